@@ -0,0 +1,187 @@
+'''
+Shared pytest fixtures
+
+`clock` is a virtual clock, so code that sleeps can be tested without waiting
+`runner` is a fake command runner that stands in for subprocess.run in
+dist_stat_test, `diskstats` a fake /proc/diskstats, and `disk_check` wires them
+all into dist_stat_test for one test
+
+Everything is fixture scoped and installed with monkeypatch, so no state is shared
+between tests, and the tests can run in any order or in parallel (e.g. pytest-xdist)
+'''
+import pytest
+
+import dist_stat_test
+import disk_stats
+
+import io
+import subprocess
+import types
+
+class VirtualClock:
+	'''
+	Stands in for the time module; sleep() just moves the clock forward
+	'''
+	def __init__(self, start=0.0):
+		self.now = start
+		self.sleeps = []
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		self.now += seconds
+
+	def monotonic(self):
+		return self.now
+
+	def time(self):
+		return self.now
+
+def step(cmd):
+	'''
+	Names the step of dist_stat_test.main() that runs `cmd`
+	'''
+	if cmd[0] == "grep":
+		return "partitions"
+	if cmd[0] == "ls":
+		return "sysfs"
+	if cmd[0] == "cat":
+		return "sys_stat"
+	return cmd[0]
+
+def stat(reads=1, in_flight=0, io_ticks=0):
+	'''
+	The counters of a sysfs stat, for a disk that has completed `reads` reads
+	'''
+	return f"{reads} 0 {reads * 8} 0 0 0 0 0 {in_flight} {io_ticks} {io_ticks}\n"
+
+def row(disk, reads=1, in_flight=0, io_ticks=0):
+	'''
+	A /proc/diskstats row for `disk`
+	'''
+	return f"   8       0 {disk} {stat(reads, in_flight, io_ticks).strip()} 0 0 0 0 0 0\n"
+
+class FakeDiskstats:
+	'''
+	Stands in for /proc/diskstats: disk_stats.read() of it parses rows made up here,
+	rather than the file, so the parser is the real one
+
+	There's a row for every device read, see row(), and every disk completes
+	another read each time the rows are read, so its stats always look like they
+	changed; `reads` holds the devices asked for by each read.  add() gives a
+	device counters of its own, which stay as given unless `moving`, remove() leaves
+	its row out, and on() queues up whole contents for the next reads, after which
+	the rows apply again
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.rows = {}
+		self.moving = set()
+		self.removed = set()
+		self.queued = []
+		self.reads = []
+		self.parse = disk_stats.read
+
+	def add(self, name, counters, moving=False):
+		self.rows[name] = [int(counter) for counter in counters.split()]
+		if moving:
+			self.moving.add(name)
+
+	def remove(self, name):
+		self.removed.add(name)
+
+	def on(self, contents):
+		self.queued.extend(contents)
+
+	def read(self, path, devices=None, **kwargs):
+		if path != self.path:
+			return self.parse(path, devices, **kwargs)
+
+		self.reads.append(None if devices is None else list(devices))
+		if self.queued:
+			text = self.queued.pop(0)
+		else:
+			for device in devices or ():
+				if device not in self.rows:
+					self.add(device, row(device).split(maxsplit=3)[3], moving=True)
+			text = "".join(f"   8       0 {name} {' '.join(map(str, counters))}\n"
+				for name, counters in self.rows.items() if name not in self.removed)
+			#one more read done by each moving disk, of 8 sectors
+			for name in self.moving:
+				self.rows[name][0] += 1
+				self.rows[name][2] += 8
+		return disk_stats.parse(io.BytesIO(text.encode()), devices)
+
+class FakeRunner:
+	'''
+	Stands in for subprocess.run, recording each command it's given
+
+	By default every command succeeds, and each read of a sysfs stat returns new
+	counters, see stat(), so the stats always look like they changed.  on() changes
+	what a step returns, optionally for one disk only.  `stdout` is a list of outputs handed out one per
+	call, after which the default applies again; `raises`, an exception to raise
+	instead of returning, e.g. for a command that isn't installed
+	'''
+	def __init__(self):
+		self.calls = []
+		self.rules = []
+
+	def on(self, name, returncode=0, stdout=(), stderr="", disk=None, raises=None):
+		self.rules.append({"step": name, "disk": disk, "returncode": returncode,
+			"stdout": list(stdout), "stderr": stderr, "raises": raises})
+
+	def steps(self):
+		return [step(cmd) for cmd in self.calls]
+
+	def run(self, cmd, **kwargs):
+		self.calls.append(list(cmd))
+
+		name = step(cmd)
+		returncode, stdout, stderr = 0, f"{name} output {len(self.calls)}", ""
+		if name == "sys_stat":
+			stdout = stat(len(self.calls))
+		for rule in self.rules:
+			if rule["step"] != name:
+				continue
+			if rule["disk"] is not None and rule["disk"] not in cmd and not any(f"/{rule['disk']}" in part for part in cmd):
+				continue
+			if rule["raises"] is not None:
+				raise rule["raises"]
+			returncode, stderr = rule["returncode"], rule["stderr"]
+			if rule["stdout"]:
+				stdout = rule["stdout"].pop(0)
+			break
+
+		return subprocess.CompletedProcess(cmd, returncode, stdout.encode(), stderr.encode())
+
+@pytest.fixture
+def clock():
+	return VirtualClock()
+
+@pytest.fixture
+def diskstats(tmp_path):
+	return FakeDiskstats(str(tmp_path / "proc" / "diskstats"))
+
+@pytest.fixture
+def runner():
+	return FakeRunner()
+
+@pytest.fixture
+def disk_check(tmp_path, monkeypatch, runner, clock, diskstats):
+	'''
+	Sets dist_stat_test up to check "sda" using `runner`, `clock` and `diskstats`
+	SYS points at a directory holding a non-empty block/sda/stat, which tests may
+	remove or empty, and PROC at a directory whose diskstats is `diskstats`; DEV is
+	left alone, as only the runner looks at it
+	'''
+	stat = tmp_path / "sys" / "block" / "sda" / "stat"
+	stat.parent.mkdir(parents=True)
+	stat.write_text("       1        0        8        0        0        0        0        0        0        0        0\n")
+
+	monkeypatch.setattr(dist_stat_test, "DISK", "sda")
+	monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+	monkeypatch.setattr(dist_stat_test, "SYS", str(tmp_path / "sys"))
+	monkeypatch.setattr(dist_stat_test, "PROC", str(tmp_path / "proc"))
+	monkeypatch.setattr(dist_stat_test.disk_stats, "read", diskstats.read)
+	monkeypatch.setattr(dist_stat_test, "subprocess", types.SimpleNamespace(run=runner.run))
+	monkeypatch.setattr(dist_stat_test, "time", clock)
+	return stat
@@ -0,0 +1,326 @@
+'''
+Collects dist_stat_test result records sent in by many hosts, for fleet-wide views
+
+Hosts connect over TCP and stream newline-delimited JSON, one result record (see
+dist_stat_test.check_disk) per line; when a host has sent everything it shuts down
+its side of the connection, and the collector answers with a single line,
+{"received": N, "rejected": M}, or {"error": ...} if it refused the connection.
+send_results() is the client side of this
+
+Records are counted into per-host and per-model rollups as they arrive, then put on
+a bounded queue; one writer task takes them off in batches of up to BATCH and
+stores each batch in a single transaction (see disk_results_db.store), in a thread
+of its own so the event loop isn't held up by SQLite.  Records whose fields don't
+have the types in FIELDS are rejected as they arrive, and a batch that still can't
+be stored is retried a record at a time, so a bad record costs no one else theirs
+
+When the writer falls behind and the queue fills, connection handlers wait to put
+their records on it, and so stop reading their sockets; TCP flow control then
+slows the senders down.  The rest of the collector's memory is bounded too: at
+most MAX_CONNECTIONS are served at once, each buffering a line or two of up to
+LINE_LIMIT bytes, and further connections are refused; a record's strings are at
+most FIELD_LIMIT characters; and the rollups keep at most MAX_ROLLUPS hosts (and
+as many models), counting any more together under OTHER
+
+Run on its own to listen, e.g. `python3 disk_collector.py 0.0.0.0:9400 --db fleet.db`
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import socket
+import sys
+
+import disk_results_db
+
+#how many records may be waiting to be written before senders are made to wait
+QUEUE_SIZE = 10000
+#most records written in one transaction
+BATCH = 1000
+#longest line (record) accepted; a connection sending a longer one is dropped
+LINE_LIMIT = 64 * 1024
+#most connections served at once; one over it is refused
+MAX_CONNECTIONS = 256
+#longest string a record's field may hold
+FIELD_LIMIT = 256
+#most hosts, and most models, with rollups of their own; results of any others are rolled up under OTHER
+MAX_ROLLUPS = 10000
+OTHER = "(other)"
+
+#the types a record's fields may have; each may also be left out, or null, except
+#disk and status: a result that doesn't say whether the disk passed is no result
+FIELDS = {
+	"host": (str,),
+	"disk": (str,),
+	"serial": (str,),
+	"model": (str,),
+	"workload": (str,),
+	"status": (int,),
+	"timestamp": (int, float),
+	"iops": (int, float),
+	"bandwidth": (int, float),
+	"duration": (int, float),
+}
+
+def parse_address(address):
+	'''
+	Splits "HOST:PORT" into (host, port)
+	'''
+	host, _, port = address.rpartition(":")
+	if not host or not port.isdigit():
+		raise ValueError(f"Expected HOST:PORT, got {address!r}")
+	return host.strip("[]"), int(port)
+
+def valid(record):
+	'''
+	Whether `record` is a result record that can be rolled up and stored: a dict
+	naming its disk and status, whose fields have the types in FIELDS, and whose
+	strings are no longer than FIELD_LIMIT
+	'''
+	if not isinstance(record, dict) or not isinstance(record.get("disk"), str) or record.get("status") is None:
+		return False
+	for field, types in FIELDS.items():
+		value = record.get(field)
+		#bool is a subclass of int, but true isn't a status
+		if value is not None and (isinstance(value, bool) or not isinstance(value, types)):
+			return False
+		if isinstance(value, str) and len(value) > FIELD_LIMIT:
+			return False
+	return True
+
+class Rollup:
+	'''
+	Running totals for a group of results, e.g. one host's or one model's
+	'''
+	def __init__(self):
+		self.results = 0
+		self.failed = 0
+		self.measured = 0
+		self.bandwidth = 0.0
+
+	def add(self, record):
+		self.results += 1
+		if record.get("status"):
+			self.failed += 1
+		if record.get("bandwidth") is not None:
+			self.measured += 1
+			self.bandwidth += record["bandwidth"]
+
+	def as_dict(self):
+		return {
+			"results": self.results,
+			"failed": self.failed,
+			"mean_bandwidth": self.bandwidth / self.measured if self.measured else None,
+		}
+
+class Collector:
+	'''
+	The collector server; start() it inside a running event loop, stop() it to
+	close the listening socket and wait for everything received to be written
+	`db` is the path of a disk_results_db database, or None to only keep rollups
+	'''
+	def __init__(self, db=None, queue_size=QUEUE_SIZE, batch=BATCH, max_connections=MAX_CONNECTIONS, max_rollups=MAX_ROLLUPS):
+		self.db = db
+		self.batch = batch
+		self.queue = asyncio.Queue(queue_size)
+		self.max_connections = max_connections
+		self.connections = 0
+		self.max_rollups = max_rollups
+		self.hosts = {}
+		self.models = {}
+		self.received = 0
+		self.stored = 0
+		self.server = None
+		self.writer = None
+		self.conn = None
+		#a single thread, so the SQLite connection is only ever used from the thread that opened it
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+	async def start(self, host="127.0.0.1", port=0):
+		'''
+		Starts listening; returns the (host, port) listened on, useful when `port` is 0
+		'''
+		self.writer = asyncio.create_task(self.write())
+		self.server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+		return self.server.sockets[0].getsockname()[:2]
+
+	async def stop(self):
+		self.server.close()
+		await self.server.wait_closed()
+		await self.queue.join()
+		self.writer.cancel()
+		loop = asyncio.get_running_loop()
+		await loop.run_in_executor(self.executor, self._close)
+		self.executor.shutdown()
+
+	def rollups(self):
+		'''
+		The live rollups, as {"hosts": {host: totals}, "models": {model: totals}}
+		'''
+		return {
+			"hosts": {host: rollup.as_dict() for host, rollup in self.hosts.items()},
+			"models": {model: rollup.as_dict() for model, rollup in self.models.items()},
+		}
+
+	def add(self, record):
+		self.received += 1
+		self._rollup(self.hosts, record["host"]).add(record)
+		self._rollup(self.models, record.get("model")).add(record)
+
+	def _rollup(self, rollups, key):
+		if key not in rollups and len(rollups) >= self.max_rollups:
+			key = OTHER
+		return rollups.setdefault(key, Rollup())
+
+	async def handle(self, reader, writer):
+		'''
+		Reads one host's stream of records, unless MAX_CONNECTIONS are already being read
+		'''
+		if self.connections >= self.max_connections:
+			try:
+				writer.write(json.dumps({"error": "too many connections"}).encode() + b"\n")
+				await writer.drain()
+			except ConnectionError:
+				pass
+			finally:
+				writer.close()
+			return
+
+		self.connections += 1
+		peer = writer.get_extra_info("peername")
+		received = rejected = 0
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+				except ValueError:
+					#a line over LINE_LIMIT; there's no finding where the next record starts
+					rejected += 1
+					break
+				if not line:
+					break
+
+				try:
+					record = json.loads(line)
+				except ValueError:
+					rejected += 1
+					continue
+				if not valid(record):
+					rejected += 1
+					continue
+
+				if record.get("host") is None:
+					record["host"] = peer[0] if peer else None
+				self.add(record)
+				#waits while the queue is full, which is what pushes back on the sender
+				await self.queue.put(record)
+				received += 1
+
+			writer.write(json.dumps({"received": received, "rejected": rejected}).encode() + b"\n")
+			await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			self.connections -= 1
+			writer.close()
+
+	async def write(self):
+		'''
+		Writes queued records to the database, in batches of whatever has built up
+		'''
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = [await self.queue.get()]
+			while len(batch) < self.batch and not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+
+			try:
+				if self.db is not None:
+					await loop.run_in_executor(self.executor, self._store, batch)
+				self.stored += len(batch)
+			except Exception:
+				#one record that can't be stored mustn't cost the others theirs
+				stored, error = await loop.run_in_executor(self.executor, self._store_each, batch)
+				self.stored += stored
+				if stored < len(batch):
+					print(f"ERROR: could not store {len(batch) - stored} of {len(batch)} results: {error}", file=sys.stderr)
+			finally:
+				for _ in batch:
+					self.queue.task_done()
+
+	def _store(self, batch):
+		if self.conn is None:
+			self.conn = disk_results_db.connect(self.db)
+		disk_results_db.store(self.conn, batch)
+
+	def _store_each(self, batch):
+		'''
+		Stores `batch` a record at a time, for when it couldn't be stored as a whole;
+		returns how many were stored, and the last error
+		'''
+		stored, error = 0, None
+		for record in batch:
+			try:
+				self._store([record])
+				stored += 1
+			except Exception as e:
+				error = e
+		return stored, error
+
+	def _close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+def send_results(records, address, timeout=30):
+	'''
+	Sends `records` to the collector at `address` ("HOST:PORT" or (host, port)) over
+	one connection; returns the collector's reply, {"received": N, "rejected": M}
+	Raises OSError if the collector can't be reached, doesn't reply or refuses the results
+	'''
+	if isinstance(address, str):
+		address = parse_address(address)
+
+	data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+	with socket.create_connection(address, timeout=timeout) as sock:
+		try:
+			sock.sendall(data)
+			sock.shutdown(socket.SHUT_WR)
+		except OSError:
+			#a collector refusing the connection may have closed it already; its reply says why
+			pass
+		reply = sock.makefile("rb").readline()
+
+	if not reply:
+		raise ConnectionError(f"No reply from collector at {address[0]}:{address[1]}")
+	reply = json.loads(reply)
+	if "error" in reply:
+		raise ConnectionError(f"Collector at {address[0]}:{address[1]} refused the results: {reply['error']}")
+	return reply
+
+async def serve(address, db=None, interval=60):
+	'''
+	Runs a collector until cancelled, printing the per-model rollups every `interval` seconds
+	'''
+	collector = Collector(db)
+	host, port = await collector.start(*parse_address(address))
+	print(f"Collecting results on {host}:{port}")
+	try:
+		while True:
+			await asyncio.sleep(interval)
+			for model, totals in collector.rollups()["models"].items():
+				print(f"{model}: {totals['results']} results, {totals['failed']} failed, mean bandwidth {totals['mean_bandwidth']}")
+	finally:
+		await collector.stop()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Collects dist_stat_test results sent with --report")
+	parser.add_argument('address', type=str, help='HOST:PORT to listen on, e.g. 0.0.0.0:9400')
+	parser.add_argument('--db', type=str, help='SQLite database to store the results in')
+	parser.add_argument('--interval', type=float, default=60, help='Seconds between printing rollups; default 60')
+	args = parser.parse_args()
+
+	try:
+		asyncio.run(serve(args.address, args.db, args.interval))
+	except KeyboardInterrupt:
+		pass
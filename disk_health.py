@@ -0,0 +1,204 @@
+'''
+Drive health: the SMART status and attributes of a disk, or the SMART / Health
+Information log page of an NVMe drive
+
+NVMe drives are asked for log page 0x02 directly, with the NVMe admin passthrough
+ioctl, when the device node can be opened (root, or a udev rule); this needs no
+tools installed.  Otherwise, and for every other disk, `smartctl -j` is run and its
+JSON output read
+
+Health data changes slowly and asking for it can take a second or more per drive,
+so each drive's summary is cached on disk, keyed by serial number, for TTL seconds.
+Anyone who could write to the cache could hide a failing drive behind a forged
+summary, so it's only used if its directory is owned by this user and no one else
+can write to it
+'''
+import ctypes
+import fcntl
+import json
+import os
+import stat
+import struct
+import subprocess
+import tempfile
+import time
+
+import disk_topology
+
+#where each drive's last health summary is kept, and for how long it's good for
+CACHE_DIR = "/var/cache/dist_stat_test/health"
+TTL = 60 * 60
+
+#_IOWR('N', 0x41, struct nvme_admin_cmd), from linux/nvme_ioctl.h
+NVME_IOCTL_ADMIN_CMD = 0xC0484E41
+#struct nvme_admin_cmd: opcode, flags, rsvd1, nsid, cdw2, cdw3, metadata, addr,
+#metadata_len, data_len, cdw10-cdw15, timeout_ms, result
+NVME_ADMIN_CMD = struct.Struct("=BBHIIIQQII6III")
+NVME_GET_LOG_PAGE = 0x02
+NVME_LOG_SMART = 0x02
+NVME_LOG_SMART_SIZE = 512
+NVME_NSID_ALL = 0xFFFFFFFF
+
+#smartctl's exit status is a bitmask; these bits mean it couldn't parse its command
+#line or open the drive, the others report on what it read
+SMARTCTL_FAILED = 0b11
+
+#ATA SMART attribute ids
+REALLOCATED_SECTORS = 5
+PENDING_SECTORS = 197
+
+class HealthError(Exception):
+	pass
+
+def parse_nvme_smart_log(data):
+	'''
+	Summarises an NVMe SMART / Health Information log page (log page 0x02)
+	'''
+	critical_warning = data[0]
+	temperature = int.from_bytes(data[1:3], "little")
+	u128 = lambda offset: int.from_bytes(data[offset:offset + 16], "little")
+	return {
+		"source": "nvme",
+		"passed": critical_warning == 0,
+		"critical_warning": critical_warning,
+		#reported in kelvin
+		"temperature": temperature - 273 if temperature else None,
+		"available_spare": data[3],
+		"percentage_used": data[5],
+		#in thousands of 512 byte units
+		"data_units_read": u128(32),
+		"data_units_written": u128(48),
+		"power_on_hours": u128(128),
+		"unsafe_shutdowns": u128(144),
+		"media_errors": u128(160),
+	}
+
+def nvme_smart_log(path):
+	'''
+	Reads the SMART / Health Information log page of the NVMe drive at `path` with
+	the admin passthrough ioctl; raises OSError if the drive can't be opened or asked
+	'''
+	buffer = ctypes.create_string_buffer(NVME_LOG_SMART_SIZE)
+	#cdw10: the log page id, and the number of dwords to return, less one
+	cdw10 = NVME_LOG_SMART | ((NVME_LOG_SMART_SIZE // 4 - 1) << 16)
+	cmd = bytearray(NVME_ADMIN_CMD.pack(NVME_GET_LOG_PAGE, 0, 0, NVME_NSID_ALL, 0, 0, 0,
+		ctypes.addressof(buffer), 0, NVME_LOG_SMART_SIZE, cdw10, 0, 0, 0, 0, 0, 0, 0))
+
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		status = fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd)
+	finally:
+		os.close(fd)
+	if status != 0:
+		raise OSError(f"NVMe get log page failed with status {status:#x}")
+	return parse_nvme_smart_log(buffer.raw)
+
+def _raw_attribute(attributes, id):
+	for attribute in attributes:
+		if attribute.get("id") == id:
+			return attribute.get("raw", {}).get("value")
+	return None
+
+def parse_smartctl(output):
+	'''
+	Summarises the JSON output of `smartctl -j -a`
+	'''
+	try:
+		data = json.loads(output)
+	except ValueError:
+		raise HealthError("smartctl output is not JSON; smartctl 7.0 or newer is needed")
+
+	if "smart_status" not in data:
+		messages = [message.get("string", "") for message in data.get("smartctl", {}).get("messages", [])]
+		raise HealthError(f"No SMART data: {'; '.join(messages) or 'unknown reason'}")
+
+	attributes = data.get("ata_smart_attributes", {}).get("table", [])
+	nvme_log = data.get("nvme_smart_health_information_log", {})
+	return {
+		"source": "smartctl",
+		"passed": data["smart_status"].get("passed"),
+		"temperature": data.get("temperature", {}).get("current"),
+		"power_on_hours": data.get("power_on_time", {}).get("hours"),
+		"reallocated_sectors": _raw_attribute(attributes, REALLOCATED_SECTORS),
+		"pending_sectors": _raw_attribute(attributes, PENDING_SECTORS),
+		"percentage_used": nvme_log.get("percentage_used"),
+		"media_errors": nvme_log.get("media_errors"),
+	}
+
+def smartctl(path, run=subprocess.run):
+	'''
+	Runs `smartctl -j -a` on the drive at `path`; `run` stands in for subprocess.run
+	'''
+	try:
+		res = run(["smartctl", "-j", "-a", path], capture_output=True)
+	except OSError as e:
+		raise HealthError(f"Could not run smartctl: {e}")
+	if res.returncode & SMARTCTL_FAILED:
+		raise HealthError(f"smartctl could not read {path}, exit status {res.returncode}")
+	return parse_smartctl(res.stdout.decode())
+
+def _cache_path(disk, sys_root, cache_dir):
+	serial, _ = disk_topology.disk_identity(disk, sys_root)
+	#a serial can hold any character; keep the file name to ones that are safe
+	key = "".join(c if c.isalnum() or c in "-_." else "_" for c in serial or disk)
+	return os.path.join(cache_dir, f"{key}.json")
+
+def _private_dir(path):
+	'''
+	Creates `path` (readable by this user only) if it doesn't exist, and says whether
+	it's a directory owned by this user that no one else can write to
+	'''
+	try:
+		os.makedirs(path, mode=0o700, exist_ok=True)
+		st = os.lstat(path)
+	except OSError:
+		return False
+	return stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+def read_health(disk, dev="/dev", run=subprocess.run):
+	'''
+	Reads `disk`'s health summary from the drive itself, never the cache
+	'''
+	path = f"{dev}/{disk}"
+	if disk.startswith("nvme"):
+		try:
+			return nvme_smart_log(path)
+		except OSError:
+			pass
+	return smartctl(path, run)
+
+def health(disk, dev="/dev", sys_root="/sys", cache_dir=None, ttl=TTL, run=subprocess.run, clock=time.time):
+	'''
+	Returns `disk`'s health summary, from the cache (CACHE_DIR by default) if it was
+	read within `ttl` seconds, otherwise from the drive; raises HealthError if
+	neither has it
+	A cache directory that isn't private to this user (see _private_dir) is neither
+	read nor written
+	'''
+	if cache_dir is None:
+		cache_dir = CACHE_DIR
+	if not _private_dir(cache_dir):
+		return read_health(disk, dev, run)
+
+	cached = _cache_path(disk, sys_root, cache_dir)
+	try:
+		with open(cached) as f:
+			entry = json.load(f)
+		if clock() - entry["time"] < ttl:
+			return entry["health"]
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+
+	summary = read_health(disk, dev, run)
+
+	#best effort; a cache that can't be written only costs a re-read next time
+	temp = None
+	try:
+		fd, temp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+		with os.fdopen(fd, "w") as f:
+			json.dump({"time": clock(), "health": summary}, f)
+		os.replace(temp, cached)
+	except OSError:
+		if temp is not None and os.path.exists(temp):
+			os.unlink(temp)
+	return summary
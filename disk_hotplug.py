@@ -0,0 +1,216 @@
+'''
+Disk arrival and removal, as it happens
+
+The kernel announces every device added or removed with a uevent on a netlink
+socket; listening there means a long running checker learns about disks straight
+away, without re-reading /proc/partitions or /sys/block on a timer.  Where that
+socket can't be opened (e.g. in some containers) we fall back to watching /dev
+with inotify, which sees the device nodes devtmpfs creates and removes.
+
+Both monitors have the same interface: fileno(), for select(), and read_events(),
+which returns a list of (action, disk) tuples with action either "add" or
+"remove", or None once the monitor has been closed.  Only whole disks are
+reported; partitions are left out.  If the kernel had to drop events because the
+monitor fell behind, a (LOST, None) tuple says so, and the set of disks has to be
+read again with scan(); see DeviceTable.resync()
+'''
+import ctypes
+import errno
+import os
+import socket
+import struct
+from pathlib import Path
+
+#the netlink protocol of uevents, which the socket module doesn't name
+NETLINK_KOBJECT_UEVENT = 15
+#the kernel's multicast group on NETLINK_KOBJECT_UEVENT (udev's own re-broadcasts are group 2)
+UEVENT_KERNEL_GROUP = 1
+#the uevent socket's receive buffer, so a burst of events (e.g. a shelf of disks
+#coming up) isn't dropped; SO_RCVBUFFORCE (which the socket module doesn't name)
+#can go past net.core.rmem_max, but needs CAP_NET_ADMIN
+UEVENT_BUFFER = 16 * 1024 * 1024
+SO_RCVBUFFORCE = 33
+#the action reported when events were dropped
+LOST = "lost"
+
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class HotplugError(Exception): pass
+
+def parse_uevent(data):
+	'''
+	Parses a kernel uevent, e.g.
+	b"add@/devices/.../block/sdb\\0ACTION=add\\0DEVPATH=...\\0SUBSYSTEM=block\\0DEVNAME=sdb\\0DEVTYPE=disk\\0"
+	into a dict of its KEY=VALUE pairs; returns None for anything else (e.g. udev's messages)
+	'''
+	parts = data.split(b"\0")
+	if not parts or b"@" not in parts[0]:
+		return None
+
+	event = {}
+	for part in parts[1:]:
+		key, sep, value = part.partition(b"=")
+		if sep:
+			event[key.decode(errors="replace")] = value.decode(errors="replace")
+	return event
+
+def disk_event(event):
+	'''
+	Returns the (action, disk) a parsed uevent describes, or None if it isn't a disk being added or removed
+	'''
+	if event is None or event.get("SUBSYSTEM") != "block" or event.get("DEVTYPE") != "disk":
+		return None
+	if event.get("ACTION") not in ("add", "remove") or not event.get("DEVNAME"):
+		return None
+	return event["ACTION"], Path(event["DEVNAME"]).name
+
+class UeventMonitor:
+	'''
+	Listens for the kernel's uevents on a netlink socket
+	'''
+	def __init__(self):
+		try:
+			self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+			self.sock.bind((0, UEVENT_KERNEL_GROUP))
+		except (OSError, AttributeError) as e:
+			raise HotplugError(f"can't listen for uevents: {e}")
+		self.sock.setblocking(False)
+
+		try:
+			self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, UEVENT_BUFFER)
+		except OSError:
+			#without CAP_NET_ADMIN; the kernel caps this one at net.core.rmem_max
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UEVENT_BUFFER)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def read_events(self):
+		events = []
+		while True:
+			try:
+				data = self.sock.recv(65536)
+			except BlockingIOError:
+				return events
+			except OSError as e:
+				if e.errno != errno.ENOBUFS:
+					raise
+				#the receive buffer overflowed and events were dropped; the socket
+				#carries on with the ones after, and one LOST covers them all
+				if (LOST, None) not in events:
+					events.append((LOST, None))
+				continue
+			event = disk_event(parse_uevent(data))
+			if event is not None:
+				events.append(event)
+
+	def close(self):
+		self.sock.close()
+
+class InotifyMonitor:
+	'''
+	Watches a /dev directory for device nodes being created and removed
+
+	/dev has plenty in it that isn't a disk, so a new node counts as a disk only if
+	SYS/block has an entry of the same name (partitions live a level further down,
+	under their disk, so are left out as well)
+	'''
+	def __init__(self, dev="/dev", sys_root="/sys"):
+		self.sys_root = sys_root
+		self._libc = ctypes.CDLL(None, use_errno=True)
+
+		self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise HotplugError(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+
+		mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+		if self._libc.inotify_add_watch(self.fd, os.fsencode(dev), mask) < 0:
+			error = ctypes.get_errno()
+			os.close(self.fd)
+			raise HotplugError(f"can't watch {dev}: {os.strerror(error)}")
+
+	def fileno(self):
+		return self.fd
+
+	def read_events(self):
+		events = []
+		while True:
+			try:
+				data = os.read(self.fd, 65536)
+			except BlockingIOError:
+				return events
+
+			offset = 0
+			while offset < len(data):
+				_, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+				offset += INOTIFY_EVENT.size
+				name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+				offset += length
+
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					if os.path.isdir(f"{self.sys_root}/block/{name}"):
+						events.append(("add", name))
+				elif mask & (IN_DELETE | IN_MOVED_FROM):
+					#by now the sysfs entry may be gone too, so leave filtering to the DeviceTable
+					events.append(("remove", name))
+
+	def close(self):
+		os.close(self.fd)
+
+def open_monitor(dev="/dev", sys_root="/sys"):
+	'''
+	Returns a UeventMonitor if we can listen for uevents, otherwise an InotifyMonitor
+	'''
+	try:
+		return UeventMonitor()
+	except HotplugError:
+		return InotifyMonitor(dev, sys_root)
+
+def scan(sys_root="/sys"):
+	'''
+	The disks present right now; used once, to fill the DeviceTable when watching starts
+	'''
+	try:
+		return sorted(entry.name for entry in os.scandir(f"{sys_root}/block"))
+	except OSError:
+		return []
+
+class DeviceTable:
+	'''
+	The set of disks currently present, kept up to date one event at a time
+	'''
+	def __init__(self, disks=()):
+		self.disks = set(disks)
+
+	def __contains__(self, disk):
+		return disk in self.disks
+
+	def __iter__(self):
+		return iter(sorted(self.disks))
+
+	def resync(self, disks):
+		'''
+		The events that bring the table in line with `disks`, those present now, e.g.
+		from scan() after events were lost; apply() them as usual
+		'''
+		disks = set(disks)
+		return [("remove", disk) for disk in sorted(self.disks - disks)] + [("add", disk) for disk in sorted(disks - self.disks)]
+
+	def apply(self, action, disk):
+		'''
+		Applies one event; returns True if it changed the table, so duplicate adds
+		(or removes of nodes that were never disks) can be ignored
+		'''
+		if action == "add" and disk not in self.disks:
+			self.disks.add(disk)
+			return True
+		if action == "remove" and disk in self.disks:
+			self.disks.discard(disk)
+			return True
+		return False
@@ -0,0 +1,150 @@
+'''
+Runs a check as a pipeline of stages, over any number of disks at once
+
+Each Stage names the stages it needs, and is run once for all the disks still being
+checked: a stage gets the whole list, so one that reads a shared file (e.g.
+/proc/diskstats) reads it once for everyone, and one that waits (e.g. for the
+stats to settle) waits once.  Stages are run in an order that puts every stage
+after the ones it needs, and otherwise in the order they were added
+
+A stage can fail a disk, which is reported and sets the disk's status but lets
+its check go on (as check_return_code() does), or stop it, which ends its check
+there: no later stage is run for it.  A stage that raises fails and stops every
+disk it was run for, rather than ending the whole run
+
+Extra stages can be added to a pipeline with add(); see dist_stat_test.PIPELINE
+'''
+class PipelineError(Exception):
+	pass
+
+class Stage:
+	'''
+	`run(pipeline_run, disks)` does the stage's work for `disks`, returning a dict of
+	disk to its result (disks left out get None); `needs` names the stages whose
+	results it uses; `enabled`, if given, is called when the pipeline runs, and the
+	stage is left out if it returns false
+	`needs` only orders the stages: a stage is still run for a disk that failed a
+	stage it needs (only stopping a disk ends its check), and when a stage it needs
+	was left out its result is None
+	'''
+	def __init__(self, name, run, needs=(), enabled=None):
+		self.name = name
+		self.run = run
+		self.needs = tuple(needs)
+		self.enabled = enabled
+
+	def __repr__(self):
+		return f"Stage({self.name!r}, needs={self.needs!r})"
+
+class Run:
+	'''
+	One run of a pipeline over a list of disks; what stages see and report through
+	'''
+	def __init__(self, disks, report=None):
+		self.disks = list(disks)
+		self.results = {disk: {} for disk in self.disks}
+		self.status = dict.fromkeys(self.disks, 0)
+		self.failures = dict.fromkeys(self.disks, 0)
+		self.stopped = set()
+		self.report = report
+
+	def result(self, disk, stage):
+		'''
+		What `stage` found for `disk`, or None if it didn't run for the disk
+		'''
+		return self.results[disk].get(stage)
+
+	def check(self, disk, return_code, message, *outputs):
+		'''
+		Fails `disk` with `return_code` if it isn't 0; the first failure sets its status
+		'''
+		if return_code == 0:
+			return
+		if self.report is not None:
+			self.report(return_code, message, *outputs)
+		self.failures[disk] += 1
+		if self.status[disk] == 0:
+			self.status[disk] = return_code
+
+	def stop(self, disk):
+		'''
+		Ends `disk`'s check after the current stage
+		'''
+		self.stopped.add(disk)
+
+	def active(self):
+		return [disk for disk in self.disks if disk not in self.stopped]
+
+class Pipeline:
+	def __init__(self, stages=(), report=None):
+		'''
+		`report(return_code, message, *outputs)` is called for each failure
+		'''
+		self.stages = []
+		self.report = report
+		for stage in stages:
+			self.add(stage)
+
+	def add(self, stage):
+		if any(existing.name == stage.name for existing in self.stages):
+			raise PipelineError(f"There is already a stage named {stage.name}")
+		self.stages.append(stage)
+		return stage
+
+	def order(self):
+		'''
+		The stages in the order they're run; raises PipelineError if a stage needs
+		one that doesn't exist, or stages need each other
+		'''
+		stages = {stage.name: stage for stage in self.stages}
+		for stage in self.stages:
+			for need in stage.needs:
+				if need not in stages:
+					raise PipelineError(f"Stage {stage.name} needs {need}, which doesn't exist")
+
+		ordered = []
+		done = set()
+		visiting = []
+
+		def visit(stage):
+			if stage.name in done:
+				return
+			if stage.name in visiting:
+				raise PipelineError(f"Stages depend on each other: {' -> '.join(visiting + [stage.name])}")
+			visiting.append(stage.name)
+			for need in stage.needs:
+				visit(stages[need])
+			visiting.pop()
+			done.add(stage.name)
+			ordered.append(stage)
+
+		for stage in self.stages:
+			visit(stage)
+		return ordered
+
+	def run(self, disks):
+		'''
+		Runs every enabled stage over `disks`, returning the Run
+		'''
+		run = Run(disks, self.report)
+		for stage in self.order():
+			if stage.enabled is not None and not stage.enabled():
+				continue
+
+			todo = run.active()
+			if not todo:
+				continue
+
+			try:
+				results = stage.run(run, todo) or {}
+			except Exception as e:
+				#the stage's disks can't be trusted to have been checked; end their checks,
+				#and carry on with the rest of the run
+				for disk in todo:
+					if disk not in run.stopped:
+						run.check(disk, 1, f"Stage {stage.name} failed for {disk}: {e!r}")
+						run.stop(disk)
+				results = {}
+			for disk in todo:
+				run.results[disk][stage.name] = results.get(disk)
+		return run
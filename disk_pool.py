@@ -0,0 +1,319 @@
+'''
+A small supervised process pool for running per-disk work in isolation
+
+A failing disk can leave a read (hdparm, or even a plain read of a sysfs file)
+blocked in uninterruptible sleep, and a process in that state cannot be joined
+or waited on until the kernel gives up on the I/O.  To keep one bad drive from
+holding up a whole sweep, each task is run in its own forked child with its own
+process group, and given a deadline.  Children that miss their deadline are
+sent SIGKILL and abandoned: the pool never waits on them again (beyond a
+non-blocking reap), and their slot is handed to the next task.
+
+run_threaded() schedules work that has to stay in this process the same way,
+in threads, and simulate() works out how long a run would take; all of them start
+work in the order a Scheduler gives.
+
+Linux only, as is the rest of this tool.
+'''
+import concurrent.futures
+import heapq
+import os
+import pickle
+import select
+import signal
+import sys
+import time
+
+#pids of workers we have given up on; reaped opportunistically with WNOHANG
+ABANDONED = set()
+
+def _run_child(task, item, write_fd, cpus=None):
+	'''
+	Runs `task(item)` inside the forked child and sends the outcome back to the
+	parent over `write_fd` as a pickled (state, value) tuple
+	If `cpus` is given the child is pinned to them first
+	A SystemExit raised by the task is treated as a normal return of its exit code,
+	so existing functions that end with `sys.exit(STATUS)` can be used as tasks
+	Never returns
+	'''
+	try:
+		#own process group, so a kill also takes out anything the task spawned (e.g. hdparm)
+		os.setpgid(0, 0)
+		if cpus:
+			try:
+				os.sched_setaffinity(0, cpus)
+			except OSError:
+				#e.g. the cpus are outside our cpuset; run unpinned rather than not at all
+				pass
+		try:
+			payload = ("ok", task(item))
+		except SystemExit as e:
+			payload = ("ok", e.code)
+		except BaseException as e:
+			payload = ("error", repr(e))
+
+		try:
+			data = pickle.dumps(payload)
+		except Exception as e:
+			data = pickle.dumps(("error", f"unpicklable result: {e!r}"))
+
+		view = memoryview(data)
+		while view:
+			written = os.write(write_fd, view)
+			view = view[written:]
+	finally:
+		for stream in (sys.stdout, sys.stderr):
+			try:
+				stream.flush()
+			except Exception:
+				pass
+		os._exit(0)
+
+class Worker:
+	'''
+	A single forked child running `task(item)`
+
+	The parent side holds the non-blocking read end of a pipe; `read()` is called
+	whenever that pipe is readable and returns True once the child has finished,
+	at which point `result` holds a (state, value) tuple where state is one of
+	"ok", "error" or "timeout"
+	'''
+	def __init__(self, task, item, timeout=None, cpus=None, group=None):
+		self.item = item
+		self.group = group
+		self.result = None
+		self.deadline = None if timeout is None else time.monotonic() + timeout
+		self._chunks = []
+
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(read_fd)
+			_run_child(task, item, write_fd, cpus)
+
+		os.close(write_fd)
+		os.set_blocking(read_fd, False)
+		self.pid = pid
+		self.fd = read_fd
+
+	def expired(self, now=None):
+		if self.deadline is None:
+			return False
+		if now is None:
+			now = time.monotonic()
+		return now >= self.deadline
+
+	def read(self):
+		'''
+		Drains whatever the child has written so far
+		Returns True when the child has closed its end of the pipe (i.e. exited)
+		'''
+		try:
+			data = os.read(self.fd, 65536)
+		except BlockingIOError:
+			return False
+
+		if data:
+			self._chunks.append(data)
+			return False
+
+		#EOF; the child has exited, or is about to
+		os.close(self.fd)
+		self.fd = None
+		_, wait_status = os.waitpid(self.pid, 0)
+
+		if self._chunks:
+			try:
+				self.result = pickle.loads(b"".join(self._chunks))
+			except Exception as e:
+				self.result = ("error", f"corrupt result from worker: {e!r}")
+		else:
+			self.result = ("error", f"worker exited without a result, wait status {wait_status}")
+		return True
+
+	def abandon(self, reason="timeout"):
+		'''
+		Kills the child (and its process group) without waiting for it to exit
+		A child stuck in D state will only die once its I/O returns, so we just
+		record the pid and move on
+		'''
+		for kill in (os.killpg, os.kill):
+			try:
+				kill(self.pid, signal.SIGKILL)
+				break
+			except (ProcessLookupError, PermissionError):
+				continue
+
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+		ABANDONED.add(self.pid)
+		self.result = (reason, None)
+
+def reap_abandoned():
+	'''
+	Collects the exit status of any abandoned workers that have finally died
+	so they don't linger as zombies; never blocks
+	'''
+	for pid in list(ABANDONED):
+		try:
+			done, _ = os.waitpid(pid, os.WNOHANG)
+		except ChildProcessError:
+			done = pid
+		if done:
+			ABANDONED.discard(pid)
+
+class Scheduler:
+	'''
+	Decides which of the `pending` items to start next: in the order given, with at
+	most `max_workers` running at once and, if `group_of` is given, at most
+	`group_limit` of any one group (e.g. the disks behind one host adapter), skipping
+	over items whose group is full.  Items in group None are not limited
+	Items can be added to (and removed from) `pending` at any time
+	'''
+	def __init__(self, items=(), max_workers=None, group_of=None, group_limit=None):
+		if max_workers is None:
+			max_workers = os.cpu_count() or 1
+		self.max_workers = max(1, max_workers)
+		self.group_of = group_of
+		self.group_limit = None if group_limit is None else max(1, group_limit)
+		self.pending = list(items)
+		self.running = 0
+		self.group_counts = {}
+
+	def group_full(self, group):
+		if group is None or self.group_limit is None:
+			return False
+		return self.group_counts.get(group, 0) >= self.group_limit
+
+	def start(self):
+		'''
+		Takes every item that can start now off `pending`, counting it as running
+		Returns a list of (item, group)
+		'''
+		started = []
+		index = 0
+		while index < len(self.pending) and self.running < self.max_workers:
+			item = self.pending[index]
+			group = None if self.group_of is None else self.group_of(item)
+			if self.group_full(group):
+				index += 1
+				continue
+			del self.pending[index]
+			self.running += 1
+			self.group_counts[group] = self.group_counts.get(group, 0) + 1
+			started.append((item, group))
+		return started
+
+	def finished(self, group):
+		'''
+		Counts an item of `group` as no longer running
+		'''
+		self.running -= 1
+		self.group_counts[group] -= 1
+
+def run_isolated(task, items, timeout=None, max_workers=None, group_of=None, group_limit=None, affinity_of=None):
+	'''
+	Runs `task(item)` for each item, each in its own forked worker, with at most
+	`max_workers` running at once and each given `timeout` seconds to finish
+
+	If `group_of` is given, at most `group_limit` items of any one group (e.g. the
+	disks behind one host adapter) run at once; see Scheduler
+	If `affinity_of` is given, each worker is pinned to the set of CPUs it returns
+	for its item (None leaves it unpinned)
+
+	This is a generator, yielding (item, state, value) as each task completes,
+	where state is "ok" (value is the return value), "error" (value describes
+	the failure) or "timeout" (value is None; the worker was abandoned)
+	'''
+	scheduler = Scheduler(items, max_workers, group_of, group_limit)
+	running = {}
+
+	def finished(worker):
+		scheduler.finished(worker.group)
+		return (worker.item, *worker.result)
+
+	try:
+		while scheduler.pending or running:
+			#top the pool back up, replacing any finished or abandoned workers
+			for item, group in scheduler.start():
+				cpus = None if affinity_of is None else affinity_of(item)
+				worker = Worker(task, item, timeout, cpus, group)
+				running[worker.fd] = worker
+
+			#wait for output, but no longer than the nearest deadline
+			deadlines = [w.deadline for w in running.values() if w.deadline is not None]
+			wait = None
+			if deadlines:
+				wait = max(0, min(deadlines) - time.monotonic())
+
+			readable, _, _ = select.select(list(running), [], [], wait)
+
+			for fd in readable:
+				worker = running[fd]
+				if worker.read():
+					del running[fd]
+					yield finished(worker)
+
+			now = time.monotonic()
+			for fd, worker in list(running.items()):
+				if worker.expired(now):
+					del running[fd]
+					worker.abandon()
+					yield finished(worker)
+
+			reap_abandoned()
+	finally:
+		#if the caller stops early (or we're interrupted) don't leave workers behind
+		for worker in running.values():
+			worker.abandon("cancelled")
+
+def run_threaded(task, items, max_workers=None, group_of=None, group_limit=None):
+	'''
+	Runs `task(item)` for each item in a thread of this process, starting them in
+	the same order and under the same `max_workers` and `group_of` / `group_limit`
+	limits as run_isolated(); for work that shares state with the caller, and so
+	can't be isolated (or given a deadline)
+
+	This is a generator, yielding (item, state, value) as each task completes,
+	where state is "ok" (value is the return value) or "error" (value is the
+	exception the task raised)
+	'''
+	scheduler = Scheduler(items, max_workers, group_of, group_limit)
+	#future: (item, group)
+	running = {}
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=scheduler.max_workers) as executor:
+		while scheduler.pending or running:
+			for item, group in scheduler.start():
+				running[executor.submit(task, item)] = (item, group)
+
+			done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				item, group = running.pop(future)
+				scheduler.finished(group)
+				error = future.exception()
+				yield (item, "ok", future.result()) if error is None else (item, "error", error)
+
+def simulate(durations, items, max_workers=None, group_of=None, group_limit=None):
+	'''
+	Works out how long run_isolated() would take to run `items`, if each took
+	durations[item] seconds, by starting them in the same order under the same limits
+	Returns (total seconds, {item: seconds from the start at which it starts})
+	'''
+	scheduler = Scheduler(items, max_workers, group_of, group_limit)
+	#(finish time, order started, group) of each running item
+	running = []
+	starts = {}
+	now = 0.0
+
+	while scheduler.pending or running:
+		for item, group in scheduler.start():
+			starts[item] = now
+			heapq.heappush(running, (now + durations[item], len(starts), group))
+
+		now, _, group = heapq.heappop(running)
+		scheduler.finished(group)
+
+	return now, starts
@@ -0,0 +1,159 @@
+'''
+A local SQLite store of per-disk check results, so runs can be compared over time
+
+Every result record (see dist_stat_test.check_disk) is kept, keyed by the host it
+ran on, the disk's serial number and when it ran.  Disks are identified by serial
+rather than name, since sda on one boot can be sdb on the next
+
+Queries are written to use the indexes on results: e.g. throughput_drops() looks
+up each workload each disk has measured in the small `measured` table, then seeks
+through the (host, serial, workload, ts) index to the first and last result in the
+window for that disk and workload, so its cost grows with the number of disks, not
+the number of results.  model_durations() reads the (workload, status,
+model, duration) index alone, which holds the passed checks of a workload together
+and already grouped by model
+'''
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS disks (
+	host TEXT NOT NULL,
+	serial TEXT NOT NULL,
+	model TEXT,
+	PRIMARY KEY (host, serial)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS measured (
+	host TEXT NOT NULL,
+	serial TEXT NOT NULL,
+	workload TEXT NOT NULL,
+	PRIMARY KEY (host, serial, workload)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS results (
+	host TEXT NOT NULL,
+	serial TEXT NOT NULL,
+	ts REAL NOT NULL,
+	disk TEXT NOT NULL,
+	model TEXT,
+	status INTEGER NOT NULL,
+	workload TEXT,
+	iops REAL,
+	bandwidth REAL,
+	duration REAL
+);
+
+CREATE INDEX IF NOT EXISTS results_host_serial_ts ON results (host, serial, ts);
+CREATE INDEX IF NOT EXISTS results_host_serial_workload_ts ON results (host, serial, workload, ts);
+CREATE INDEX IF NOT EXISTS results_workload_status_model ON results (workload, status, model, duration);
+"""
+
+COLUMNS = ("host", "serial", "ts", "disk", "model", "status", "workload", "iops", "bandwidth", "duration")
+
+DAY = 24 * 60 * 60
+
+def connect(path):
+	'''
+	Opens (creating if need be) the results database at `path`
+	'''
+	conn = sqlite3.connect(path)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	#a database from before `measured` existed has it filled in from its results
+	backfill = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'measured'").fetchone() is None
+	conn.executescript(SCHEMA)
+	if backfill:
+		with conn:
+			conn.execute("""INSERT OR IGNORE INTO measured (host, serial, workload)
+				SELECT DISTINCT host, serial, workload FROM results WHERE workload IS NOT NULL AND bandwidth IS NOT NULL""")
+	return conn
+
+def _row(record, host):
+	#a record without a status never said the disk passed, so mustn't be taken as a pass
+	if record.get("status") is None:
+		raise ValueError(f"The result for {record['disk']} has no status")
+	return (
+		record.get("host", host),
+		record.get("serial") or record["disk"],
+		record.get("timestamp") or time.time(),
+		record["disk"],
+		record.get("model"),
+		record["status"],
+		record.get("workload"),
+		record.get("iops"),
+		record.get("bandwidth"),
+		record.get("duration"),
+	)
+
+def store(conn, records, host=None):
+	'''
+	Inserts result records in a single transaction; `host` is used for records that
+	don't name their own
+	Raises ValueError, and stores none of them, if any record has no status
+	'''
+	rows = [_row(record, host) for record in records]
+	with conn:
+		conn.executemany("INSERT OR IGNORE INTO disks (host, serial, model) VALUES (?, ?, ?)",
+			{(row[0], row[1], row[4]) for row in rows})
+		conn.executemany("INSERT OR IGNORE INTO measured (host, serial, workload) VALUES (?, ?, ?)",
+			{(row[0], row[1], row[6]) for row in rows if row[6] is not None and row[8] is not None})
+		conn.executemany(f"INSERT INTO results ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+	return len(rows)
+
+def history(conn, host, serial, since=None):
+	'''
+	The results for one disk, oldest first, as dicts
+	'''
+	if since is None:
+		since = float("-inf")
+	cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM results WHERE host = ? AND serial = ? AND ts >= ? ORDER BY ts",
+		(host, serial, since))
+	return [dict(zip(COLUMNS, row)) for row in cursor]
+
+def throughput_drops(conn, drop=0.2, days=30, workload=None, now=None):
+	'''
+	Disks whose bandwidth under a workload fell by at least `drop` (a fraction) over
+	the last `days` days, comparing the first and last measurement of that workload
+	in the window; each workload is compared only with itself, as a slower workload
+	run later isn't a drop.  Only `workload` is looked at, if given
+	Returns a list of (host, serial, model, workload, first bandwidth, last bandwidth)
+	'''
+	if now is None:
+		now = time.time()
+	since = now - days * DAY
+
+	query = f"""
+		SELECT host, serial, model, workload, first, last FROM (
+			SELECT m.host, m.serial, d.model, m.workload,
+				(SELECT bandwidth FROM results r WHERE r.host = m.host AND r.serial = m.serial AND r.workload = m.workload
+					AND r.ts >= :since AND r.bandwidth IS NOT NULL ORDER BY r.ts ASC LIMIT 1) AS first,
+				(SELECT bandwidth FROM results r WHERE r.host = m.host AND r.serial = m.serial AND r.workload = m.workload
+					AND r.ts >= :since AND r.bandwidth IS NOT NULL ORDER BY r.ts DESC LIMIT 1) AS last
+			FROM measured m JOIN disks d ON d.host = m.host AND d.serial = m.serial
+			{"" if workload is None else "WHERE m.workload = :workload"}
+		)
+		WHERE first > 0 AND last <= first * (1 - :drop)
+		ORDER BY host, serial, workload
+	"""
+	return conn.execute(query, {"since": since, "drop": drop, "workload": workload}).fetchall()
+
+def last_passed(conn, host, serial):
+	'''
+	When the disk last passed its check, or None if it never has
+	'''
+	row = conn.execute("SELECT MAX(ts) FROM results WHERE host = ? AND serial = ? AND status = 0", (host, serial)).fetchone()
+	return row[0]
+
+def model_durations(conn, workload):
+	'''
+	How long checks running `workload` took on average, per disk model, counting only
+	checks that passed (a failed check can stop early, or run to its timeout)
+	Returns {model: (mean seconds, number of checks)}
+	'''
+	cursor = conn.execute("""
+		SELECT model, AVG(duration), COUNT(*) FROM results
+		WHERE status = 0 AND workload = ? AND duration IS NOT NULL
+		GROUP BY model
+	""", (workload,))
+	return {model: (duration, count) for model, duration, count in cursor}
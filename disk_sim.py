@@ -0,0 +1,169 @@
+'''
+Virtual disks for running the whole stats check without real hardware or privileges
+
+Two kinds are available:
+- loop devices, backed by sparse files, when we're allowed to create them
+  (running as root with `losetup` available); these are real block devices and
+  show up in the real /proc and /sys
+- a simulated block layer, for everywhere else; a directory tree standing in for
+  /proc, /sys and /dev, with a regular file as each disk's device node.  Reads done
+  through the "simulated" workload are accounted in the fake /proc/diskstats and
+  /sys/block/DISK/stat, just as the kernel would for a real disk
+
+Point dist_stat_test.PROC, SYS and DEV at a SimulatedBlockLayer's `proc`, `sys` and
+`dev` and set dist_stat_test.WORKLOAD to "simulated" to check simulated disks
+'''
+import fcntl
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import disk_workloads
+
+SECTOR_SIZE = 512
+DISK_SIZE = 1024 * 1024
+
+#indexes of the counters after the device name in a /proc/diskstats row
+READS = 0
+SECTORS_READ = 2
+MS_READING = 3
+WRITES = 4
+SECTORS_WRITTEN = 6
+MS_WRITING = 7
+MS_DOING_IO = 9
+FIELDS = 17
+
+#major number for the simulated disks; 240-254 is reserved for local/experimental use
+MAJOR = 240
+
+class SimulatedBlockLayer:
+	'''
+	A fake procfs/sysfs/devtmpfs tree under `root`
+
+	Counters are kept in the fake /proc/diskstats itself, so any number of processes
+	(e.g. the workers of a sweep) can account I/O against the same layer; updates are
+	serialised with a lock file and each file is replaced atomically, so a reader never
+	sees a half written file
+	'''
+	def __init__(self, root):
+		self.root = Path(root)
+		self.proc = str(self.root / "proc")
+		self.sys = str(self.root / "sys")
+		self.dev = str(self.root / "dev")
+		self._lock = self.root / "lock"
+
+	@classmethod
+	def create(cls, root, disks, size=DISK_SIZE):
+		'''
+		Lays out a new layer under `root` with a disk of `size` bytes for each name in `disks`
+		'''
+		layer = cls(root)
+		for directory in (layer.proc, layer.dev, f"{layer.sys}/block"):
+			os.makedirs(directory, exist_ok=True)
+		layer._lock.touch()
+
+		rows = {}
+		for minor, disk in enumerate(disks):
+			with open(f"{layer.dev}/{disk}", "wb") as f:
+				f.truncate(size)
+			os.makedirs(f"{layer.sys}/block/{disk}", exist_ok=True)
+			rows[disk] = (minor, [0] * FIELDS)
+
+		with open(f"{layer.proc}/partitions", "w") as f:
+			f.write("major minor  #blocks  name\n\n")
+			for disk, (minor, _) in rows.items():
+				f.write(f"{MAJOR:4d} {minor:7d} {size // 1024:10d} {disk}\n")
+
+		layer._write(rows)
+		return layer
+
+	def _read(self):
+		rows = {}
+		with open(f"{self.proc}/diskstats") as f:
+			for line in f:
+				fields = line.split()
+				rows[fields[2]] = (int(fields[1]), [int(value) for value in fields[3:]])
+		return rows
+
+	def _write(self, rows):
+		def replace(path, text):
+			tmp = f"{path}.{os.getpid()}.tmp"
+			with open(tmp, "w") as f:
+				f.write(text)
+			os.replace(tmp, path)
+
+		lines = []
+		for disk, (minor, counters) in rows.items():
+			lines.append(f"{MAJOR:4d} {minor:7d} {disk} " + " ".join(str(value) for value in counters) + "\n")
+			replace(f"{self.sys}/block/{disk}/stat", "".join(f"{value:8d} " for value in counters).rstrip() + "\n")
+		replace(f"{self.proc}/diskstats", "".join(lines))
+
+	def counters(self, disk):
+		return self._read()[disk][1]
+
+	def account(self, disk, reads=0, sectors_read=0, writes=0, sectors_written=0, ms=0):
+		'''
+		Adds completed I/O to `disk`'s counters, as the kernel does when a request completes
+		'''
+		with open(self._lock, "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			rows = self._read()
+			counters = rows[disk][1]
+			counters[READS] += reads
+			counters[SECTORS_READ] += sectors_read
+			counters[WRITES] += writes
+			counters[SECTORS_WRITTEN] += sectors_written
+			if reads:
+				counters[MS_READING] += ms
+			if writes:
+				counters[MS_WRITING] += ms
+			counters[MS_DOING_IO] += ms
+			self._write(rows)
+
+def simulated_read(path, **options):
+	'''
+	The "simulated" workload: reads the disk's backing file sequentially, then accounts
+	the reads in the layer the file belongs to (the layer root is two levels up from
+	ROOT/dev/DISK)
+	'''
+	result = disk_workloads.sequential_read(path, **options)
+	layer = SimulatedBlockLayer(Path(path).parent.parent)
+	layer.account(Path(path).name, reads=result.ops, sectors_read=result.nbytes // SECTOR_SIZE, ms=int(result.seconds * 1000))
+	result.name = "simulated"
+	return result
+
+disk_workloads.WORKLOADS["simulated"] = simulated_read
+
+def loop_devices_permitted():
+	'''
+	Whether we can expect `losetup` to be able to attach loop devices
+	'''
+	return os.geteuid() == 0 and shutil.which("losetup") is not None and os.path.exists("/dev/loop-control")
+
+def attach_loop_devices(directory, count, size=DISK_SIZE):
+	'''
+	Creates `count` sparse files of `size` bytes in `directory` and attaches each to a
+	free loop device; returns the device names, e.g. ["loop3", "loop4"]
+	Raises OSError if a device can't be attached, after detaching any that were
+	'''
+	names = []
+	try:
+		for i in range(count):
+			backing = Path(directory) / f"loop{i}.img"
+			with open(backing, "wb") as f:
+				f.truncate(size)
+
+			cmd = ["losetup", "--find", "--show", str(backing)]
+			res = subprocess.run(cmd, capture_output=True)
+			if res.returncode != 0:
+				raise OSError(f"losetup failed: {res.stderr.decode().strip()}")
+			names.append(Path(res.stdout.decode().strip()).name)
+	except BaseException:
+		detach_loop_devices(names)
+		raise
+	return names
+
+def detach_loop_devices(names):
+	for name in names:
+		subprocess.run(["losetup", "--detach", f"/dev/{name}"], capture_output=True)
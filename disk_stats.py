@@ -0,0 +1,93 @@
+'''
+A streaming parser for /proc/diskstats that keeps only the rows it's asked for
+
+On hosts with tens of thousands of dm, loop and zram devices /proc/diskstats runs
+to tens of thousands of lines, while a check only cares about a handful of them.
+The file is read in CHUNK_SIZE pieces, each row's device name is looked at before
+anything else is decoded, and only the rows for the selected devices are kept, in
+a Snapshot: one array('Q') per counter rather than a list of int objects per row
+
+Memory use is bounded by the chunk being parsed (CHUNK_SIZE, 64 KiB) plus, for each
+row kept, FIELDS 8 byte counters, a 1 byte row width, and the device's name in a
+list and a dict; about 300 bytes a row.  A few selected devices cost next to
+nothing however long the file, and keeping every row of a 100,000 device file
+stays under 50 MB (both checked by test_disk_stats.py)
+'''
+from array import array
+
+CHUNK_SIZE = 64 * 1024
+
+#counters per row in the longest format (Linux 5.5 onwards); older kernels have 11 or 15
+FIELDS = 17
+
+class Snapshot:
+	'''
+	The counters of a set of devices from one read of /proc/diskstats, stored as a
+	struct of arrays: names[i]'s counters are counters[0][i], counters[1][i], ...
+	Behaves as a read-only dict of device name to its list of counters
+	'''
+	def __init__(self):
+		self.names = []
+		self.index = {}
+		self.widths = array("B")
+		self.counters = [array("Q") for _ in range(FIELDS)]
+
+	def add(self, name, values):
+		self.index[name] = len(self.names)
+		self.names.append(name)
+		self.widths.append(min(len(values), FIELDS))
+		for field in range(FIELDS):
+			self.counters[field].append(int(values[field]) if field < len(values) else 0)
+
+	def counter(self, name, field):
+		return self.counters[field][self.index[name]]
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def __getitem__(self, name):
+		row = self.index[name]
+		return [self.counters[field][row] for field in range(self.widths[row])]
+
+	def __len__(self):
+		return len(self.names)
+
+	def __iter__(self):
+		return iter(self.names)
+
+	def get(self, name, default=None):
+		return self[name] if name in self else default
+
+def parse(f, devices=None, chunk_size=CHUNK_SIZE):
+	'''
+	Parses /proc/diskstats from the binary file `f`, keeping the rows of `devices`
+	(any iterable of names), or every row if None; returns a Snapshot
+	'''
+	wanted = None if devices is None else {device.encode() for device in devices}
+	snapshot = Snapshot()
+	tail = b""
+
+	def parse_line(line):
+		#major, minor, name, counters...
+		fields = line.split()
+		if len(fields) > 3 and (wanted is None or fields[2] in wanted):
+			snapshot.add(fields[2].decode(), fields[3:])
+
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+		lines = (tail + chunk).split(b"\n")
+		tail = lines.pop()
+		for line in lines:
+			parse_line(line)
+	parse_line(tail)
+
+	return snapshot
+
+def read(path="/proc/diskstats", devices=None, chunk_size=CHUNK_SIZE):
+	'''
+	Reads a Snapshot of `devices` (every device if None) from `path`
+	'''
+	with open(path, "rb", buffering=0) as f:
+		return parse(f, devices, chunk_size)
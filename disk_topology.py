@@ -0,0 +1,135 @@
+'''
+Where a disk sits in the machine: which host adapter it hangs off, and which NUMA
+node (and so which CPUs) that adapter is local to
+
+All of this comes from sysfs; /sys/block/DISK/device is a symlink into the device
+tree, e.g. for a SATA disk behind an AHCI controller:
+/sys/devices/pci0000:00/0000:00:17.0/ata3/host2/target2:0:0/2:0:0:0
+and the deepest PCI function on that path (0000:00:17.0) is the adapter the
+disk's I/O goes through
+'''
+import re
+from collections import namedtuple
+from pathlib import Path
+
+PCI_ADDRESS = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$")
+
+#the SCSI peripheral device type of CD and DVD drives (sr*), in device/type
+SCSI_TYPE_ROM = "5"
+
+#adapter is a PCI address, or None if the disk isn't behind one (or sysfs doesn't say)
+#numa_node is -1 when unknown, as in sysfs; cpus is a set of CPU numbers, or None
+Topology = namedtuple("Topology", ["adapter", "numa_node", "cpus"])
+
+def parse_cpulist(text):
+	'''
+	Parses a sysfs cpulist such as "0-3,8,10-11" into a set of CPU numbers
+	'''
+	cpus = set()
+	for part in text.strip().split(","):
+		if not part:
+			continue
+		if "-" in part:
+			first, last = part.split("-")
+			cpus.update(range(int(first), int(last) + 1))
+		else:
+			cpus.add(int(part))
+	return cpus
+
+def _read(path):
+	try:
+		return Path(path).read_text().strip()
+	except OSError:
+		return None
+
+def disk_topology(disk, sys_root="/sys"):
+	'''
+	Returns the Topology of `disk`; fields that can't be determined are left unknown
+	'''
+	adapter = None
+	adapter_path = None
+	try:
+		device = Path(f"{sys_root}/block/{disk}/device").resolve(strict=True)
+	except OSError:
+		device = None
+
+	if device is not None:
+		for path in [device, *device.parents]:
+			if PCI_ADDRESS.match(path.name):
+				adapter, adapter_path = path.name, path
+				break
+
+	numa_node = -1
+	if adapter_path is not None:
+		value = _read(adapter_path / "numa_node")
+		if value is not None and value.lstrip("-").isdigit():
+			numa_node = int(value)
+
+	cpus = None
+	if numa_node >= 0:
+		value = _read(f"{sys_root}/devices/system/node/node{numa_node}/cpulist")
+		if value:
+			cpus = parse_cpulist(value)
+
+	return Topology(adapter, numa_node, cpus)
+
+class Topologies(dict):
+	'''
+	The Topology of each disk, as a dict, read from sysfs the first time a disk is
+	looked up; adapter_of() and cpus_of() are the lookups work is scheduled by
+	'''
+	def __init__(self, sys_root="/sys"):
+		super().__init__()
+		self.sys_root = sys_root
+
+	def __missing__(self, disk):
+		self[disk] = disk_topology(disk, self.sys_root)
+		return self[disk]
+
+	def adapter_of(self, disk):
+		return self[disk].adapter
+
+	def cpus_of(self, disk):
+		return self[disk].cpus
+
+def is_physical_disk(disk, sys_root="/sys"):
+	'''
+	Whether `disk` is a whole physical disk: it has a device behind it in sysfs, which
+	loop, ram, zram, dm and md devices don't, and isn't a CD or DVD drive
+	'''
+	if not Path(f"{sys_root}/block/{disk}/device").exists():
+		return False
+	return _read(f"{sys_root}/block/{disk}/device/type") != SCSI_TYPE_ROM
+
+def interleave(disks, key):
+	'''
+	Orders `disks` round-robin across the groups given by `key`, e.g. adapters, so
+	that work is started on every adapter before any one of them gets a second disk
+	'''
+	groups = {}
+	for disk in disks:
+		groups.setdefault(key(disk), []).append(disk)
+
+	ordered = []
+	queues = list(groups.values())
+	while queues:
+		for queue in queues:
+			ordered.append(queue.pop(0))
+		queues = [queue for queue in queues if queue]
+	return ordered
+
+def disk_identity(disk, sys_root="/sys"):
+	'''
+	Returns (serial, model) for `disk`, either of which may be None
+	Where sysfs keeps these varies by driver: SCSI/SATA and NVMe disks have them
+	under device/, virtio disks have a serial next to their stat file, and some
+	disks only have a wwid
+	'''
+	serial = None
+	for name in ("device/serial", "serial", "device/wwid", "wwid"):
+		serial = _read(f"{sys_root}/block/{disk}/{name}")
+		if serial:
+			break
+
+	model = _read(f"{sys_root}/block/{disk}/device/model") or None
+	return serial or None, model
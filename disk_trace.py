@@ -0,0 +1,221 @@
+'''
+Per-request latency of a disk, from the kernel's block_rq_issue and
+block_rq_complete tracepoints
+
+A private tracefs instance is created for each trace, so nothing else using ftrace
+is disturbed, with both events enabled and filtered in the kernel to the one disk.
+The instance's trace_pipe is read by a thread while the disk is being exercised;
+each completion is paired with its issue by sector, and the time between them
+added to a LatencyHistogram as it's read, so nothing is kept per request beyond
+those still in flight (at most MAX_IN_FLIGHT)
+
+Needs tracefs mounted (at /sys/kernel/tracing, or under debugfs) and root; when
+that isn't so start() raises TraceError, and the check goes on without latencies
+'''
+import math
+import os
+import re
+import select
+import threading
+
+TRACEFS = ("/sys/kernel/tracing", "/sys/kernel/debug/tracing")
+EVENTS = ("block_rq_issue", "block_rq_complete")
+
+#e.g. "hdparm-1234 [002] d..1. 1234.567890: block_rq_issue: 8,0 R 4096 () 12345 + 8 none,0,0 [hdparm]"
+#  or "<idle>-0 [002] ..s1. 1234.568000: block_rq_complete: 8,0 R () 12345 + 8 none,0,0 [0]"
+EVENT = re.compile(rb" (\d+\.\d+): block_rq_(issue|complete): (\d+),(\d+) \S+ (?:\d+ )?\(.*?\) (\d+) \+ (\d+)")
+
+#requests awaiting completion; past this, the oldest are forgotten (their completions lost)
+MAX_IN_FLIGHT = 65536
+
+#buckets per doubling of latency; each bucket is 2 ** (1 / 8), about 9%, wide
+BUCKETS_PER_DOUBLING = 8
+
+class TraceError(Exception):
+	pass
+
+class LatencyHistogram:
+	'''
+	A log-bucketed histogram of latencies in seconds, of fixed size however many
+	are added; percentiles are accurate to the width of a bucket, max exactly
+	'''
+	#latencies below a microsecond all go in the first bucket
+	RESOLUTION = 1e-6
+
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.max = 0.0
+
+	def add(self, seconds):
+		bucket = max(0, math.floor(math.log2(max(seconds, self.RESOLUTION) / self.RESOLUTION) * BUCKETS_PER_DOUBLING))
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+		self.count += 1
+		self.max = max(self.max, seconds)
+
+	def percentile(self, percent):
+		'''
+		The latency `percent`% of requests completed within, as the upper bound of
+		its bucket (but no more than the largest latency seen); None if empty
+		'''
+		if not self.count:
+			return None
+		rank = max(1, math.ceil(self.count * percent / 100))
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				return min(self.max, self.RESOLUTION * 2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING))
+
+	def summary(self):
+		return {"requests": self.count, "p50": self.percentile(50), "p99": self.percentile(99), "max": self.max if self.count else None}
+
+	def __str__(self):
+		if not self.count:
+			return "latency: no requests traced"
+		return f"latency: p50 {self.percentile(50) * 1000:.3f}ms, p99 {self.percentile(99) * 1000:.3f}ms, max {self.max * 1000:.3f}ms over {self.count} requests"
+
+class LatencyParser:
+	'''
+	Pairs issue and completion events for one device, in trace_pipe's text format,
+	adding each request's latency to `histogram` as it completes
+	'''
+	def __init__(self, major, minor, histogram=None):
+		self.device = (major, minor)
+		self.histogram = LatencyHistogram() if histogram is None else histogram
+		self.in_flight = {}
+		self.tail = b""
+
+	def feed(self, data):
+		lines = (self.tail + data).split(b"\n")
+		self.tail = lines.pop()
+		for line in lines:
+			self.line(line)
+
+	def line(self, line):
+		match = EVENT.search(line)
+		if match is None:
+			return
+		timestamp, event, major, minor, sector, count = match.groups()
+		if (int(major), int(minor)) != self.device:
+			return
+
+		key = (int(sector), int(count))
+		if event == b"issue":
+			if len(self.in_flight) >= MAX_IN_FLIGHT:
+				#dicts keep insertion order; the first is the longest outstanding
+				del self.in_flight[next(iter(self.in_flight))]
+			self.in_flight[key] = float(timestamp)
+		else:
+			issued = self.in_flight.pop(key, None)
+			if issued is not None:
+				self.histogram.add(float(timestamp) - issued)
+
+def tracefs():
+	'''
+	Where tracefs is mounted, if it can be used; raises TraceError if not
+	'''
+	for path in TRACEFS:
+		if os.path.isdir(f"{path}/instances"):
+			if not os.access(f"{path}/instances", os.W_OK):
+				raise TraceError(f"{path} is not writable; root is needed")
+			if not all(os.path.isdir(f"{path}/events/block/{event}") for event in EVENTS):
+				raise TraceError(f"{path} has no block_rq tracepoints")
+			return path
+	raise TraceError("tracefs is not mounted")
+
+def device_number(disk, sys_root="/sys"):
+	'''
+	(major, minor) of `disk`, from sysfs
+	'''
+	try:
+		with open(f"{sys_root}/block/{disk}/dev") as f:
+			major, minor = f.read().strip().split(":")
+	except (OSError, ValueError) as e:
+		raise TraceError(f"No device number for {disk}: {e}")
+	return int(major), int(minor)
+
+def _write(path, value):
+	with open(path, "w") as f:
+		f.write(value)
+
+class Trace:
+	'''
+	A running trace of one disk's requests; stop() it to get its LatencyHistogram
+	'''
+	def __init__(self, disk, sys_root="/sys", root=None):
+		self.major, self.minor = device_number(disk, sys_root)
+		root = tracefs() if root is None else root
+
+		self.instance = f"{root}/instances/dist_stat_test-{os.getpid()}-{disk}"
+		self.parser = LatencyParser(self.major, self.minor)
+		self.done = threading.Event()
+		self.pipe = None
+		try:
+			os.mkdir(self.instance)
+			#the kernel's dev_t, as the tracepoints see it
+			dev = (self.major << 20) | self.minor
+			for event in EVENTS:
+				_write(f"{self.instance}/events/block/{event}/filter", f"dev == {dev}")
+				_write(f"{self.instance}/events/block/{event}/enable", "1")
+			self.pipe = os.open(f"{self.instance}/trace_pipe", os.O_RDONLY | os.O_NONBLOCK)
+		except OSError as e:
+			self._remove()
+			raise TraceError(f"Could not set up tracing in {root}: {e}")
+
+		self.reader = threading.Thread(target=self._read, daemon=True)
+		self.reader.start()
+
+	def _drain(self):
+		while True:
+			try:
+				data = os.read(self.pipe, 65536)
+			except BlockingIOError:
+				return
+			if not data:
+				return
+			self.parser.feed(data)
+
+	def _read(self):
+		while not self.done.is_set():
+			readable, _, _ = select.select([self.pipe], [], [], 0.1)
+			if readable:
+				self._drain()
+
+	def _remove(self):
+		if self.pipe is not None:
+			os.close(self.pipe)
+			self.pipe = None
+		if os.path.isdir(self.instance):
+			for event in EVENTS:
+				try:
+					_write(f"{self.instance}/events/block/{event}/enable", "0")
+				except OSError:
+					pass
+			try:
+				os.rmdir(self.instance)
+			except OSError:
+				pass
+
+	def stop(self):
+		'''
+		Stops tracing, and returns the histogram of the requests that completed
+		'''
+		self.done.set()
+		self.reader.join()
+		try:
+			for event in EVENTS:
+				_write(f"{self.instance}/events/block/{event}/enable", "0")
+			self._drain()
+		except OSError:
+			pass
+		finally:
+			self._remove()
+		self.parser.feed(b"\n")
+		return self.parser.histogram
+
+def start(disk, sys_root="/sys", root=None):
+	'''
+	Starts tracing the requests to `disk`; raises TraceError if that isn't possible
+	'''
+	return Trace(disk, sys_root, root)
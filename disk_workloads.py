@@ -0,0 +1,264 @@
+'''
+Activity workloads used to generate I/O against a disk while its stats are watched
+
+Each workload takes the path of the device (or file) to exercise, does its I/O,
+and returns a WorkloadResult with the IOPS and bandwidth it achieved, so a stats
+check doubles as a quick performance acceptance test
+
+The page cache is dropped for the target before reading, otherwise reads could
+be served from memory and never show up in the disk's stats
+'''
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 4096
+SEQUENTIAL_BLOCK_SIZE = 1024 * 1024
+
+#defaults; kept small so a check stays a few seconds long, like `hdparm -t`
+SEQUENTIAL_BYTES = 256 * 1024 * 1024
+RANDOM_COUNT = 4096
+QUEUE_DEPTH = 8
+SCRATCH_BYTES = 16 * 1024 * 1024
+
+#the trickle used in gentle mode; GENTLE_COUNT 4K reads at GENTLE_RATE a second
+GENTLE_RATE = 32
+GENTLE_COUNT = 16
+
+class WorkloadError(Exception): pass
+
+class WorkloadResult:
+	'''
+	What a workload did and how long it took
+	'''
+	def __init__(self, name, ops, nbytes, seconds):
+		self.name = name
+		self.ops = ops
+		self.nbytes = nbytes
+		self.seconds = seconds
+
+	@property
+	def iops(self):
+		return self.ops / self.seconds if self.seconds > 0 else 0.0
+
+	@property
+	def bandwidth(self):
+		'''
+		bytes per second
+		'''
+		return self.nbytes / self.seconds if self.seconds > 0 else 0.0
+
+	def __str__(self):
+		return f"{self.name}: {self.iops:.0f} IOPS, {self.bandwidth / 1e6:.1f} MB/s"
+
+def _drop_cache(fd):
+	try:
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+	except OSError:
+		pass
+
+def _size(fd):
+	return os.lseek(fd, 0, os.SEEK_END)
+
+def sequential_read(path, nbytes=SEQUENTIAL_BYTES, block_size=SEQUENTIAL_BLOCK_SIZE, **options):
+	'''
+	Reads the first `nbytes` of `path` front to back, like `hdparm -t`
+	'''
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		_drop_cache(fd)
+		nbytes = min(nbytes, _size(fd))
+
+		ops = 0
+		done = 0
+		start = time.monotonic()
+		while done < nbytes:
+			data = os.pread(fd, min(block_size, nbytes - done), done)
+			if not data:
+				break
+			done += len(data)
+			ops += 1
+		seconds = time.monotonic() - start
+	finally:
+		os.close(fd)
+
+	return WorkloadResult("sequential", ops, done, seconds)
+
+def random_read(path, count=RANDOM_COUNT, queue_depth=QUEUE_DEPTH, block_size=BLOCK_SIZE, **options):
+	'''
+	Issues `count` reads of `block_size` bytes at random aligned offsets, keeping
+	`queue_depth` of them in flight at once
+
+	Queue depth comes from a thread pool; os.pread releases the GIL, so each thread
+	keeps one request outstanding
+	'''
+	queue_depth = max(1, queue_depth)
+
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		_drop_cache(fd)
+		blocks = _size(fd) // block_size
+		if blocks == 0:
+			raise WorkloadError(f"{path} is smaller than a single {block_size} byte block")
+
+		offsets = [random.randrange(blocks) * block_size for _ in range(count)]
+		#one slice of offsets per thread, so each thread is a single queue slot
+		slices = [offsets[i::queue_depth] for i in range(queue_depth)]
+
+		def read_slice(slice_offsets):
+			nbytes = 0
+			for offset in slice_offsets:
+				nbytes += len(os.pread(fd, block_size, offset))
+			return nbytes
+
+		start = time.monotonic()
+		with ThreadPoolExecutor(max_workers=queue_depth) as executor:
+			nbytes = sum(executor.map(read_slice, slices))
+		seconds = time.monotonic() - start
+	finally:
+		os.close(fd)
+
+	return WorkloadResult("random4k", count, nbytes, seconds)
+
+def write_verify(path, scratch=None, scratch_offset=None, nbytes=SCRATCH_BYTES, block_size=SEQUENTIAL_BLOCK_SIZE, **options):
+	'''
+	Writes a pattern to a scratch region, flushes it, then reads it back and compares
+
+	This destroys whatever was in the scratch region, so it only runs against a region
+	that has been designated explicitly: either `scratch`, a file or loop device kept on
+	the disk under test for the purpose, or `scratch_offset`, a byte offset into `path`
+	itself from which `nbytes` may be overwritten
+	'''
+	if scratch is not None:
+		target, offset = scratch, scratch_offset or 0
+	elif scratch_offset is not None:
+		target, offset = path, scratch_offset
+	else:
+		raise WorkloadError("write-verify needs a designated scratch file or scratch offset")
+
+	if offset % BLOCK_SIZE:
+		raise WorkloadError(f"scratch offset {offset} is not {BLOCK_SIZE} byte aligned")
+
+	pattern = random.Random(offset).randbytes(block_size)
+
+	fd = os.open(target, os.O_RDWR)
+	try:
+		ops = 0
+		start = time.monotonic()
+
+		done = 0
+		while done < nbytes:
+			length = min(block_size, nbytes - done)
+			os.pwrite(fd, pattern[:length], offset + done)
+			done += length
+			ops += 1
+		os.fsync(fd)
+		_drop_cache(fd)
+
+		done = 0
+		while done < nbytes:
+			length = min(block_size, nbytes - done)
+			data = os.pread(fd, length, offset + done)
+			if data != pattern[:length]:
+				raise WorkloadError(f"verify failed on {target} at offset {offset + done}")
+			done += length
+			ops += 1
+
+		seconds = time.monotonic() - start
+	finally:
+		os.close(fd)
+
+	return WorkloadResult("write-verify", ops, 2 * nbytes, seconds)
+
+class TokenBucket:
+	'''
+	A token bucket; `rate` tokens are added a second, up to at most `burst`
+	take() blocks until the tokens it asks for are available
+
+	`clock` and `sleep` can be replaced, e.g. with a virtual clock in tests
+	'''
+	def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+		if rate <= 0:
+			raise WorkloadError(f"token rate must be positive, not {rate}")
+		self.rate = rate
+		self.burst = burst
+		self.clock = clock
+		self.sleep = sleep
+		self.tokens = burst
+		self.last = clock()
+
+	def take(self, tokens=1):
+		while True:
+			now = self.clock()
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+
+			#allow for rounding, or a sleep of a few ulps could be lost against a large clock value
+			if self.tokens >= tokens - 1e-9:
+				self.tokens = max(0, self.tokens - tokens)
+				return
+			self.sleep((tokens - self.tokens) / self.rate)
+
+def trickle_read(path, rate=GENTLE_RATE, count=GENTLE_COUNT, block_size=BLOCK_SIZE, bucket=None, **options):
+	'''
+	Issues `count` single block reads at random offsets, no more than `rate` a second
+	Meant for disks serving other work; only the pages about to be read are dropped
+	from the page cache, rather than the whole device's
+	'''
+	if bucket is None:
+		bucket = TokenBucket(rate)
+
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		blocks = _size(fd) // block_size
+		if blocks == 0:
+			raise WorkloadError(f"{path} is smaller than a single {block_size} byte block")
+
+		nbytes = 0
+		start = time.monotonic()
+		for _ in range(count):
+			bucket.take()
+			offset = random.randrange(blocks) * block_size
+			try:
+				os.posix_fadvise(fd, offset, block_size, os.POSIX_FADV_DONTNEED)
+			except OSError:
+				pass
+			nbytes += len(os.pread(fd, block_size, offset))
+		seconds = time.monotonic() - start
+	finally:
+		os.close(fd)
+
+	return WorkloadResult("trickle", count, nbytes, seconds)
+
+#e.g. " Timing buffered disk reads: 1024 MB in  3.00 seconds = 341.33 MB/sec"
+HDPARM_TIMING = re.compile(r"Timing buffered disk reads:\s*([\d.]+)\s*MB in\s*([\d.]+)\s*seconds")
+#hdparm -t reads in 2MiB chunks, and its MB are MiB
+HDPARM_CHUNK = 2 * 1024 * 1024
+
+def parse_hdparm(output):
+	'''
+	Returns a WorkloadResult for what `hdparm -t` reported, or None if it didn't report a timing
+	'''
+	match = HDPARM_TIMING.search(output)
+	if match is None:
+		return None
+	nbytes = int(float(match.group(1)) * 1024 * 1024)
+	return WorkloadResult("hdparm", max(1, nbytes // HDPARM_CHUNK), nbytes, float(match.group(2)))
+
+#the workloads selectable by name; other modules may register their own here
+WORKLOADS = {
+	"sequential": sequential_read,
+	"random4k": random_read,
+	"write-verify": write_verify,
+	"trickle": trickle_read,
+}
+
+def run_workload(name, path, **options):
+	'''
+	Runs the workload registered as `name` against `path`
+	'''
+	if name not in WORKLOADS:
+		raise WorkloadError(f"unknown workload {name}")
+	return WORKLOADS[name](path, **options)
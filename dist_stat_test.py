@@ -3,14 +3,91 @@ Simple script to gather some data about a disk to verify it's seen by the OS
 and is properly represented.  Defaults to sda if not passed a disk at run time
 '''
 import argparse
+import concurrent.futures
 import sys
 import subprocess
 from pathlib import Path
 import time
+import os
+import fnmatch
+import select
+import socket
+
+import disk_collector
+import disk_health
+import disk_hotplug
+import disk_pipeline
+import disk_pool
+import disk_results_db
+import disk_stats
+import disk_topology
+import disk_trace
+import disk_workloads
 
 DISK = "sda"
 STATUS = 0
 
+#where to find procfs, sysfs and device nodes; changed to run against simulated disks, see disk_sim.py
+PROC = "/proc"
+SYS = "/sys"
+DEV = "/dev"
+
+#seconds to wait after generating activity for the stats files to catch up
+SETTLE = 5
+
+#how long a single disk's check may take in a sweep before its worker is abandoned
+TIMEOUT = 60
+#how many disks are checked at once in a sweep
+JOBS = os.cpu_count() or 1
+#how many disks behind any one host adapter are checked at once in a sweep
+PER_ADAPTER = 8
+#check the disks of a sweep together in one process, rather than each in a worker of its own
+BATCH = False
+
+#the activity to generate; `hdparm -t` by default, otherwise one of disk_workloads.WORKLOADS
+WORKLOAD = "hdparm"
+#extra keyword arguments for the workload, e.g. queue_depth or scratch; {disk} in a
+#scratch path is replaced by the name of the disk being checked, see workload_options()
+WORKLOAD_OPTIONS = {}
+#what the last workload achieved, if it reports it
+WORKLOAD_RESULT = None
+
+#gentle mode, for disks serving production traffic: pass without any I/O if the stats
+#move by themselves within OBSERVE seconds, otherwise generate only a trickle of reads
+GENTLE = False
+OBSERVE = 1
+#reads a second for the trickle
+GENTLE_RATE = disk_workloads.GENTLE_RATE
+
+#also check each partition of the disk, and that their counters add up to the disk's
+PARTITIONS = False
+#the /proc/diskstats counters (indexes after the device name) whose partition totals
+#can't exceed the disk's: reads completed, sectors read, writes completed, sectors written
+SUMMED_FIELDS = {0: "reads completed", 2: "sectors read", 4: "writes completed", 6: "sectors written"}
+
+#SQLite database to keep every result in (see disk_results_db.py); None to keep nothing
+RESULTS_DB = None
+
+#also trace each request of the activity, reporting their latencies (see disk_trace.py)
+LATENCY = False
+#the latencies traced during the last activity, a disk_trace.LatencyHistogram
+LATENCY_RESULT = None
+
+#also collect each disk's SMART / NVMe health (see disk_health.py), reusing what was
+#collected within HEALTH_TTL seconds
+HEALTH = False
+HEALTH_TTL = disk_health.TTL
+
+#skip disks that passed within this many seconds, by RESULTS_DB; None to check every disk
+SKIP_PASSED = None
+#the /proc/diskstats counter (index after the device name) of I/Os currently in flight
+IN_FLIGHT = 8
+#seconds of activity --plan assumes for a disk model no earlier timings have been recorded for
+PLAN_ACTIVITY = 5
+
+#HOST:PORT of a disk_collector to send every result to; None to send nothing
+REPORT = None
+
 def check_return_code(return_code, message, *args):
 	if return_code != 0:
 		print(f"ERROR: retval {return_code} : {message}", file=sys.stderr)
@@ -22,47 +99,178 @@ def check_return_code(return_code, message, *args):
 		for item in args:
 			print(f'output: {item}')
 			
-def main():
-	nvdimm="pmem"
-	if nvdimm in DISK:
-		print(f"Disk {DISK} appears to be an NVDIMM, skipping")
-		sys.exit(STATUS)
-		
-	#Check /proc/partitions, exit with fail if disk isn't found
-	cmd = ["grep", "-w", "-q", DISK, "/proc/partitions"]
-	res = subprocess.run(cmd, capture_output=True)
-	
-	check_return_code(res.returncode, f"Disk {DISK} not found in /proc/partitions")
-	
-	#Next, check /proc/diskstats
-	cmd = ["grep", "-w", "-q", "-m", "1", DISK, "/proc/diskstats"]
-	res = subprocess.run(cmd, capture_output=True)
-	
-	check_return_code(res.returncode, f"Disk {DISK} not found in /proc/diskstats")
+def read_sys_stats(disks):
+	'''
+	Returns the contents of /sys/block/DISK/stat for each of `disks`
+	'''
+	stats = {}
+	for disk in disks:
+		cmd = ["cat", f"{SYS}/block/{disk}/stat"]
+		res = subprocess.run(cmd, capture_output=True)
+		stats[disk] = res.stdout.decode()
+	return stats
 	
+def read_diskstats(devices=None):
+	'''
+	Reads /proc/diskstats once, keeping only the rows of `devices` (all if None); returns
+	a disk_stats.Snapshot, which acts as a dict of device name to its list of counters
+	'''
+	return disk_stats.read(f"{PROC}/diskstats", devices)
+
+def partitions_of(disk):
+	'''
+	The partitions of `disk` that sysfs knows about; each has a directory under
+	/sys/block/DISK holding a `partition` file
+	'''
+	try:
+		entries = os.scandir(f"{SYS}/block/{disk}")
+	except OSError:
+		return []
+	with entries:
+		return sorted(entry.name for entry in entries if os.path.exists(f"{entry.path}/partition"))
+
+def read_partition_stats(disk, partitions):
+	'''
+	The counters in /sys/block/DISK/PARTITION/stat for each of `partitions`, or None
+	for those whose stat is missing, empty or unreadable
+	'''
+	stats = {}
+	for partition in partitions:
+		try:
+			stats[partition] = [int(field) for field in Path(f"{SYS}/block/{disk}/{partition}/stat").read_text().split()] or None
+		except (OSError, ValueError):
+			stats[partition] = None
+	return stats
+
+def stat_agrees(before, row, after):
+	'''
+	Whether a /proc/diskstats row agrees with the sysfs stat of the same device read
+	just before and just after it; the counters only go up, so each has to be
+	between the two (the I/Os in flight, which go down too, aren't compared)
+	'''
+	fields = min(len(before), len(row), len(after))
+	return all(before[index] <= row[index] <= after[index] for index in range(fields) if index != IN_FLIGHT)
+
+def inconsistent_fields(disk, partitions, stats):
+	'''
+	Returns the SUMMED_FIELDS for which the partitions' counters add up to more than the disk's
+	'''
+	bad = []
+	for index, name in SUMMED_FIELDS.items():
+		total = sum(stats[partition][index] for partition in partitions)
+		if total > stats[disk][index]:
+			bad.append((name, total, stats[disk][index]))
+	return bad
+
+'''
+The checks, as stages of a disk_pipeline.Pipeline; each is run once for all the
+disks being checked, in the order they're added to PIPELINE below, which is the
+order the original script ran them in
+'''
+def check_nvdimm(run, disks):
+	for disk in disks:
+		if "pmem" in disk:
+			print(f"Disk {disk} appears to be an NVDIMM, skipping")
+			run.stop(disk)
+
+def check_proc_partitions(run, disks):
+	#Check /proc/partitions, fail if the disk isn't found
+	for disk in disks:
+		cmd = ["grep", "-w", "-q", disk, f"{PROC}/partitions"]
+		res = subprocess.run(cmd, capture_output=True)
+		
+		run.check(disk, res.returncode, f"Disk {disk} not found in {PROC}/partitions")
+
+def check_proc_diskstats(run, disks):
+	'''
+	Next, check /proc/diskstats; the rows read are kept as the baseline stats, so
+	the file is read once for every disk, and only once
+	'''
+	rows = read_diskstats(disks)
+	for disk in disks:
+		if disk not in rows:
+			run.check(disk, 1, f"Disk {disk} not found in {PROC}/diskstats")
+	return {disk: rows.get(disk) for disk in disks}
+
+def check_sysfs(run, disks):
 	#Verify the disk shows up in /sys/block/
-	cmd = ["ls", f'/sys/block/{DISK}']
-	res = subprocess.run(cmd, capture_output=True)
-	
-	check_return_code(res.returncode, f"Disk {DISK} not found in /sys/block")
-	
+	for disk in disks:
+		cmd = ["ls", f'{SYS}/block/{disk}']
+		res = subprocess.run(cmd, capture_output=True)
+		
+		run.check(disk, res.returncode, f"Disk {disk} not found in {SYS}/block")
+
+def check_sys_stat(run, disks):
 	#Verify there are stats in /sys/block/$DISK/stat
-	disk_stat = Path(f"/sys/block/{DISK}/stat")
-	if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
-		check_return_code(1, f"stat is either empty or nonexistant in /sys/block/{DISK}/")
-	
-	#Get some baseline stats for use later
-	cmd = ["grep", "-w", "-m", "1", f'{DISK}', "/proc/diskstats"]
-	res = subprocess.run(cmd, capture_output=True)
+	for disk in disks:
+		disk_stat = Path(f"{SYS}/block/{disk}/stat")
+		if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+			run.check(disk, 1, f"stat is either empty or nonexistant in {SYS}/block/{disk}/")
 
-	PROC_STAT_BEGIN = res.stdout.decode()
-	
-	cmd = ["cat", f"/sys/block/{DISK}/stat"]
-	res = subprocess.run(cmd, capture_output=True)
+def take_baseline(run, disks):
+	#Get some baseline stats for use later; the /proc/diskstats rows were read by check_proc_diskstats
+	sys_stats = read_sys_stats(disks)
+	return {disk: (run.result(disk, "diskstats"), sys_stats[disk]) for disk in disks}
 
-	SYS_STAT_BEGIN = res.stdout.decode()
+def counters(stats):
+	'''
+	The counters of a sysfs stat, as ints, or those of a /proc/diskstats row as
+	read by read_diskstats(); None if there aren't any to read
+	'''
+	if isinstance(stats, list):
+		return stats or None
+	fields = (stats or "").split()
+	try:
+		return [int(field) for field in fields] or None
+	except ValueError:
+		return None
+
+def io_completed(before, after):
+	'''
+	Whether I/O completed between two reads of a disk's stats: reads, writes or
+	sectors (the SUMMED_FIELDS) went up.  A disk with a request hung in flight still
+	moves its in-flight count and io_ticks, so they don't count
+	'''
+	before, after = counters(before), counters(after)
+	if before is None or after is None:
+		return False
+	return any(after[index] > before[index] for index in SUMMED_FIELDS if index < min(len(before), len(after)))
+
+def observe(run, disks):
+	'''
+	In gentle mode, first see whether the disks are already busy; if a disk is
+	completing I/O on its own it's clearly live, and there's no need to add any
+	'''
+	time.sleep(OBSERVE)
+	proc_stats, sys_stats = read_diskstats(disks), read_sys_stats(disks)
 	
-	#Generate some disk activity using hdparm -t
+	results = {}
+	for disk in disks:
+		proc_stat_begin, sys_stat_begin = run.result(disk, "baseline")
+		if io_completed(proc_stat_begin, proc_stats.get(disk)) and io_completed(sys_stat_begin, sys_stats[disk]):
+			results[disk] = {"workload": disk_workloads.WorkloadResult("none", 0, 0, OBSERVE), "latency": None}
+			
+			if run.status[disk] == 0:
+				print(f"PASS: Stats for {disk} are already changing, no activity generated")
+			
+			run.stop(disk)
+	return results
+
+def workload_options(disk):
+	'''
+	WORKLOAD_OPTIONS for `disk`, with {disk} in the scratch path replaced by its name,
+	so that each disk of a sweep writes to a scratch file of its own
+	'''
+	options = dict(WORKLOAD_OPTIONS)
+	if options.get("scratch"):
+		options["scratch"] = options["scratch"].replace("{disk}", disk)
+	return options
+
+def generate_activity(run, disk):
+	'''
+	Generates some disk activity on `disk` using hdparm -t, or the chosen workload
+	from disk_workloads; returns what the workload achieved, if it says
+	'''
 	'''
 	BUG
 	in the shell script disk_stats_test.sh (https://code.launchpad.net/coding-samples) this command is used to attempt to generate disk
@@ -76,18 +284,100 @@ def main():
 	
 	The script has been changed from the source to address this eventuality
 	'''
-	cmd = ["hdparm", "-t", f'/dev/{DISK}']
-	res = subprocess.run(cmd, capture_output=True)
+	if GENTLE:
+		#only a rate limited trickle of small reads, so foreground I/O is barely disturbed
+		try:
+			return disk_workloads.trickle_read(f'{DEV}/{disk}', rate=GENTLE_RATE)
+		except (OSError, disk_workloads.WorkloadError) as e:
+			run.check(disk, 1, f"Error with trickle workload: {e}")
+			
+			#giving up, as the test is compromised
+			run.stop(disk)
+	elif WORKLOAD == "hdparm":
+		cmd = ["hdparm", "-t", f'{DEV}/{disk}']
+		try:
+			res = subprocess.run(cmd, capture_output=True)
+		except OSError as e:
+			#e.g. hdparm isn't installed
+			run.check(disk, 1, f"Error with hdparm: {e}")
+			run.stop(disk)
+			return None
+		
+		run.check(disk, res.returncode, f"Error with hdparm: {res.stderr.decode()}")
+		
+		if res.returncode != 0:
+			#giving up, as the test is compromised
+			run.stop(disk)
+			return None
+		
+		#keep the throughput hdparm measured, for the results database
+		return disk_workloads.parse_hdparm(res.stdout.decode())
+	else:
+		try:
+			result = disk_workloads.run_workload(WORKLOAD, f'{DEV}/{disk}', **workload_options(disk))
+		except (OSError, disk_workloads.WorkloadError) as e:
+			run.check(disk, 1, f"Error with {WORKLOAD} workload: {e}")
+			
+			#giving up, as the test is compromised
+			run.stop(disk)
+			return None
+		
+		print(f"Disk {disk} {result}")
+		return result
+
+def activity(run, disks):
+	'''
+	Generates activity on the disks as one wave, under the same JOBS and PER_ADAPTER
+	limits as a sweep, tracing each disk's requests for their latencies if LATENCY
+	is set; a disk whose activity raises is failed and its check stopped
+	Each disk's result also has how long its own activity took ("seconds"), and the
+	whole wave ("wave")
+	'''
+	traces = {}
+	if LATENCY:
+		for disk in disks:
+			try:
+				traces[disk] = disk_trace.start(disk, SYS)
+			except disk_trace.TraceError as e:
+				print(f"Latency tracing unavailable for {disk}: {e}")
 	
-	check_return_code(res.returncode, f"Error with hdparm: {res.stderr.decode()}")
+	adapter_of = disk_topology.Topologies(SYS).adapter_of
 	
-	if res.returncode != 0:
-		#giving up, as the test is compromised
-		sys.exit(STATUS)
+	seconds = {}
+	def timed(disk):
+		started = time.monotonic()
+		try:
+			return generate_activity(run, disk)
+		finally:
+			seconds[disk] = time.monotonic() - started
 	
-	#Sleep 5 to let the stats files catch up
-	time.sleep(5)
+	workloads = {}
+	started = time.monotonic()
+	try:
+		ordered = disk_topology.interleave(disks, adapter_of)
+		for disk, state, value in disk_pool.run_threaded(timed, ordered,
+				max_workers=JOBS, group_of=adapter_of, group_limit=PER_ADAPTER):
+			if state == "ok":
+				workloads[disk] = value
+			else:
+				run.check(disk, 1, f"Could not generate activity on {disk}: {value!r}")
+				run.stop(disk)
+	finally:
+		latencies = {disk: trace.stop() for disk, trace in traces.items()}
+	wave = time.monotonic() - started
 	
+	return {disk: {"workload": workloads.get(disk), "latency": latencies.get(disk),
+		"seconds": seconds.get(disk, 0), "wave": wave} for disk in disks}
+
+def settle(run, disks):
+	#Sleep SETTLE (5 by default) to let the stats files catch up; once, for every disk
+	time.sleep(SETTLE)
+
+def take_end(run, disks):
+	proc_stats, sys_stats = read_diskstats(disks), read_sys_stats(disks)
+	return {disk: (proc_stats.get(disk), sys_stats[disk]) for disk in disks}
+
+def compare(run, disks):
 	'''
 	ERROR
 	In the shell script disk_stats_test.sh (https://code.launchpad.net/coding-samples)
@@ -99,38 +389,589 @@ def main():
 	even though there is error handling as if a comparison were expected
 	This additional comparison is added here, even though it is absent in the original code
 	'''
-
 	#Make sure the stats have changed:
-	cmd = ["grep", "-w", "-m", "1", f'{DISK}', "/proc/diskstats"]
-	res = subprocess.run(cmd, capture_output=True)
+	for disk in disks:
+		PROC_STAT_BEGIN, SYS_STAT_BEGIN = run.result(disk, "baseline")
+		PROC_STAT_END, SYS_STAT_END = run.result(disk, "end")
+		
+		#a disk missing from /proc/diskstats has already been reported as such
+		if (PROC_STAT_BEGIN is not None) and (PROC_STAT_BEGIN == PROC_STAT_END):
+			run.check(disk, 1, f"Stats in {PROC}/diskstats did not change",
+				" ".join(map(str, PROC_STAT_BEGIN)), " ".join(map(str, PROC_STAT_END)))
+			
+		if (SYS_STAT_BEGIN == SYS_STAT_END):
+			run.check(disk, 1, f"Stats in {SYS}/block/{disk}/stat did not change", SYS_STAT_BEGIN, SYS_STAT_END)
 
-	PROC_STAT_END = res.stdout.decode()
+def check_partitions(run, disks):
+	'''
+	Checks every partition of the disks from a single read of /proc/diskstats; each
+	partition sysfs knows of must have a row, and a non-empty stat in sysfs that
+	agrees with it, and between them the partitions can't have done more I/O than
+	the disk as a whole
+	'''
+	partitions = {disk: partitions_of(disk) for disk in disks}
+	devices = [*disks, *[partition for disk in disks for partition in partitions[disk]]]
+	#each partition's sysfs stat is read either side of /proc/diskstats, so its row can
+	#be checked against it however busy the partition is, see stat_agrees()
+	before = {disk: read_partition_stats(disk, partitions[disk]) for disk in disks}
+	stats = read_diskstats(devices)
+	after = {disk: read_partition_stats(disk, partitions[disk]) for disk in disks}
 	
-	cmd = ["cat", f"/sys/block/{DISK}/stat"]
-	res = subprocess.run(cmd, capture_output=True)
-
-	SYS_STAT_END = res.stdout.decode()
+	suspect = []
+	for disk in disks:
+		if disk not in stats:
+			#already reported by check_proc_diskstats
+			continue
+		
+		missing = [partition for partition in partitions[disk] if partition not in stats]
+		for partition in missing:
+			run.check(disk, 1, f"Partition {partition} of {disk} not found in {PROC}/diskstats")
+		
+		partitions[disk] = [partition for partition in partitions[disk] if partition in stats]
+		for partition in partitions[disk]:
+			sys_before, sys_after = before[disk][partition], after[disk][partition]
+			if sys_before is None or sys_after is None:
+				run.check(disk, 1, f"stat is either empty or nonexistant in {SYS}/block/{disk}/{partition}/")
+			elif not stat_agrees(sys_before, stats[partition], sys_after):
+				run.check(disk, 1, f"Stats in {SYS}/block/{disk}/{partition}/stat don't match its row in {PROC}/diskstats",
+					" ".join(map(str, sys_after)), " ".join(map(str, stats[partition])))
+		
+		if inconsistent_fields(disk, partitions[disk], stats):
+			suspect.append(disk)
+	
+	if not suspect:
+		return
 	
-	if (PROC_STAT_BEGIN == PROC_STAT_END):
-		check_return_code(1, "Stats in /proc/diskstats did not change", PROC_STAT_BEGIN, PROC_STAT_END)
+	#a disk's row is printed before its partitions' rows, so I/O completing in between
+	#can make the partitions look ahead for a moment; only a second look settles it
+	stats = read_diskstats(devices)
+	for disk in suspect:
+		present = [partition for partition in partitions[disk] if partition in stats]
+		for name, total, disk_total in inconsistent_fields(disk, present, stats):
+			run.check(disk, 1, f"Partitions of {disk} have {total} {name} between them, more than the disk's {disk_total}")
+
+#the check, as a pipeline; further stages can be added with PIPELINE.add()
+PIPELINE = disk_pipeline.Pipeline([
+	disk_pipeline.Stage("nvdimm", check_nvdimm),
+	disk_pipeline.Stage("partitions", check_proc_partitions, needs=["nvdimm"]),
+	disk_pipeline.Stage("diskstats", check_proc_diskstats, needs=["nvdimm"]),
+	disk_pipeline.Stage("sysfs", check_sysfs, needs=["nvdimm"]),
+	disk_pipeline.Stage("stat", check_sys_stat, needs=["nvdimm"]),
+	disk_pipeline.Stage("baseline", take_baseline, needs=["diskstats", "stat"]),
+	disk_pipeline.Stage("observe", observe, needs=["baseline"], enabled=lambda: GENTLE),
+	disk_pipeline.Stage("activity", activity, needs=["baseline", "observe"]),
+	disk_pipeline.Stage("settle", settle, needs=["activity"]),
+	disk_pipeline.Stage("end", take_end, needs=["settle"]),
+	disk_pipeline.Stage("compare", compare, needs=["baseline", "end"]),
+	disk_pipeline.Stage("partition_stats", check_partitions, needs=["end"], enabled=lambda: PARTITIONS),
+], report=check_return_code)
+
+def activity_result(run, disk):
+	'''
+	What the activity on `disk` achieved, and its latencies: {"workload", "latency"}
+	'''
+	return run.result(disk, "activity") or run.result(disk, "observe") or {"workload": None, "latency": None}
+
+def finish(run):
+	'''
+	Reports the outcome of each disk whose check ran through to the end
+	'''
+	for disk in run.active():
+		if run.status[disk] == 0:
+			print(f"PASS: Finished testing stats for {disk}")
 		
-	if (SYS_STAT_BEGIN == SYS_STAT_END):
-		check_return_code(1, f"Stats in /sys/block/{DISK}/stat did not change", SYS_STAT_BEGIN, SYS_STAT_END)
+		latency = activity_result(run, disk)["latency"]
+		if latency is not None:
+			print(f"Disk {disk} {latency}")
 	
-	if STATUS == 0:
-		print(f"PASS: Finished testing stats for {DISK}")
+def main():
+	'''
+	Checks DISK by running PIPELINE over it
+	'''
+	run = PIPELINE.run([DISK])
+	finish(run)
+	
+	global WORKLOAD_RESULT, LATENCY_RESULT
+	WORKLOAD_RESULT = activity_result(run, DISK)["workload"]
+	LATENCY_RESULT = activity_result(run, DISK)["latency"]
 	
 	sys.exit(STATUS)
+
+def new_record(disk, status):
+	'''
+	The result record for one check of `disk`; check_disk() fills in what the check measured
+	'''
+	serial, model = disk_topology.disk_identity(disk, SYS)
+	return {
+		"disk": disk,
+		"status": status,
+		"host": socket.gethostname(),
+		"serial": serial,
+		"model": model,
+		"timestamp": time.time(),
+		"workload": WORKLOAD,
+		"iops": None,
+		"bandwidth": None,
+		"duration": None,
+		"health": None,
+		"latency": None,
+	}
+
+def start_health(executor, disk):
+	'''
+	Starts collecting `disk`'s health with `executor`, if HEALTH is set
+	'''
+	if not HEALTH:
+		return None
+	return executor.submit(disk_health.health, disk, DEV, SYS, ttl=HEALTH_TTL, run=subprocess.run)
+
+def collect_health(disk, health):
+	'''
+	Waits for the health collection started by start_health(), failing the check if
+	the drive reports failing health; returns the health summary, or None
+	'''
+	if health is None:
+		return None
+	
+	summary = None
+	try:
+		summary = health.result()
+	except disk_health.HealthError as e:
+		print(f"Health data for {disk} unavailable: {e}")
+	
+	if summary is not None and summary["passed"] is False:
+		check_return_code(1, f"Disk {disk} reports failing health", summary)
+	return summary
+
+def result_record(disk, status, duration, activity, health):
+	'''
+	The result record for a finished check; `activity` is as from activity_result()
+	'''
+	record = new_record(disk, status)
+	record["health"] = health
+	record["duration"] = duration
+	if activity["latency"] is not None:
+		record["latency"] = activity["latency"].summary()
+	
+	workload = activity["workload"]
+	if workload is not None:
+		record["workload"] = workload.name
+		if workload.ops:
+			record["iops"] = workload.iops
+			record["bandwidth"] = workload.bandwidth
+	
+	return record
+
+def check_disk(disk):
+	'''
+	Runs main() against `disk` and returns a result record for it
+	This is the per-disk task run by sweep(), inside its own worker process
+	'''
+	global DISK
+	DISK = disk
+	
+	global STATUS
+	STATUS = 0
+	
+	started = time.monotonic()
+	
+	#health data is collected alongside the check, mostly while it waits for the stats to settle
+	with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+		health = start_health(executor, disk)
+		
+		try:
+			main()
+		except SystemExit as e:
+			STATUS = e.code
+		
+		summary = collect_health(disk, health)
+		if summary is not None and summary["passed"] is False:
+			STATUS = STATUS or 1
+	
+	activity = {"workload": WORKLOAD_RESULT, "latency": LATENCY_RESULT}
+	return result_record(disk, STATUS, time.monotonic() - started, activity, summary)
+
+def check_batch(disks):
+	'''
+	Checks all of `disks` together, in this process, with one run of PIPELINE: one
+	read of /proc/diskstats for every snapshot, activity on every disk at once and
+	a single wait for the stats to settle.  Much faster than checking disks one by
+	one, but with no worker processes a disk whose I/O hangs holds up the rest
+	Returns a result record for each disk
+	'''
+	started = time.monotonic()
+	
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(disks))) as executor:
+		health = {disk: start_health(executor, disk) for disk in disks}
+		
+		run = PIPELINE.run(disks)
+		finish(run)
+		
+		summaries = {disk: collect_health(disk, health[disk]) for disk in disks}
+	
+	#each disk took its own activity plus the waits it shared with the rest, not the
+	#whole wave of activity, which would inflate disk_results_db.model_durations()
+	elapsed = time.monotonic() - started
+	wave = max((run.result(disk, "activity") or {}).get("wave", 0) for disk in disks)
+	records = []
+	for disk in disks:
+		status = run.status[disk]
+		if summaries[disk] is not None and summaries[disk]["passed"] is False:
+			status = status or 1
+		duration = elapsed - wave + (run.result(disk, "activity") or {}).get("seconds", 0)
+		records.append(result_record(disk, status, duration, activity_result(run, disk), summaries[disk]))
+	return records
+
+def last_passed(disks):
+	'''
+	When each of `disks` last passed its check, by RESULTS_DB; {disk: timestamp or None}
+	'''
+	if RESULTS_DB is None or not os.path.exists(RESULTS_DB):
+		return dict.fromkeys(disks)
+	
+	host = socket.gethostname()
+	conn = disk_results_db.connect(RESULTS_DB)
+	try:
+		return {disk: disk_results_db.last_passed(conn, host, disk_topology.disk_identity(disk, SYS)[0] or disk) for disk in disks}
+	finally:
+		conn.close()
+
+def recently_passed(disks):
+	'''
+	Those of `disks` that passed within SKIP_PASSED seconds, and so can be skipped
+	'''
+	if SKIP_PASSED is None:
+		return set()
+	now = time.time()
+	return {disk for disk, passed in last_passed(disks).items() if passed is not None and now - passed < SKIP_PASSED}
+
+def plan(disks):
+	'''
+	Works out what sweep(disks) would do, from one look at /proc/diskstats, sysfs and
+	RESULTS_DB, without any I/O to the disks themselves
+	Returns (entries, estimated total seconds); an entry per disk, in the order the
+	sweep would start them, of {"disk", "model", "adapter", "action" ("check", "fail"
+	or "skip"), "reason" (why it's skipped or will fail, or anything to know about
+	it, or None), "workload", "estimate" (seconds), "basis" (what the estimate is
+	based on)}
+	Each disk's check is estimated from the average time earlier checks of that model
+	took with the same workload, and the total by scheduling them the way sweep() would;
+	with BATCH, as one wave of activity followed by a single wait for the stats to settle
+	'''
+	stats = read_diskstats(disks)
+	adapter_of = disk_topology.Topologies(SYS).adapter_of
+	skipped = recently_passed(disks)
+	workload = "trickle" if GENTLE else WORKLOAD
+	
+	durations = {}
+	if RESULTS_DB is not None and os.path.exists(RESULTS_DB):
+		conn = disk_results_db.connect(RESULTS_DB)
+		try:
+			durations = disk_results_db.model_durations(conn, workload)
+		finally:
+			conn.close()
+	
+	if GENTLE:
+		default = OBSERVE + disk_workloads.GENTLE_COUNT / GENTLE_RATE + SETTLE
+	else:
+		default = PLAN_ACTIVITY + SETTLE
+	
+	entries = []
+	for disk in disk_topology.interleave(disks, adapter_of):
+		_, model = disk_topology.disk_identity(disk, SYS)
+		entry = {"disk": disk, "model": model, "adapter": adapter_of(disk), "action": "check", "reason": None,
+			"workload": workload, "estimate": default, "basis": "default"}
+		entries.append(entry)
+		
+		if model is not None and model in durations:
+			entry["estimate"], count = durations[model]
+			entry["basis"] = f"{count} earlier checks of {model}"
+		entry["estimate"] = min(entry["estimate"], TIMEOUT)
+		
+		if "pmem" in disk:
+			entry.update(action="skip", reason="pmem", workload=None, estimate=0)
+		elif disk in skipped:
+			entry.update(action="skip", reason="cached", workload=None, estimate=0)
+		elif disk not in stats:
+			entry.update(action="fail", reason=f"not in {PROC}/diskstats", workload=None, estimate=0)
+		elif stats.counter(disk, IN_FLIGHT) > 0:
+			#in gentle mode a busy disk is very likely passed on its own activity
+			if GENTLE:
+				entry.update(reason="busy", workload="none", estimate=OBSERVE, basis="default")
+			else:
+				entry.update(reason="busy; consider --gentle")
+	
+	estimates = {entry["disk"]: entry["estimate"] for entry in entries}
+	checked = [entry["disk"] for entry in entries if entry["action"] == "check"]
+	if not BATCH:
+		total, _ = disk_pool.simulate(estimates, checked, max_workers=JOBS, group_of=adapter_of, group_limit=PER_ADAPTER)
+		return entries, total
+	
+	#check_batch() waits once for every disk, before and after the activity, which it
+	#runs under the same limits as a sweep
+	waits = SETTLE + (OBSERVE if GENTLE else 0)
+	activity = {disk: max(0, estimate - waits) for disk, estimate in estimates.items()}
+	total, _ = disk_pool.simulate(activity, checked, max_workers=JOBS, group_of=adapter_of, group_limit=PER_ADAPTER)
+	return entries, (total + waits if checked else 0)
+
+def print_plan(disks):
+	'''
+	Prints the plan for sweeping `disks`
+	'''
+	entries, total = plan(disks)
+	actions = [entry["action"] for entry in entries]
+	
+	print(f"Plan for {len(entries)} disks: {actions.count('check')} to check, {actions.count('fail')} will fail, {actions.count('skip')} skipped")
+	for entry in entries:
+		if entry["action"] == "check":
+			line = f"  {entry['disk']}: check with {entry['workload']}, ~{entry['estimate']:.1f}s ({entry['basis']})"
+		elif entry["action"] == "fail":
+			line = f"  {entry['disk']}: will fail"
+		else:
+			line = f"  {entry['disk']}: skip"
+		if entry["reason"]:
+			line += f" [{entry['reason']}]"
+		print(line)
+	print(f"Estimated time: {total:.1f}s, checking {JOBS} disks at once, at most {PER_ADAPTER} per adapter{', in one batch' if BATCH else ''}")
+	
+	return STATUS
+
+def sweep(disks):
+	'''
+	Checks each of `disks`, running each check in an isolated worker process
+	A disk whose check doesn't finish within TIMEOUT seconds (e.g. a read stuck in
+	D state on a failing drive) is reported as timed out and its worker abandoned,
+	so the other disks are not held up
+	Each disk's worker is pinned to the CPUs local to its host adapter's NUMA node, and
+	at most PER_ADAPTER disks behind any one adapter are checked at once; disks are
+	started round-robin across adapters, so all of them are kept busy
+	Disks that passed within SKIP_PASSED seconds are skipped
+	With BATCH set, the disks are instead checked together by check_batch()
+	Returns the overall status; the first non-zero status seen
+	'''
+	skipped = recently_passed(disks)
+	for disk in disks:
+		if disk in skipped:
+			print(f"Disk {disk} passed within the last {SKIP_PASSED}s, skipping")
+	disks = [disk for disk in disks if disk not in skipped]
+	
+	if BATCH:
+		records = [report(record["disk"], "ok", record) for record in check_batch(disks)]
+		save_results(records)
+		return STATUS
+	
+	topology = disk_topology.Topologies(SYS)
+	
+	ordered = disk_topology.interleave(disks, topology.adapter_of)
+	results = disk_pool.run_isolated(check_disk, ordered, timeout=TIMEOUT, max_workers=JOBS,
+		group_of=topology.adapter_of, group_limit=PER_ADAPTER, affinity_of=topology.cpus_of)
+	
+	records = [report(disk, state, value) for disk, state, value in results]
+	save_results(records)
+
+	return STATUS
+
+def report(disk, state, value):
+	'''
+	Reports the outcome of one disk's check, as yielded by disk_pool.run_isolated(),
+	and returns its result record
+	'''
+	if state == "ok":
+		check_return_code(value["status"], f"Disk {disk} failed its checks")
+		return value
+	
+	if state == "timeout":
+		check_return_code(1, f"Disk {disk} timed out after {TIMEOUT}s, abandoning its worker")
+	else:
+		check_return_code(1, f"Disk {disk} could not be checked: {value}")
+	
+	record = new_record(disk, 1)
+	record["duration"] = TIMEOUT if state == "timeout" else None
+	return record
+
+def save_results(records):
+	'''
+	Adds `records` to RESULTS_DB and sends them to the REPORT collector, for each
+	of those there is, in a single batch
+	'''
+	if not records:
+		return
+	
+	if RESULTS_DB is not None:
+		try:
+			conn = disk_results_db.connect(RESULTS_DB)
+			try:
+				disk_results_db.store(conn, records)
+			finally:
+				conn.close()
+		except disk_results_db.sqlite3.Error as e:
+			check_return_code(1, f"Could not save results to {RESULTS_DB}: {e}")
+	
+	if REPORT is not None:
+		try:
+			disk_collector.send_results(records, REPORT)
+		except (OSError, ValueError) as e:
+			check_return_code(1, f"Could not send results to {REPORT}: {e}")
+
+def watch(patterns=(), monitor=None):
+	'''
+	Long running mode; checks every disk present when started, then each disk as it
+	arrives, learning of arrivals and removals from a disk_hotplug monitor rather than
+	by rescanning.  A disk removed while it's being checked has its worker abandoned
+	Only disks whose names match one of the shell-style `patterns` are checked; if
+	there are none, every whole physical disk (not loop, ram, zram, dm or md devices,
+	or CD drives)
+	Checks are scheduled as in sweep(): at most JOBS at once and PER_ADAPTER behind
+	any one adapter, each pinned to the CPUs local to its adapter
+	Runs until the monitor is closed, then lets the checks already started finish,
+	and returns the overall status
+	'''
+	if monitor is None:
+		monitor = disk_hotplug.open_monitor(DEV, SYS)
+
+	def selected(disk):
+		if patterns:
+			return any(fnmatch.fnmatch(disk, pattern) for pattern in patterns)
+		return disk_topology.is_physical_disk(disk, SYS)
+
+	table = disk_hotplug.DeviceTable(disk_hotplug.scan(SYS))
+	#decided when a disk arrives, as its sysfs entry is gone by the time it's removed
+	watched = {disk for disk in table if selected(disk)}
+	topology = disk_topology.Topologies(SYS)
+	scheduler = disk_pool.Scheduler([disk for disk in table if disk in watched], JOBS, topology.adapter_of, PER_ADAPTER)
+	running = {}
+	watching = True
+
+	def stopped(fd):
+		worker = running.pop(fd)
+		scheduler.finished(worker.group)
+		return worker
+
+	try:
+		while watching or scheduler.pending or running:
+			#in the order a sweep's disks are started, see disk_pool.Scheduler
+			for disk, adapter in scheduler.start():
+				worker = disk_pool.Worker(check_disk, disk, TIMEOUT, topology.cpus_of(disk), adapter)
+				running[worker.fd] = worker
+
+			deadlines = [worker.deadline for worker in running.values()]
+			wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+			fds = list(running)
+			if watching:
+				fds.append(monitor.fileno())
+			readable, _, _ = select.select(fds, [], [], wait)
+
+			if watching and monitor.fileno() in readable:
+				events = monitor.read_events()
+				if events is None:
+					watching = False
+					events = []
+
+				#events were dropped, so catch up with what's present now, once
+				if (disk_hotplug.LOST, None) in events:
+					events.remove((disk_hotplug.LOST, None))
+					events += table.resync(disk_hotplug.scan(SYS))
+
+				for action, disk in events:
+					if not table.apply(action, disk):
+						continue
+					if action == "add":
+						if selected(disk):
+							watched.add(disk)
+							print(f"Disk {disk} added")
+							scheduler.pending.append(disk)
+						continue
+					if disk not in watched:
+						continue
+
+					print(f"Disk {disk} removed")
+					watched.discard(disk)
+					#a disk added again may be behind another adapter
+					topology.pop(disk, None)
+
+					#stop checking a disk that has gone away
+					if disk in scheduler.pending:
+						scheduler.pending.remove(disk)
+					for fd, worker in list(running.items()):
+						if worker.item == disk:
+							stopped(fd).abandon("removed")
+
+			for fd in readable:
+				if fd in running and running[fd].read():
+					worker = stopped(fd)
+					save_results([report(worker.item, *worker.result)])
+
+			now = time.monotonic()
+			for fd, worker in list(running.items()):
+				if worker.expired(now):
+					stopped(fd).abandon()
+					save_results([report(worker.item, *worker.result)])
+
+			disk_pool.reap_abandoned()
+	finally:
+		for worker in running.values():
+			worker.abandon("cancelled")
+		monitor.close()
+
+	return STATUS
 	
 if __name__ == "__main__":
 	desc = "An implementation of `disk_stats_test.sh` from https://code.launchpad.net/coding-samples"
 	parser = argparse.ArgumentParser(description=desc)
 
-	#accept a single argument, which specifies which disk to test
-	parser.add_argument('disk', type=str, nargs='?', help='The name of which disk to test; For example: `sda`')
+	#accept any number of disks to test, defaulting to DISK
+	parser.add_argument('disk', type=str, nargs='*', help='The name of which disk(s) to test; For example: `sda`')
+	parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Seconds each disk may take before it is reported as timed out; default {TIMEOUT}')
+	parser.add_argument('--jobs', type=int, default=JOBS, help=f'How many disks to check at once; default {JOBS}')
+	parser.add_argument('--watch', action='store_true', help='Keep running, checking disks as they are added; the disks given are then shell-style patterns')
+	parser.add_argument('--per-adapter', type=int, default=PER_ADAPTER, help=f'How many disks behind one host adapter to check at once; default {PER_ADAPTER}')
+	parser.add_argument('--batch', action='store_true', help='Check all the disks together in one pass: faster, but without a worker per disk a hung disk holds up the rest')
+	parser.add_argument('--workload', choices=["hdparm", *disk_workloads.WORKLOADS], default=WORKLOAD, help=f'Activity to generate on each disk; default {WORKLOAD}')
+	parser.add_argument('--queue-depth', type=int, default=disk_workloads.QUEUE_DEPTH, help='Reads kept in flight by the random4k workload')
+	parser.add_argument('--gentle', action='store_true', help='Low impact mode for busy disks; pass without I/O if the stats are already moving, otherwise only trickle reads')
+	parser.add_argument('--gentle-rate', type=float, default=GENTLE_RATE, help=f'Reads a second in gentle mode; default {GENTLE_RATE}')
+	parser.add_argument('--partitions', action='store_true', help="Also check each partition, and that their stats add up to the disk's")
+	parser.add_argument('--latency', action='store_true', help="Trace each request of the activity with the kernel's block tracepoints, and report latency percentiles")
+	parser.add_argument('--health', action='store_true', help='Also collect SMART / NVMe health data from each disk')
+	parser.add_argument('--health-ttl', type=float, default=HEALTH_TTL, help=f'Seconds collected health data is reused for; default {HEALTH_TTL}')
+	parser.add_argument('--db', type=str, help='SQLite database to record every result in, for comparing runs over time')
+	parser.add_argument('--skip-passed', type=float, metavar='SECONDS', help='Skip disks that passed within this many seconds, by --db')
+	parser.add_argument('--plan', action='store_true', help='Only print what a sweep would check and skip, and how long it should take; no I/O is done')
+	parser.add_argument('--report', type=str, metavar='HOST:PORT', help='Also send every result to the disk_collector listening at HOST:PORT')
+	parser.add_argument('--scratch', type=str, help='File or loop device on the disk under test that write-verify may overwrite; with more than one disk, {disk} in the path is replaced by each disk\'s name, e.g. /mnt/{disk}/scratch')
+	parser.add_argument('--scratch-offset', type=int, help='Byte offset into the disk (or --scratch) from which write-verify may overwrite data')
 	args = parser.parse_args()
 	
-	if not args.disk is None:
-		DISK = str(args.disk)
+	TIMEOUT = args.timeout
+	JOBS = args.jobs
+	PER_ADAPTER = args.per_adapter
+	BATCH = args.batch
+	WORKLOAD = args.workload
+	GENTLE = args.gentle
+	GENTLE_RATE = args.gentle_rate
+	PARTITIONS = args.partitions
+	LATENCY = args.latency
+	HEALTH = args.health
+	HEALTH_TTL = args.health_ttl
+	RESULTS_DB = args.db
+	SKIP_PASSED = args.skip_passed
+	REPORT = args.report
+	WORKLOAD_OPTIONS = {"queue_depth": args.queue_depth, "scratch": args.scratch, "scratch_offset": args.scratch_offset}
+	
+	#one scratch file for every disk would have them all writing to the one file, and no I/O reaching the others
+	if args.scratch and "{disk}" not in args.scratch and (args.watch or len(args.disk) > 1):
+		parser.error("--scratch is the same file for every disk; check one disk, or put {disk} in the path, e.g. /mnt/{disk}/scratch")
+	
+	if args.watch:
+		try:
+			sys.exit(watch([str(pattern) for pattern in args.disk]))
+		except KeyboardInterrupt:
+			sys.exit(STATUS)
+	
+	disks = [str(disk) for disk in args.disk] or [DISK]
+	
+	if args.plan:
+		sys.exit(print_plan(disks))
 		
-	main()
+	sys.exit(sweep(disks))
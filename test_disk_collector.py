@@ -0,0 +1,216 @@
+import pytest
+
+import disk_collector
+import disk_results_db
+
+import asyncio
+import json
+import socket
+import threading
+
+def record(n, host="host1", model="ST8000", status=0, bandwidth=200e6):
+	return {"host": host, "disk": f"sd{n}", "serial": f"S{n}", "model": model, "timestamp": 1_800_000_000.0 + n,
+		"status": status, "workload": "hdparm", "iops": None, "bandwidth": bandwidth, "duration": 8.0}
+
+def collect(test, collector=None, **options):
+	'''
+	Runs `test(collector, address)` against a collector listening on localhost
+	'''
+	async def run():
+		nonlocal collector
+		if collector is None:
+			collector = disk_collector.Collector(**options)
+		address = await collector.start()
+		try:
+			await test(collector, address)
+		finally:
+			await collector.stop()
+		return collector
+	return asyncio.run(run())
+
+class Test_disk_collector:
+	def test_parse_address(self):
+		assert disk_collector.parse_address("collector.example.com:9400") == ("collector.example.com", 9400)
+		assert disk_collector.parse_address("[::1]:9400") == ("::1", 9400)
+		with pytest.raises(ValueError):
+			disk_collector.parse_address("collector.example.com")
+			
+	def test_results_stored_and_rolled_up(self, tmp_path):
+		db = str(tmp_path / "fleet.db")
+		
+		async def test(collector, address):
+			replies = await asyncio.gather(
+				asyncio.to_thread(disk_collector.send_results, [record(1), record(2, status=1, bandwidth=None)], address),
+				asyncio.to_thread(disk_collector.send_results, [record(3, host="host2", model="MZ7LH", bandwidth=500e6)], address),
+			)
+			assert replies == [{"received": 2, "rejected": 0}, {"received": 1, "rejected": 0}]
+		
+		collector = collect(test, db=db)
+		
+		assert collector.rollups() == {
+			"hosts": {
+				"host1": {"results": 2, "failed": 1, "mean_bandwidth": 200e6},
+				"host2": {"results": 1, "failed": 0, "mean_bandwidth": 500e6},
+			},
+			"models": {
+				"ST8000": {"results": 2, "failed": 1, "mean_bandwidth": 200e6},
+				"MZ7LH": {"results": 1, "failed": 0, "mean_bandwidth": 500e6},
+			},
+		}
+		conn = disk_results_db.connect(db)
+		assert [row["status"] for row in disk_results_db.history(conn, "host1", "S2")] == [1]
+		assert conn.execute("SELECT COUNT(*) FROM results").fetchone() == (3,)
+		conn.close()
+		
+	def test_bad_records_rejected(self, tmp_path):
+		'''
+		lines that aren't records, or whose fields have the wrong types, are counted and
+		skipped; records that don't say which host they're from are put down to the
+		address they came from
+		'''
+		db = str(tmp_path / "fleet.db")
+		
+		async def test(collector, address):
+			def send():
+				with socket.create_connection(address) as sock:
+					sock.sendall(b'not json\n[1, 2]\n{"status": 0}\n{"disk": "sda", "status": 0}\n'
+						b'{"disk": "sdb", "serial": ["x"]}\n{"disk": {"name": "sdc"}}\n{"disk": "sdd", "bandwidth": "fast"}\n'
+						b'{"disk": "sde", "status": true}\n{"disk": "sdf", "status": 0, "host": null, "iops": 100}\n{"disk": "sdg"}\n'
+						+ json.dumps({"disk": "sdh", "status": 0, "model": "x" * (disk_collector.FIELD_LIMIT + 1)}).encode() + b'\n')
+					sock.shutdown(socket.SHUT_WR)
+					return json.loads(sock.makefile("rb").readline())
+			assert await asyncio.to_thread(send) == {"received": 2, "rejected": 9}
+		
+		collector = collect(test, db=db)
+		
+		assert list(collector.rollups()["hosts"]) == ["127.0.0.1"]
+		assert collector.stored == 2
+		
+	def test_unstorable_record(self, tmp_path, monkeypatch, capsys):
+		'''
+		a record the database won't take costs only itself, not the rest of its batch,
+		and the writer carries on with the records sent after it
+		'''
+		store = disk_results_db.store
+		def fussy_store(conn, records, host=None):
+			if any(record["disk"] == "sdbad" for record in records):
+				raise disk_results_db.sqlite3.IntegrityError("bad record")
+			return store(conn, records, host)
+		monkeypatch.setattr(disk_results_db, "store", fussy_store)
+		
+		async def test(collector, address):
+			records = [record(n) for n in range(50)] + [record(50) | {"disk": "sdbad"}]
+			assert await asyncio.to_thread(disk_collector.send_results, records, address) == {"received": 51, "rejected": 0}
+			await collector.queue.join()
+			assert await asyncio.to_thread(disk_collector.send_results, [record(100)], address) == {"received": 1, "rejected": 0}
+		
+		collector = collect(test, db=str(tmp_path / "fleet.db"))
+		
+		assert collector.stored == 51
+		assert "could not store 1 of" in capsys.readouterr().err
+		
+	def test_overlong_line_dropped(self):
+		'''
+		the connection is dropped, as the collector can't tell where the next record starts,
+		but what came before is kept
+		'''
+		async def test(collector, address):
+			def send():
+				with socket.create_connection(address) as sock:
+					sock.sendall(json.dumps(record(1)).encode() + b"\n" + b"x" * (disk_collector.LINE_LIMIT * 2))
+					#the collector may already have closed the connection without reading the rest
+					with pytest.raises(OSError):
+						while True:
+							sock.sendall(b"x" * disk_collector.LINE_LIMIT)
+			await asyncio.to_thread(send)
+			
+		collector = collect(test)
+		
+		assert collector.received == 1
+		
+	def test_back_pressure(self, tmp_path):
+		'''
+		while the database is stuck, a sender gets no further ahead of it than the
+		queue and the batch being written
+		'''
+		stuck = threading.Event()
+		collector = disk_collector.Collector(db=str(tmp_path / "fleet.db"), queue_size=100, batch=100)
+		store = collector._store
+		collector._store = lambda batch: stuck.wait() and store(batch)
+		
+		async def test(collector, address):
+			sending = asyncio.create_task(asyncio.to_thread(disk_collector.send_results, [record(n) for n in range(5000)], address))
+			await asyncio.sleep(0.5)
+			
+			assert collector.queue.full()
+			assert collector.received <= 100 + 100 + 1
+			assert not sending.done()
+			
+			stuck.set()
+			assert await sending == {"received": 5000, "rejected": 0}
+		
+		collect(test, collector)
+		
+		assert collector.stored == 5000
+		
+	def test_many_hosts(self, tmp_path):
+		'''
+		tens of thousands of records from many hosts at once, all written to the database
+		'''
+		hosts = 20
+		per_host = 2000
+		
+		async def test(collector, address):
+			records = {host: [record(n, host=f"host{host}") for n in range(per_host)] for host in range(hosts)}
+			replies = await asyncio.gather(*[asyncio.to_thread(disk_collector.send_results, records[host], address) for host in range(hosts)])
+			await collector.queue.join()
+			
+			assert all(reply == {"received": per_host, "rejected": 0} for reply in replies)
+		
+		collector = collect(test, db=str(tmp_path / "fleet.db"))
+		
+		assert collector.stored == hosts * per_host
+		assert len(collector.rollups()["hosts"]) == hosts
+		
+	def test_too_many_connections(self):
+		'''
+		a connection over the limit is refused, and its sender told so, while the ones
+		already open are served; once they close, new ones are served again
+		'''
+		collector = disk_collector.Collector(max_connections=2)
+		
+		async def test(collector, address):
+			held = [socket.create_connection(address) for _ in range(2)]
+			while collector.connections < 2:
+				await asyncio.sleep(0.01)
+			
+			with pytest.raises(ConnectionError, match="too many connections"):
+				await asyncio.to_thread(disk_collector.send_results, [record(0)], address)
+			
+			for sock in held:
+				sock.close()
+			while collector.connections:
+				await asyncio.sleep(0.01)
+			
+			assert await asyncio.to_thread(disk_collector.send_results, [record(1)], address) == {"received": 1, "rejected": 0}
+		
+		collect(test, collector)
+		
+		assert collector.received == 1
+		
+	def test_rollups_capped(self):
+		'''
+		past MAX_ROLLUPS hosts (or models), further ones are rolled up together under OTHER
+		'''
+		collector = disk_collector.Collector(max_rollups=3)
+		
+		async def test(collector, address):
+			records = [record(n, host=f"host{n}", model=f"model{n % 2}") for n in range(10)]
+			await asyncio.to_thread(disk_collector.send_results, records, address)
+		
+		collect(test, collector)
+		
+		rollups = collector.rollups()
+		assert list(rollups["hosts"]) == ["host0", "host1", "host2", disk_collector.OTHER]
+		assert rollups["hosts"][disk_collector.OTHER]["results"] == 7
+		assert list(rollups["models"]) == ["model0", "model1"]
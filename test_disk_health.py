@@ -0,0 +1,166 @@
+import pytest
+
+import disk_health
+
+import json
+import subprocess
+
+SMARTCTL_OK = {
+	"smartctl": {"version": [7, 2], "exit_status": 0},
+	"smart_status": {"passed": True},
+	"temperature": {"current": 34},
+	"power_on_time": {"hours": 21043},
+	"ata_smart_attributes": {"table": [
+		{"id": 5, "name": "Reallocated_Sector_Ct", "raw": {"value": 8}},
+		{"id": 197, "name": "Current_Pending_Sector", "raw": {"value": 0}},
+	]},
+}
+
+def smart_log(critical_warning=0, kelvin=310, power_on_hours=1200, media_errors=0):
+	data = bytearray(disk_health.NVME_LOG_SMART_SIZE)
+	data[0] = critical_warning
+	data[1:3] = kelvin.to_bytes(2, "little")
+	data[3] = 100
+	data[5] = 3
+	data[32:48] = (1000).to_bytes(16, "little")
+	data[128:144] = power_on_hours.to_bytes(16, "little")
+	data[160:176] = media_errors.to_bytes(16, "little")
+	return bytes(data)
+
+class FakeSmartctl:
+	def __init__(self, output=SMARTCTL_OK, returncode=0):
+		self.output = json.dumps(output)
+		self.returncode = returncode
+		self.calls = []
+		
+	def run(self, cmd, **kwargs):
+		self.calls.append(cmd)
+		return subprocess.CompletedProcess(cmd, self.returncode, self.output.encode(), b"")
+
+@pytest.fixture
+def fake_sys(tmp_path):
+	for disk in ("sda", "sdb", "nvme0n1"):
+		(tmp_path / "sys" / "block" / disk / "device").mkdir(parents=True)
+	(tmp_path / "sys" / "block" / "sda" / "device" / "serial").write_text("ZA/1234\n")
+	return str(tmp_path / "sys")
+
+class Test_disk_health:
+	def test_parse_nvme_smart_log(self):
+		summary = disk_health.parse_nvme_smart_log(smart_log())
+		
+		assert summary["passed"] is True
+		assert summary["temperature"] == 37
+		assert summary["available_spare"] == 100
+		assert summary["percentage_used"] == 3
+		assert summary["data_units_read"] == 1000
+		assert summary["power_on_hours"] == 1200
+		
+		summary = disk_health.parse_nvme_smart_log(smart_log(critical_warning=0x04, media_errors=12))
+		
+		assert summary["passed"] is False
+		assert summary["media_errors"] == 12
+		
+	def test_nvme_admin_cmd_layout(self):
+		'''
+		struct nvme_admin_cmd is 72 bytes, matching the size encoded in the ioctl number
+		'''
+		assert disk_health.NVME_ADMIN_CMD.size == 72
+		assert (disk_health.NVME_IOCTL_ADMIN_CMD >> 16) & 0x3FFF == disk_health.NVME_ADMIN_CMD.size
+		
+	def test_parse_smartctl(self):
+		summary = disk_health.parse_smartctl(json.dumps(SMARTCTL_OK))
+		
+		assert summary == {"source": "smartctl", "passed": True, "temperature": 34, "power_on_hours": 21043,
+			"reallocated_sectors": 8, "pending_sectors": 0, "percentage_used": None, "media_errors": None}
+		
+	def test_parse_smartctl_errors(self):
+		with pytest.raises(disk_health.HealthError, match="smartctl 7.0"):
+			disk_health.parse_smartctl("smartctl 6.6 2016-05-31\n")
+		with pytest.raises(disk_health.HealthError, match="SMART support is: Unavailable"):
+			disk_health.parse_smartctl(json.dumps({"smartctl": {"messages": [{"string": "SMART support is: Unavailable"}]}}))
+			
+	def test_smartctl_exit_status(self):
+		'''
+		only the low bits mean smartctl failed; a failing drive is data, not an error
+		'''
+		with pytest.raises(disk_health.HealthError):
+			disk_health.smartctl("/dev/sda", FakeSmartctl(returncode=2).run)
+		
+		failing = dict(SMARTCTL_OK, smart_status={"passed": False})
+		assert disk_health.smartctl("/dev/sda", FakeSmartctl(failing, returncode=8).run)["passed"] is False
+		
+	def test_smartctl_missing(self):
+		def run(cmd, **kwargs):
+			raise FileNotFoundError(2, "No such file or directory", "smartctl")
+		
+		with pytest.raises(disk_health.HealthError, match="Could not run smartctl"):
+			disk_health.smartctl("/dev/sda", run)
+			
+	def test_nvme_falls_back_to_smartctl(self, tmp_path, fake_sys):
+		'''
+		where the passthrough ioctl can't be used (here a regular file stands in for the drive)
+		'''
+		(tmp_path / "nvme0n1").write_bytes(b"")
+		smartctl = FakeSmartctl()
+		
+		summary = disk_health.read_health("nvme0n1", str(tmp_path), smartctl.run)
+		
+		assert summary["source"] == "smartctl"
+		assert smartctl.calls == [["smartctl", "-j", "-a", f"{tmp_path}/nvme0n1"]]
+		
+	def test_cache(self, tmp_path, fake_sys):
+		cache = str(tmp_path / "cache")
+		smartctl = FakeSmartctl()
+		now = [1000.0]
+		health = lambda disk: disk_health.health(disk, "/dev", fake_sys, cache, ttl=60, run=smartctl.run, clock=lambda: now[0])
+		
+		assert health("sda")["passed"] is True
+		assert health("sdb")["passed"] is True
+		now[0] += 59
+		assert health("sda")["passed"] is True
+		
+		assert len(smartctl.calls) == 2
+		#keyed by serial, with characters unsafe in a file name replaced
+		assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == ["ZA_1234.json", "sdb.json"]
+		
+		now[0] += 1
+		smartctl.output = json.dumps(dict(SMARTCTL_OK, smart_status={"passed": False}))
+		
+		assert health("sda")["passed"] is False
+		assert len(smartctl.calls) == 3
+		
+	def test_cache_private(self, tmp_path, fake_sys):
+		'''
+		the cache directory is created for this user only, and nothing but the
+		summaries is left in it
+		'''
+		cache = tmp_path / "cache"
+		disk_health.health("sda", "/dev", fake_sys, str(cache), run=FakeSmartctl().run)
+		
+		assert cache.stat().st_mode & 0o777 == 0o700
+		assert [path.name for path in cache.iterdir()] == ["ZA_1234.json"]
+		
+	def test_shared_cache_ignored(self, tmp_path, fake_sys):
+		'''
+		a summary planted in a cache others can write to doesn't hide a failing drive,
+		and isn't overwritten
+		'''
+		cache = tmp_path / "cache"
+		cache.mkdir()
+		cache.chmod(0o777)
+		forged = json.dumps({"time": 1000.0, "health": {"source": "smartctl", "passed": True}})
+		(cache / "ZA_1234.json").write_text(forged)
+		smartctl = FakeSmartctl(dict(SMARTCTL_OK, smart_status={"passed": False}))
+		
+		assert disk_health.health("sda", "/dev", fake_sys, str(cache), run=smartctl.run, clock=lambda: 1000.0)["passed"] is False
+		assert len(smartctl.calls) == 1
+		assert (cache / "ZA_1234.json").read_text() == forged
+		
+	def test_unreadable_not_cached(self, tmp_path, fake_sys):
+		smartctl = FakeSmartctl(returncode=2)
+		
+		for _ in range(2):
+			with pytest.raises(disk_health.HealthError):
+				disk_health.health("sda", "/dev", fake_sys, str(tmp_path / "cache"), run=smartctl.run)
+		
+		assert len(smartctl.calls) == 2
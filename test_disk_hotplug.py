@@ -0,0 +1,286 @@
+import pytest
+
+import dist_stat_test
+import disk_hotplug
+
+import errno
+import os
+import time
+
+from unittest.mock import patch
+
+'''
+NOTE
+Real hotplug events need real devices, so the watch loop is fed by PipeMonitor
+which replays (action, disk) events written to a pipe, then reports itself closed
+'''
+class PipeMonitor:
+	def __init__(self, events):
+		self.read_fd, write_fd = os.pipe()
+		os.write(write_fd, "".join(f"{action} {disk}\n" for action, disk in events).encode())
+		os.close(write_fd)
+		
+	def fileno(self):
+		return self.read_fd
+		
+	def read_events(self):
+		data = os.read(self.read_fd, 65536)
+		if not data:
+			return None
+		return [tuple(line.split()) for line in data.decode().splitlines()]
+		
+	def close(self):
+		os.close(self.read_fd)
+
+class ScriptedSocket:
+	'''
+	Stands in for a UeventMonitor's netlink socket: recv() replays `script`, uevents
+	or exceptions to raise, and after that finds nothing more to read.  Its fileno()
+	is a pipe that's always readable
+	'''
+	def __init__(self, script):
+		self.script = list(script)
+		self.read_fd, self.write_fd = os.pipe()
+		os.write(self.write_fd, b"x")
+		
+	def fileno(self):
+		return self.read_fd
+		
+	def recv(self, size):
+		if not self.script:
+			raise BlockingIOError
+		item = self.script.pop(0)
+		if isinstance(item, Exception):
+			raise item
+		return item
+		
+	def close(self):
+		os.close(self.read_fd)
+		os.close(self.write_fd)
+
+class ScriptedMonitor(disk_hotplug.UeventMonitor):
+	'''
+	A UeventMonitor reading from a ScriptedSocket, which reports itself closed once
+	the script has been read
+	'''
+	def __init__(self, script):
+		self.sock = ScriptedSocket(script)
+		
+	def read_events(self):
+		if not self.sock.script:
+			return None
+		return super().read_events()
+
+def uevent(action, disk):
+	return f"{action}@/devices/.../block/{disk}\0ACTION={action}\0SUBSYSTEM=block\0DEVNAME={disk}\0DEVTYPE=disk\0".encode()
+
+def mock_check_disk(disk):
+	if disk == "sdb":
+		time.sleep(60)
+	return {"disk": disk, "status": 0}
+
+def mock_check_timed(disk):
+	start = time.monotonic()
+	time.sleep(0.1)
+	return {"disk": disk, "status": 0, "start": start, "end": time.monotonic(), "cpus": os.sched_getaffinity(0)}
+
+def add_disk(tree, disk, device="device"):
+	'''
+	A disk in the fake sysfs, with a `device` behind it as a physical disk has
+	'''
+	(tree / "sys" / "block" / disk).mkdir(parents=True)
+	if device is not None:
+		(tree / "sys" / "block" / disk / device).mkdir()
+
+@pytest.fixture
+def fake_tree(tmp_path):
+	for disk in ("sda", "sdb"):
+		add_disk(tmp_path, disk)
+	(tmp_path / "dev").mkdir()
+	return tmp_path
+
+class Test_disk_hotplug:
+	def test_parse_uevent(self):
+		data = b"add@/devices/pci0000:00/0000:00:17.0/ata3/host2/target2:0:0/2:0:0:0/block/sdb\0ACTION=add\0DEVPATH=/devices/pci0000:00/0000:00:17.0/ata3/host2/target2:0:0/2:0:0:0/block/sdb\0SUBSYSTEM=block\0MAJOR=8\0MINOR=16\0DEVNAME=sdb\0DEVTYPE=disk\0SEQNUM=4711\0"
+		
+		event = disk_hotplug.parse_uevent(data)
+		
+		assert event["ACTION"] == "add"
+		assert event["DEVNAME"] == "sdb"
+		assert disk_hotplug.disk_event(event) == ("add", "sdb")
+		
+	def test_partitions_and_other_subsystems_ignored(self):
+		partition = b"add@/devices/.../block/sdb/sdb1\0ACTION=add\0SUBSYSTEM=block\0DEVNAME=sdb1\0DEVTYPE=partition\0"
+		usb = b"remove@/devices/.../usb1/1-1\0ACTION=remove\0SUBSYSTEM=usb\0DEVNAME=bus/usb/001/002\0DEVTYPE=usb_device\0"
+		change = b"change@/devices/.../block/sdb\0ACTION=change\0SUBSYSTEM=block\0DEVNAME=sdb\0DEVTYPE=disk\0"
+		
+		for data in (partition, usb, change):
+			assert disk_hotplug.disk_event(disk_hotplug.parse_uevent(data)) is None
+			
+	def test_udev_messages_ignored(self):
+		assert disk_hotplug.parse_uevent(b"libudev\0\xfe\xed\xca\xfe") is None
+		
+	def test_device_table(self):
+		table = disk_hotplug.DeviceTable(["sda"])
+		
+		assert table.apply("add", "sdb")
+		assert not table.apply("add", "sdb")
+		assert table.apply("remove", "sda")
+		assert not table.apply("remove", "tty1")
+		assert list(table) == ["sdb"]
+		
+	def test_inotify_monitor(self, fake_tree):
+		'''
+		a node appearing in /dev only counts as a disk if sysfs has it under block/
+		'''
+		monitor = disk_hotplug.InotifyMonitor(str(fake_tree / "dev"), str(fake_tree / "sys"))
+		try:
+			(fake_tree / "sys" / "block" / "sdc").mkdir()
+			(fake_tree / "dev" / "sdc").touch()
+			(fake_tree / "dev" / "tty9").touch()
+			(fake_tree / "dev" / "sdc").unlink()
+			
+			assert monitor.read_events() == [("add", "sdc"), ("remove", "sdc")]
+			assert monitor.read_events() == []
+		finally:
+			monitor.close()
+			
+	def test_uevent_monitor_opens(self):
+		try:
+			monitor = disk_hotplug.UeventMonitor()
+		except disk_hotplug.HotplugError as e:
+			pytest.skip(str(e))
+			
+		assert monitor.read_events() == []
+		monitor.close()
+		
+	def test_uevent_monitor_lost_events(self):
+		'''
+		an overflowing receive buffer (ENOBUFS) is reported as one LOST, however many
+		times it happens, and the events after it are still read
+		'''
+		overflow = OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS))
+		monitor = ScriptedMonitor([uevent("add", "sdc"), overflow, uevent("remove", "sdc"), overflow])
+		
+		assert monitor.read_events() == [("add", "sdc"), (disk_hotplug.LOST, None), ("remove", "sdc")]
+		monitor.close()
+		
+	def test_device_table_resync(self):
+		table = disk_hotplug.DeviceTable(["sda", "sdb"])
+		
+		assert table.resync(["sdb", "sdc"]) == [("remove", "sda"), ("add", "sdc")]
+		
+	def test_watch_resyncs_after_lost_events(self, fake_tree, monkeypatch):
+		'''
+		the uevent socket overflows while sdd arrives and sdb goes; rather than
+		stopping, watch reads the disks present again, checks sdd and stops sdb's check
+		'''
+		monkeypatch.setattr(dist_stat_test, "SYS", str(fake_tree / "sys"))
+		monkeypatch.setattr(dist_stat_test, "TIMEOUT", 30)
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		overflow = OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS))
+		monitor = ScriptedMonitor([uevent("add", "sdc"), overflow])
+		add_disk(fake_tree, "sdc")
+		add_disk(fake_tree, "sdd")
+		scans = [["sda", "sdb"], ["sda", "sdc", "sdd"]]
+		
+		start = time.monotonic()
+		with patch("dist_stat_test.disk_hotplug.scan", side_effect=scans) as mock_scan:
+			with patch("dist_stat_test.check_disk", new=mock_check_disk):
+				with patch("dist_stat_test.report") as mock_report:
+					status = dist_stat_test.watch(monitor=monitor)
+		
+		reported = sorted(call[0][0] for call in mock_report.call_args_list)
+		
+		assert status == 0
+		assert reported == ["sda", "sdc", "sdd"]
+		assert mock_scan.call_count == 2
+		assert time.monotonic() - start < 10
+		
+	def test_watch_checks_present_and_added_disks(self, fake_tree, monkeypatch):
+		'''
+		sda and sdb are present at the start, sdc is added while watching
+		sdb hangs, and is then removed; its check should be stopped rather than reported
+		'''
+		monkeypatch.setattr(dist_stat_test, "SYS", str(fake_tree / "sys"))
+		monkeypatch.setattr(dist_stat_test, "TIMEOUT", 30)
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		add_disk(fake_tree, "sdc")
+		monitor = PipeMonitor([("add", "sdc"), ("add", "sda"), ("remove", "sdb")])
+		
+		start = time.monotonic()
+		with patch("dist_stat_test.check_disk", new=mock_check_disk):
+			with patch("dist_stat_test.report") as mock_report:
+				status = dist_stat_test.watch(monitor=monitor)
+				
+		reported = sorted(call[0][0] for call in mock_report.call_args_list)
+		
+		assert status == 0
+		assert reported == ["sda", "sdc"]
+		assert time.monotonic() - start < 10
+		
+	def test_watch_patterns(self, fake_tree, monkeypatch):
+		monkeypatch.setattr(dist_stat_test, "SYS", str(fake_tree / "sys"))
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		add_disk(fake_tree, "nvme0n1")
+		monitor = PipeMonitor([("add", "nvme0n1")])
+		
+		with patch("dist_stat_test.check_disk", new=mock_check_disk):
+			with patch("dist_stat_test.report") as mock_report:
+				dist_stat_test.watch(["nvme*"], monitor=monitor)
+				
+		assert [call[0][0] for call in mock_report.call_args_list] == ["nvme0n1"]
+		
+	def test_watch_physical_disks_only(self, fake_tree, monkeypatch):
+		'''
+		with no patterns, loop, zram and dm devices are left alone, present or added
+		'''
+		monkeypatch.setattr(dist_stat_test, "SYS", str(fake_tree / "sys"))
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		(fake_tree / "sys" / "block" / "sdb" / "device").rmdir()
+		add_disk(fake_tree, "loop0", device=None)
+		add_disk(fake_tree, "zram0", device=None)
+		add_disk(fake_tree, "dm-0", device=None)
+		monitor = PipeMonitor([("add", "dm-0"), ("remove", "dm-0")])
+		
+		with patch("dist_stat_test.check_disk", new=mock_check_timed):
+			with patch("dist_stat_test.report") as mock_report:
+				dist_stat_test.watch(monitor=monitor)
+		
+		assert [call[0][0] for call in mock_report.call_args_list] == ["sda"]
+		
+	def test_watch_per_adapter(self, fake_tree, monkeypatch):
+		'''
+		disks behind one adapter are checked no more than PER_ADAPTER at a time, each
+		pinned to the CPUs local to its adapter, as in a sweep
+		'''
+		sys_root = fake_tree / "sys"
+		monkeypatch.setattr(dist_stat_test, "SYS", str(sys_root))
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		monkeypatch.setattr(dist_stat_test, "JOBS", 4)
+		monkeypatch.setattr(dist_stat_test, "PER_ADAPTER", 1)
+		
+		adapter = sys_root / "devices" / "pci0000:00" / "0000:00:17.0"
+		(adapter / "ata1").mkdir(parents=True)
+		(adapter / "ata2").mkdir()
+		(adapter / "numa_node").write_text("0\n")
+		(sys_root / "devices" / "system" / "node" / "node0").mkdir(parents=True)
+		(sys_root / "devices" / "system" / "node" / "node0" / "cpulist").write_text("0\n")
+		for disk, port in (("sda", "ata1"), ("sdb", "ata2")):
+			(sys_root / "block" / disk / "device").rmdir()
+			os.symlink(adapter / port, sys_root / "block" / disk / "device")
+		
+		with patch("dist_stat_test.check_disk", new=mock_check_timed):
+			with patch("dist_stat_test.report") as mock_report:
+				dist_stat_test.watch(monitor=PipeMonitor([]))
+		
+		results = {call[0][0]: call[0][2] for call in mock_report.call_args_list}
+		
+		assert sorted(results) == ["sda", "sdb"]
+		first, second = sorted(results.values(), key=lambda result: result["start"])
+		assert first["end"] <= second["start"]
+		assert first["cpus"] == second["cpus"] == {0}
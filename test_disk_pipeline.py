@@ -0,0 +1,115 @@
+import pytest
+
+import disk_pipeline
+
+def recording(name, calls, results=None, fail=(), stop=()):
+	'''
+	A Stage named `name` that appends (name, disks) to `calls` when run, fails the
+	disks in `fail`, stops the ones in `stop`, and returns `results` (or name for each disk)
+	'''
+	def run(pipeline_run, disks):
+		calls.append((name, list(disks)))
+		for disk in disks:
+			if disk in fail:
+				pipeline_run.check(disk, 1, f"{name} failed on {disk}")
+			if disk in stop:
+				pipeline_run.stop(disk)
+		return {disk: name for disk in disks} if results is None else results
+	return run
+
+class Test_disk_pipeline:
+	def test_order(self):
+		'''
+		stages come after the ones they need, and otherwise in the order they were added
+		'''
+		calls = []
+		pipeline = disk_pipeline.Pipeline([
+			disk_pipeline.Stage("c", recording("c", calls), needs=["b"]),
+			disk_pipeline.Stage("a", recording("a", calls)),
+			disk_pipeline.Stage("b", recording("b", calls), needs=["a"]),
+			disk_pipeline.Stage("d", recording("d", calls)),
+		])
+
+		assert [stage.name for stage in pipeline.order()] == ["a", "b", "c", "d"]
+
+		run = pipeline.run(["sda", "sdb"])
+
+		assert calls == [("a", ["sda", "sdb"]), ("b", ["sda", "sdb"]), ("c", ["sda", "sdb"]), ("d", ["sda", "sdb"])]
+		assert run.result("sdb", "c") == "c"
+		assert run.status == {"sda": 0, "sdb": 0}
+
+	def test_unknown_need(self):
+		pipeline = disk_pipeline.Pipeline([disk_pipeline.Stage("a", recording("a", []), needs=["missing"])])
+
+		with pytest.raises(disk_pipeline.PipelineError, match="missing"):
+			pipeline.run(["sda"])
+
+	def test_cycle(self):
+		pipeline = disk_pipeline.Pipeline([
+			disk_pipeline.Stage("a", recording("a", []), needs=["b"]),
+			disk_pipeline.Stage("b", recording("b", []), needs=["a"]),
+		])
+
+		with pytest.raises(disk_pipeline.PipelineError, match="a -> b -> a"):
+			pipeline.order()
+
+	def test_duplicate_name(self):
+		pipeline = disk_pipeline.Pipeline([disk_pipeline.Stage("a", recording("a", []))])
+
+		with pytest.raises(disk_pipeline.PipelineError):
+			pipeline.add(disk_pipeline.Stage("a", recording("a", [])))
+
+	def test_fail_and_stop(self):
+		'''
+		a failed disk goes on to later stages with the first failure as its status; a
+		stopped one doesn't
+		'''
+		calls = []
+		reports = []
+		pipeline = disk_pipeline.Pipeline([
+			disk_pipeline.Stage("a", recording("a", calls, fail=["sdb", "sdc"], stop=["sdc"])),
+			disk_pipeline.Stage("b", recording("b", calls, fail=["sdb"])),
+		], report=lambda return_code, message, *outputs: reports.append(message))
+
+		run = pipeline.run(["sda", "sdb", "sdc"])
+
+		assert calls == [("a", ["sda", "sdb", "sdc"]), ("b", ["sda", "sdb"])]
+		assert run.status == {"sda": 0, "sdb": 1, "sdc": 1}
+		assert run.failures == {"sda": 0, "sdb": 2, "sdc": 1}
+		assert run.result("sdc", "b") is None
+		assert reports == ["a failed on sdb", "a failed on sdc", "b failed on sdb"]
+
+	def test_stage_raises(self):
+		'''
+		a stage that raises fails and stops the disks it ran for; the run carries on
+		'''
+		calls = []
+		reports = []
+		def broken(run, disks):
+			raise OSError("no such file")
+		pipeline = disk_pipeline.Pipeline([
+			disk_pipeline.Stage("a", recording("a", calls, stop=["sdb"])),
+			disk_pipeline.Stage("broken", broken, needs=["a"]),
+			disk_pipeline.Stage("b", recording("b", calls)),
+		], report=lambda return_code, message, *outputs: reports.append(message))
+
+		run = pipeline.run(["sda", "sdb"])
+
+		assert run.status == {"sda": 1, "sdb": 0}
+		assert run.stopped == {"sda", "sdb"}
+		assert calls == [("a", ["sda", "sdb"])]
+		assert reports == ["Stage broken failed for sda: OSError('no such file')"]
+
+	def test_disabled_stage(self):
+		calls = []
+		enabled = [False]
+		pipeline = disk_pipeline.Pipeline([
+			disk_pipeline.Stage("a", recording("a", calls), enabled=lambda: enabled[0]),
+		])
+
+		pipeline.run(["sda"])
+		assert calls == []
+
+		enabled[0] = True
+		pipeline.run(["sda"])
+		assert calls == [("a", ["sda"])]
@@ -0,0 +1,188 @@
+import pytest
+
+import disk_pool
+
+import os
+import sys
+import threading
+import time
+
+'''
+NOTE
+Tasks run in forked children, so they have to be plain module level functions
+whose results can be pickled back to the parent
+'''
+def task_square(item):
+	return item * item
+
+def task_hang(item):
+	if item == "hung":
+		time.sleep(60)
+	return item
+
+def task_raise(item):
+	raise ValueError(f"bad item {item}")
+
+def task_exit(item):
+	sys.exit(item)
+
+def task_pid(item):
+	return os.getpid()
+
+def task_affinity(item):
+	return os.sched_getaffinity(0)
+
+def task_interval(item):
+	start = time.monotonic()
+	time.sleep(0.05)
+	return (start, time.monotonic())
+
+def task_rendezvous(item):
+	'''
+	Marks `item` as started in its directory, then waits for all `peers` to have
+	started too; returns whether they did, within 10s
+	'''
+	directory, name, peers = item
+	open(os.path.join(directory, name), "w").close()
+	deadline = time.monotonic() + 10
+	while time.monotonic() < deadline:
+		if len(os.listdir(directory)) == peers:
+			return True
+		time.sleep(0.01)
+	return False
+
+class Test_disk_pool:
+	def test_results_for_every_item(self):
+		results = {item: (state, value) for item, state, value in disk_pool.run_isolated(task_square, [1, 2, 3, 4], timeout=10, max_workers=2)}
+
+		assert results == {1: ("ok", 1), 2: ("ok", 4), 3: ("ok", 9), 4: ("ok", 16)}
+
+	def test_tasks_run_in_other_processes(self):
+		pids = [value for _, _, value in disk_pool.run_isolated(task_pid, [1, 2], timeout=10)]
+
+		assert os.getpid() not in pids
+
+	def test_hung_worker_is_abandoned_and_replaced(self):
+		'''
+		with a single worker slot and the first task hung, the remaining tasks still
+		have to complete; the hung one is reported as timed out
+		'''
+		start = time.monotonic()
+		results = {item: state for item, state, _ in disk_pool.run_isolated(task_hang, ["hung", "a", "b"], timeout=0.5, max_workers=1)}
+		elapsed = time.monotonic() - start
+
+		assert results == {"hung": "timeout", "a": "ok", "b": "ok"}
+		assert elapsed < 10
+
+	def test_exception_reported_as_error(self):
+		results = list(disk_pool.run_isolated(task_raise, ["x"], timeout=10))
+
+		assert len(results) == 1
+		item, state, value = results[0]
+		assert state == "error"
+		assert "bad item x" in value
+
+	def test_system_exit_is_a_result(self):
+		'''
+		main() ends with sys.exit(STATUS), so an exit code has to come back as a normal result
+		'''
+		results = {item: (state, value) for item, state, value in disk_pool.run_isolated(task_exit, [0, 3], timeout=10)}
+
+		assert results == {0: ("ok", 0), 3: ("ok", 3)}
+		
+	def test_group_limit(self, tmp_path):
+		'''
+		four tasks in one group with a limit of one never overlap, while four tasks in
+		different groups all run at once
+		'''
+		results = list(disk_pool.run_isolated(task_interval, [1, 2, 3, 4], timeout=10, max_workers=4, group_of=lambda item: "hba0", group_limit=1))
+		intervals = sorted(value for _, _, value in results)
+		
+		assert len(intervals) == 4
+		assert all(earlier[1] <= later[0] for earlier, later in zip(intervals, intervals[1:]))
+		
+		items = [(str(tmp_path), str(n), 4) for n in range(4)]
+		results = list(disk_pool.run_isolated(task_rendezvous, items, timeout=20, max_workers=4, group_of=lambda item: f"hba{item[1]}", group_limit=1))
+		
+		assert [state for _, state, _ in results] == ["ok"] * 4
+		assert all(value for _, _, value in results)
+		
+	def test_group_none_is_not_limited(self, tmp_path):
+		items = [(str(tmp_path), str(n), 4) for n in range(4)]
+		results = list(disk_pool.run_isolated(task_rendezvous, items, timeout=20, max_workers=4, group_of=lambda item: None, group_limit=1))
+		
+		assert all(value for _, _, value in results)
+		
+	def test_affinity(self):
+		results = {item: value for item, _, value in disk_pool.run_isolated(task_affinity, [1, 2], timeout=10, affinity_of=lambda item: {0})}
+		
+		assert results == {1: {0}, 2: {0}}
+		
+	def test_scheduler(self):
+		'''
+		items start in order, skipping those whose group is full, and those of group
+		None aren't limited; a finished item's slot goes to the next that fits
+		'''
+		scheduler = disk_pool.Scheduler(["a1", "a2", "b1", "x1", "x2"], max_workers=4,
+			group_of=lambda item: None if item[0] == "x" else item[0], group_limit=1)
+		
+		assert scheduler.start() == [("a1", "a"), ("b1", "b"), ("x1", None), ("x2", None)]
+		assert scheduler.start() == []
+		
+		scheduler.finished("b")
+		assert scheduler.start() == []
+		scheduler.finished("a")
+		scheduler.pending.append("b2")
+		assert scheduler.start() == [("a2", "a"), ("b2", "b")]
+		assert scheduler.pending == []
+		
+	def test_simulate(self):
+		durations = {"a": 4, "b": 1, "c": 1, "d": 2}
+		
+		assert disk_pool.simulate(durations, "abcd", max_workers=1) == (8, {"a": 0, "b": 4, "c": 5, "d": 6})
+		assert disk_pool.simulate(durations, "abcd", max_workers=2) == (4, {"a": 0, "b": 0, "c": 1, "d": 2})
+		assert disk_pool.simulate(durations, "", max_workers=2) == (0, {})
+		
+	def test_simulate_groups(self):
+		'''
+		items are started in order, skipping those whose group is full, as run_isolated() does
+		'''
+		durations = {"a1": 3, "a2": 3, "b1": 1, "b2": 1}
+		group_of = lambda item: item[0]
+		
+		total, starts = disk_pool.simulate(durations, ["a1", "a2", "b1", "b2"], max_workers=2, group_of=group_of, group_limit=1)
+		
+		assert starts == {"a1": 0, "b1": 0, "b2": 1, "a2": 3}
+		assert total == 6
+		
+	def test_run_threaded(self):
+		'''
+		no more than `group_limit` tasks of a group, or `max_workers` in all, run at once;
+		an exception is a result
+		'''
+		lock = threading.Lock()
+		running = {}
+		most = {}
+		
+		def task(item):
+			group = item[0]
+			with lock:
+				running[group] = running.get(group, 0) + 1
+				most[group] = max(most.get(group, 0), running[group])
+				most["all"] = max(most.get("all", 0), sum(running.values()))
+			time.sleep(0.01)
+			with lock:
+				running[group] -= 1
+			if item == "b3":
+				raise ValueError("bad item b3")
+			return item
+		
+		items = [f"{group}{n}" for n in range(4) for group in "abc"]
+		results = {item: (state, value) for item, state, value in disk_pool.run_threaded(task, items, max_workers=4, group_of=lambda item: item[0], group_limit=2)}
+		
+		assert set(results) == set(items)
+		assert results["a1"] == ("ok", "a1")
+		assert results["b3"][0] == "error"
+		assert isinstance(results["b3"][1], ValueError)
+		assert most["a"] <= 2 and most["b"] <= 2 and most["c"] <= 2
+		assert most["all"] <= 4
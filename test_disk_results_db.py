@@ -0,0 +1,171 @@
+import pytest
+
+import disk_results_db
+
+DAY = disk_results_db.DAY
+NOW = 1_800_000_000.0
+
+@pytest.fixture
+def conn(tmp_path):
+	conn = disk_results_db.connect(str(tmp_path / "results.db"))
+	yield conn
+	conn.close()
+
+def record(serial, days_ago, bandwidth, host="host1", workload="hdparm", status=0):
+	return {"host": host, "disk": "sda", "serial": serial, "model": "ST8000", "timestamp": NOW - days_ago * DAY,
+		"status": status, "workload": workload, "iops": None, "bandwidth": bandwidth, "duration": 8.0}
+
+def vm_steps(conn, query):
+	'''
+	How much work SQLite does for `query()`, in hundreds of virtual machine instructions
+	'''
+	steps = 0
+	def count():
+		nonlocal steps
+		steps += 1
+		return 0
+	conn.set_progress_handler(count, 100)
+	try:
+		return query(), steps
+	finally:
+		conn.set_progress_handler(None, 100)
+
+class Test_disk_results_db:
+	def test_store_and_history(self, conn):
+		disk_results_db.store(conn, [record("A", 2, 200e6), record("A", 1, 190e6), record("B", 1, 100e6)])
+		
+		history = disk_results_db.history(conn, "host1", "A")
+		
+		assert [row["bandwidth"] for row in history] == [200e6, 190e6]
+		assert history[0]["model"] == "ST8000"
+		
+	def test_store_defaults(self, conn):
+		'''
+		records without a serial are keyed by disk name, and take the host they're stored for
+		'''
+		disk_results_db.store(conn, [{"disk": "sdq", "status": 1}], host="host9")
+		
+		history = disk_results_db.history(conn, "host9", "sdq")
+		
+		assert len(history) == 1
+		assert history[0]["status"] == 1
+		assert history[0]["bandwidth"] is None
+		
+	def test_throughput_drops(self, conn):
+		disk_results_db.store(conn, [
+			#dropped 25% inside the window
+			record("A", 25, 200e6), record("A", 10, 180e6), record("A", 1, 150e6),
+			#dropped, but only compared to a result from before the window
+			record("B", 40, 200e6), record("B", 20, 150e6), record("B", 1, 149e6),
+			#steady, with an unmeasured failure at the end
+			record("C", 20, 200e6), record("C", 2, 195e6), record("C", 1, None, status=1),
+			#a single result; nothing to compare against
+			record("D", 3, 100e6),
+			#same serial on another host
+			record("A", 20, 100e6, host="host2"), record("A", 1, 50e6, host="host2"),
+		])
+		
+		drops = disk_results_db.throughput_drops(conn, drop=0.2, days=30, now=NOW)
+		
+		assert drops == [("host1", "A", "ST8000", "hdparm", 200e6, 150e6), ("host2", "A", "ST8000", "hdparm", 100e6, 50e6)]
+		
+	def test_throughput_drops_by_workload(self, conn):
+		'''
+		a slower workload measured later isn't a drop in throughput; each workload is
+		compared with itself, and can be picked out on its own
+		'''
+		disk_results_db.store(conn, [
+			record("A", 20, 200e6), record("A", 1, 20e6, workload="random4k"),
+			record("B", 20, 40e6, workload="random4k"), record("B", 10, 200e6), record("B", 1, 20e6, workload="random4k"),
+		])
+		
+		assert disk_results_db.throughput_drops(conn, now=NOW) == [("host1", "B", "ST8000", "random4k", 40e6, 20e6)]
+		assert disk_results_db.throughput_drops(conn, now=NOW, workload="hdparm") == []
+		assert len(disk_results_db.throughput_drops(conn, now=NOW, workload="random4k")) == 1
+		
+	def test_measured_backfilled(self, tmp_path):
+		'''
+		a database from before the `measured` table has it filled in from its results
+		'''
+		path = str(tmp_path / "results.db")
+		conn = disk_results_db.connect(path)
+		disk_results_db.store(conn, [record("A", 20, 200e6), record("A", 1, 150e6)])
+		conn.execute("DROP TABLE measured")
+		conn.close()
+		
+		conn = disk_results_db.connect(path)
+		drops = disk_results_db.throughput_drops(conn, now=NOW)
+		conn.close()
+		
+		assert drops == [("host1", "A", "ST8000", "hdparm", 200e6, 150e6)]
+		
+	def test_query_uses_index(self, conn):
+		plan = conn.execute("EXPLAIN QUERY PLAN SELECT bandwidth FROM results WHERE host = ? AND serial = ? AND ts >= ? ORDER BY ts LIMIT 1",
+			("host1", "A", 0)).fetchall()
+		
+		assert any("results_host_serial_ts" in row[-1] for row in plan)
+		
+	def test_throughput_drops_many_rows(self, tmp_path):
+		'''
+		100 disks on 10 hosts, with 30 and then 300 results each over 30 days; the query
+		looks up each disk through the index, so does no more work however many results
+		each disk has
+		'''
+		work = []
+		for per_disk in (30, 300):
+			conn = disk_results_db.connect(str(tmp_path / f"results{per_disk}.db"))
+			records = []
+			for n in range(per_disk):
+				for disk in range(100):
+					bandwidth = 200e6 * (0.5 if disk % 10 == 0 and n < per_disk // 30 else 1.0)
+					records.append(record(f"S{disk:04d}", n * 30 / per_disk, bandwidth, host=f"host{disk % 10}"))
+			disk_results_db.store(conn, records)
+			
+			drops, steps = vm_steps(conn, lambda: disk_results_db.throughput_drops(conn, drop=0.2, days=30, now=NOW))
+			conn.close()
+			
+			assert len(drops) == 10
+			work.append(steps)
+		
+		assert work[1] <= work[0] * 1.5
+		
+	def test_status_required(self, conn):
+		'''
+		a result that doesn't say whether the disk passed isn't stored, so can't count as a pass
+		'''
+		unknown = record("A", 1, 200e6)
+		del unknown["status"]
+		
+		with pytest.raises(ValueError):
+			disk_results_db.store(conn, [unknown])
+		assert disk_results_db.last_passed(conn, "host1", "A") is None
+		
+	def test_last_passed(self, conn):
+		disk_results_db.store(conn, [record("A", 3, 200e6), record("A", 2, 200e6), record("A", 1, None, status=1)])
+		
+		assert disk_results_db.last_passed(conn, "host1", "A") == NOW - 2 * DAY
+		assert disk_results_db.last_passed(conn, "host1", "B") is None
+		
+	def test_model_durations_uses_index(self, conn):
+		'''
+		read from the index alone, already in model order: no scan of the results, and no sort
+		'''
+		statements = []
+		conn.set_trace_callback(statements.append)
+		disk_results_db.model_durations(conn, "hdparm")
+		conn.set_trace_callback(None)
+		
+		plan = conn.execute(f"EXPLAIN QUERY PLAN {statements[-1]}").fetchall()
+		
+		assert [row[-1] for row in plan] == ["SEARCH results USING COVERING INDEX results_workload_status_model (workload=? AND status=?)"]
+		
+	def test_model_durations(self, conn):
+		'''
+		failed checks don't count; they may have stopped early or run to their timeout
+		'''
+		records = [record("A", 3, 200e6), record("B", 2, 200e6), record("C", 1, None, status=1), record("D", 1, 200e6, workload="random4k")]
+		records[1]["duration"] = 10.0
+		records[2]["duration"] = 60.0
+		disk_results_db.store(conn, records)
+		
+		assert disk_results_db.model_durations(conn, "hdparm") == {"ST8000": (9.0, 2)}
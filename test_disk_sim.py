@@ -0,0 +1,102 @@
+import pytest
+
+import dist_stat_test
+import disk_sim
+
+import time
+
+'''
+NOTE
+These tests run the whole check (partitions, diskstats, sysfs, activity, compare)
+end to end against virtual disks, so they need no real disk, hdparm or privileges
+The module globals of dist_stat_test are set with monkeypatch so they are restored
+after each test
+'''
+@pytest.fixture
+def simulated_check(tmp_path, monkeypatch):
+	def setup(disks):
+		layer = disk_sim.SimulatedBlockLayer.create(tmp_path, disks)
+		
+		monkeypatch.setattr(dist_stat_test, "PROC", layer.proc)
+		monkeypatch.setattr(dist_stat_test, "SYS", layer.sys)
+		monkeypatch.setattr(dist_stat_test, "DEV", layer.dev)
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD", "simulated")
+		monkeypatch.setattr(dist_stat_test, "SETTLE", 0)
+		monkeypatch.setattr(dist_stat_test, "JOBS", 16)
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		return layer
+	return setup
+
+class Test_disk_sim:
+	def test_account_updates_both_stats_files(self, tmp_path):
+		layer = disk_sim.SimulatedBlockLayer.create(tmp_path, ["sim0", "sim1"])
+		
+		layer.account("sim1", reads=3, sectors_read=24, ms=2)
+		
+		assert layer.counters("sim0") == [0] * disk_sim.FIELDS
+		assert layer.counters("sim1")[disk_sim.READS] == 3
+		assert layer.counters("sim1")[disk_sim.SECTORS_READ] == 24
+		
+		with open(f"{layer.sys}/block/sim1/stat") as f:
+			sys_counters = [int(value) for value in f.read().split()]
+		assert sys_counters == layer.counters("sim1")
+		
+	def test_simulated_workload(self, tmp_path):
+		layer = disk_sim.SimulatedBlockLayer.create(tmp_path, ["sim0"], size=64 * 1024)
+		
+		result = disk_sim.simulated_read(f"{layer.dev}/sim0", block_size=4096)
+		
+		assert result.name == "simulated"
+		assert layer.counters("sim0")[disk_sim.READS] == 16
+		assert layer.counters("sim0")[disk_sim.SECTORS_READ] == 128
+		
+	def test_check_disk_passes(self, capsys, simulated_check):
+		simulated_check(["sim0"])
+		
+		record = dist_stat_test.check_disk("sim0")
+		
+		assert record["status"] == 0
+		assert record["workload"] == "simulated"
+		assert record["bandwidth"] > 0
+		assert "PASS" in capsys.readouterr().out
+		
+	def test_check_disk_missing(self, capsys, simulated_check):
+		simulated_check(["sim0"])
+		
+		record = dist_stat_test.check_disk("sim9")
+		
+		assert record["status"] != 0
+		
+	def test_sweep_many_disks(self, capsys, simulated_check):
+		'''
+		dozens of disks, all checked in parallel, in a few seconds
+		'''
+		disks = [f"sim{i}" for i in range(32)]
+		layer = simulated_check(disks)
+		
+		start = time.monotonic()
+		status = dist_stat_test.sweep(disks)
+		elapsed = time.monotonic() - start
+		
+		assert status == 0
+		assert elapsed < 10
+		for disk in disks:
+			assert layer.counters(disk)[disk_sim.READS] > 0
+		
+	@pytest.mark.skipif(not disk_sim.loop_devices_permitted(), reason="loop devices can't be created here")
+	def test_sweep_loop_devices(self, capsys, tmp_path, monkeypatch):
+		try:
+			disks = disk_sim.attach_loop_devices(tmp_path, 4)
+		except OSError as e:
+			pytest.skip(str(e))
+			
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD", "sequential")
+		monkeypatch.setattr(dist_stat_test, "SETTLE", 0)
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		try:
+			status = dist_stat_test.sweep(disks)
+		finally:
+			disk_sim.detach_loop_devices(disks)
+			
+		assert status == 0
@@ -0,0 +1,77 @@
+import pytest
+
+import disk_stats
+
+import io
+import tracemalloc
+
+ROWS = (
+	"   8       0 sda 100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0\n"
+	"   8       1 sda1 60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0\n"
+	#Linux 4.18 to 5.4, 15 counters
+	" 253       0 dm-0 7 0 56 1 0 0 0 0 2 1 1 0 0 0 0\n"
+	#before Linux 4.18, 11 counters
+	"   7       0 loop0 18446744073709551615 0 0 0 0 0 0 0 0 0 0\n"
+)
+
+def write_diskstats(path, devices):
+	'''
+	A /proc/diskstats with a row for each of `devices` (a count) loop devices
+	'''
+	with open(path, "w") as f:
+		for n in range(devices):
+			f.write(f"   7 {n:7d} loop{n} {n} 0 {n * 8} 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+
+def peak_memory(parse):
+	tracemalloc.start()
+	try:
+		snapshot = parse()
+		return snapshot, tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+class Test_disk_stats:
+	def test_parse(self):
+		snapshot = disk_stats.parse(io.BytesIO(ROWS.encode()))
+		
+		assert list(snapshot) == ["sda", "sda1", "dm-0", "loop0"]
+		assert snapshot["sda"] == [100, 0, 800, 10, 50, 0, 400, 5, 0, 15, 15, 0, 0, 0, 0, 0, 0]
+		assert snapshot["dm-0"] == [7, 0, 56, 1, 0, 0, 0, 0, 2, 1, 1, 0, 0, 0, 0]
+		assert snapshot["loop0"][0] == 2 ** 64 - 1
+		assert snapshot.counter("sda1", 4) == 30
+		assert snapshot.get("sdb") is None
+		
+	def test_parse_selected(self):
+		snapshot = disk_stats.parse(io.BytesIO(ROWS.encode()), ["sda", "loop0", "sdz"])
+		
+		assert list(snapshot) == ["sda", "loop0"]
+		assert "sda1" not in snapshot
+		
+	def test_rows_split_across_chunks(self):
+		'''
+		with chunks far smaller than a row, and no newline at the end of the file
+		'''
+		for chunk_size in (1, 7, 64):
+			snapshot = disk_stats.parse(io.BytesIO(ROWS.rstrip("\n").encode()), chunk_size=chunk_size)
+			
+			assert list(snapshot) == ["sda", "sda1", "dm-0", "loop0"]
+			assert snapshot["loop0"][-1] == 0
+			
+	def test_memory_selected(self, tmp_path):
+		'''
+		a few devices out of 100,000 cost no more than the chunk being read
+		'''
+		write_diskstats(tmp_path / "diskstats", 100_000)
+		
+		snapshot, peak = peak_memory(lambda: disk_stats.read(str(tmp_path / "diskstats"), ["loop7", "loop99999"]))
+		
+		assert snapshot["loop99999"][2] == 99999 * 8
+		assert peak < 1024 * 1024
+		
+	def test_memory_all(self, tmp_path):
+		write_diskstats(tmp_path / "diskstats", 100_000)
+		
+		snapshot, peak = peak_memory(lambda: disk_stats.read(str(tmp_path / "diskstats")))
+		
+		assert len(snapshot) == 100_000
+		assert peak < 50 * 1024 * 1024
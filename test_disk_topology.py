@@ -0,0 +1,97 @@
+import pytest
+
+import disk_topology
+
+import os
+
+'''
+NOTE
+A fake sysfs is laid out under tmp_path with the same symlink structure as the real one:
+/sys/block/DISK/device -> somewhere under /sys/devices/pci.../ADAPTER/...
+'''
+@pytest.fixture
+def fake_sys(tmp_path):
+	sys_root = tmp_path / "sys"
+	
+	def add_disk(disk, device_path, numa_node=None):
+		device = sys_root / "devices" / device_path
+		device.mkdir(parents=True, exist_ok=True)
+		if numa_node is not None:
+			adapter = [parent for parent in [device, *device.parents] if disk_topology.PCI_ADDRESS.match(parent.name)][0]
+			(adapter / "numa_node").write_text(f"{numa_node}\n")
+		(sys_root / "block" / disk).mkdir(parents=True)
+		os.symlink(device, sys_root / "block" / disk / "device")
+		
+	node1 = sys_root / "devices" / "system" / "node" / "node1"
+	node1.mkdir(parents=True)
+	(node1 / "cpulist").write_text("8-11,24\n")
+	
+	add_disk("sda", "pci0000:00/0000:00:17.0/ata3/host2/target2:0:0/2:0:0:0", numa_node=-1)
+	add_disk("sdb", "pci0000:80/0000:80:03.0/0000:81:00.0/host7/port-7:0/end_device-7:0/target7:0:0/7:0:0:0", numa_node=1)
+	add_disk("nvme0n1", "pci0000:80/0000:80:01.0/0000:82:00.0/nvme/nvme0", numa_node=1)
+	(sys_root / "block" / "zram0").mkdir(parents=True)
+	return str(sys_root)
+
+class Test_disk_topology:
+	def test_parse_cpulist(self):
+		assert disk_topology.parse_cpulist("0-3,8,10-11\n") == {0, 1, 2, 3, 8, 10, 11}
+		assert disk_topology.parse_cpulist("") == set()
+		
+	def test_sata_disk_unknown_numa(self, fake_sys):
+		assert disk_topology.disk_topology("sda", fake_sys) == ("0000:00:17.0", -1, None)
+		
+	def test_sas_disk_uses_deepest_pci_function(self, fake_sys):
+		'''
+		the HBA (0000:81:00.0) sits behind a PCI bridge (0000:80:03.0); the HBA is the adapter
+		'''
+		assert disk_topology.disk_topology("sdb", fake_sys) == ("0000:81:00.0", 1, {8, 9, 10, 11, 24})
+		
+	def test_nvme_disk(self, fake_sys):
+		assert disk_topology.disk_topology("nvme0n1", fake_sys).adapter == "0000:82:00.0"
+		
+	def test_virtual_disk_has_no_adapter(self, fake_sys):
+		assert disk_topology.disk_topology("zram0", fake_sys) == (None, -1, None)
+		assert disk_topology.disk_topology("missing", fake_sys) == (None, -1, None)
+		
+	def test_topologies(self, fake_sys):
+		'''
+		each disk's topology is read once, the first time it's asked for
+		'''
+		topology = disk_topology.Topologies(fake_sys)
+		
+		assert topology.adapter_of("sdb") == "0000:81:00.0"
+		assert topology.cpus_of("sdb") == {8, 9, 10, 11, 24}
+		assert topology.cpus_of("sda") is None
+		assert list(topology) == ["sdb", "sda"]
+		
+	def test_is_physical_disk(self, fake_sys, tmp_path):
+		add_cdrom = tmp_path / "sys" / "block" / "sr0" / "device"
+		add_cdrom.mkdir(parents=True)
+		(add_cdrom / "type").write_text("5\n")
+		
+		assert disk_topology.is_physical_disk("sda", fake_sys)
+		assert disk_topology.is_physical_disk("nvme0n1", fake_sys)
+		assert not disk_topology.is_physical_disk("zram0", fake_sys)
+		assert not disk_topology.is_physical_disk("sr0", fake_sys)
+		assert not disk_topology.is_physical_disk("missing", fake_sys)
+		
+	def test_interleave(self):
+		adapters = {"sda": "a", "sdb": "a", "sdc": "a", "sdd": "b", "sde": "c", "sdf": "c"}
+		
+		assert disk_topology.interleave(list(adapters), adapters.get) == ["sda", "sdd", "sde", "sdb", "sdf", "sdc"]
+		
+	def test_disk_identity(self, fake_sys):
+		'''
+		SCSI disks have their serial and model under device/, virtio disks a serial of their own
+		'''
+		device = os.path.realpath(f"{fake_sys}/block/sdb/device")
+		with open(f"{device}/serial", "w") as f:
+			f.write("ZA1234  \n")
+		with open(f"{device}/model", "w") as f:
+			f.write("ST8000NM0055\n")
+		with open(f"{fake_sys}/block/zram0/serial", "w") as f:
+			f.write("virtio-serial\n")
+			
+		assert disk_topology.disk_identity("sdb", fake_sys) == ("ZA1234", "ST8000NM0055")
+		assert disk_topology.disk_identity("zram0", fake_sys) == ("virtio-serial", None)
+		assert disk_topology.disk_identity("sda", fake_sys) == (None, None)
@@ -0,0 +1,115 @@
+import pytest
+
+import disk_sim
+import disk_trace
+
+import mmap
+import os
+
+TRACE = (
+	b"          hdparm-1234    [002] d..1.  100.000100: block_rq_issue: 8,0 R 4096 () 2048 + 8 none,0,0 [hdparm]\n"
+	b"          hdparm-1234    [002] d..1.  100.000200: block_rq_issue: 8,0 R 4096 () 4096 + 8 none,0,0 [hdparm]\n"
+	#another disk, let through by a filter-less trace
+	b"          hdparm-1234    [002] d..1.  100.000300: block_rq_issue: 8,16 R 4096 () 2048 + 8 none,0,0 [hdparm]\n"
+	b"          <idle>-0       [002] ..s1.  100.001100: block_rq_complete: 8,0 R () 2048 + 8 none,0,0 [0]\n"
+	#an older kernel, without the I/O priority
+	b"          <idle>-0       [002] ..s1.  100.004200: block_rq_complete: 8,0 R () 4096 + 8 [0]\n"
+	b"          <idle>-0       [002] ..s1.  100.005000: block_rq_complete: 8,16 R () 2048 + 8 none,0,0 [0]\n"
+	#a completion without its issue, from before the trace started
+	b"          <idle>-0       [002] ..s1.  100.006000: block_rq_complete: 8,0 R () 8192 + 8 none,0,0 [0]\n"
+)
+
+def tracing_permitted():
+	try:
+		disk_trace.tracefs()
+	except disk_trace.TraceError:
+		return False
+	return disk_sim.loop_devices_permitted()
+
+class Test_disk_trace:
+	def test_histogram(self):
+		histogram = disk_trace.LatencyHistogram()
+		for n in range(1, 101):
+			histogram.add(n / 1000)
+		
+		assert histogram.count == 100
+		assert histogram.max == 0.1
+		#within a bucket's width (2 ** (1 / 8)) above the exact answer
+		assert 0.050 <= histogram.percentile(50) <= 0.050 * 2 ** (1 / 8)
+		assert 0.099 <= histogram.percentile(99) <= 0.1
+		assert histogram.percentile(100) == 0.1
+		
+	def test_histogram_size_is_bounded(self):
+		'''
+		a bucket per ~9% of latency, so a million requests take a few hundred buckets at most
+		'''
+		histogram = disk_trace.LatencyHistogram()
+		for n in range(1_000_000):
+			histogram.add(n * 1e-7)
+		
+		assert histogram.count == 1_000_000
+		assert len(histogram.buckets) < 200
+		assert histogram.percentile(0) is not None
+		
+	def test_empty_histogram(self):
+		histogram = disk_trace.LatencyHistogram()
+		
+		assert histogram.summary() == {"requests": 0, "p50": None, "p99": None, "max": None}
+		assert str(histogram) == "latency: no requests traced"
+		
+	def test_parser(self):
+		parser = disk_trace.LatencyParser(8, 0)
+		#fed in pieces that split lines, as trace_pipe reads do
+		for offset in range(0, len(TRACE), 100):
+			parser.feed(TRACE[offset:offset + 100])
+		
+		assert parser.histogram.count == 2
+		assert parser.histogram.max == pytest.approx(0.004)
+		assert parser.in_flight == {}
+		
+	def test_parser_in_flight_bounded(self, monkeypatch):
+		monkeypatch.setattr(disk_trace, "MAX_IN_FLIGHT", 10)
+		parser = disk_trace.LatencyParser(8, 0)
+		
+		for sector in range(100):
+			parser.line(f"x-1 [000] ....  1.0: block_rq_issue: 8,0 R 4096 () {sector} + 8 none,0,0 [x]".encode())
+		
+		assert len(parser.in_flight) == 10
+		assert min(parser.in_flight) == (90, 8)
+		
+	def test_unavailable(self, tmp_path, monkeypatch):
+		monkeypatch.setattr(disk_trace, "TRACEFS", (str(tmp_path / "tracing"),))
+		
+		with pytest.raises(disk_trace.TraceError, match="not mounted"):
+			disk_trace.tracefs()
+		
+		(tmp_path / "tracing" / "instances").mkdir(parents=True)
+		
+		with pytest.raises(disk_trace.TraceError, match="no block_rq tracepoints"):
+			disk_trace.tracefs()
+		
+		with pytest.raises(disk_trace.TraceError, match="No device number for sda"):
+			disk_trace.start("sda", str(tmp_path / "sys"))
+			
+	@pytest.mark.skipif(not tracing_permitted(), reason="tracefs or loop devices can't be used here")
+	def test_trace_loop_device(self, tmp_path):
+		try:
+			disk, = disk_sim.attach_loop_devices(tmp_path, 1)
+		except OSError as e:
+			pytest.skip(str(e))
+		
+		try:
+			trace = disk_trace.start(disk)
+			#direct reads, so each one reaches the device rather than the page cache
+			fd = os.open(f"/dev/{disk}", os.O_RDONLY | os.O_DIRECT)
+			buffer = mmap.mmap(-1, 4096)
+			for block in range(64):
+				os.preadv(fd, [buffer], block * 4096)
+			os.close(fd)
+			histogram = trace.stop()
+		finally:
+			disk_sim.detach_loop_devices([disk])
+		
+		assert histogram.count >= 64
+		assert histogram.percentile(99) <= histogram.max
+		assert not os.path.exists(trace.instance)
@@ -0,0 +1,102 @@
+import pytest
+
+import disk_workloads
+
+'''
+NOTE
+These run against a small regular file standing in for a disk; the workloads
+only need something they can open, seek to the end of and pread/pwrite
+'''
+@pytest.fixture
+def fake_disk(tmp_path):
+	path = tmp_path / "disk.img"
+	path.write_bytes(bytes(range(256)) * 4096 * 4)
+	return str(path)
+
+class Test_disk_workloads:
+	def test_sequential_read(self, fake_disk):
+		result = disk_workloads.sequential_read(fake_disk, nbytes=1024 * 1024, block_size=64 * 1024)
+		
+		assert result.name == "sequential"
+		assert result.nbytes == 1024 * 1024
+		assert result.ops == 16
+		assert result.bandwidth > 0
+		
+	def test_sequential_read_stops_at_end_of_device(self, fake_disk):
+		result = disk_workloads.sequential_read(fake_disk, nbytes=1 << 40)
+		
+		assert result.nbytes == 256 * 4096 * 4
+		
+	def test_random_read(self, fake_disk):
+		result = disk_workloads.random_read(fake_disk, count=100, queue_depth=4)
+		
+		assert result.name == "random4k"
+		assert result.ops == 100
+		assert result.nbytes == 100 * 4096
+		assert result.iops > 0
+		
+	def test_write_verify_needs_scratch(self, fake_disk):
+		with pytest.raises(disk_workloads.WorkloadError) as pytest_wrapped_e:
+			disk_workloads.write_verify(fake_disk)
+			
+		assert "scratch" in str(pytest_wrapped_e.value)
+		
+	def test_write_verify_scratch_offset(self, fake_disk):
+		'''
+		only the designated region may be overwritten
+		'''
+		with open(fake_disk, "rb") as f:
+			before = f.read()
+			
+		result = disk_workloads.write_verify(fake_disk, scratch_offset=1024 * 1024, nbytes=256 * 1024, block_size=64 * 1024)
+		
+		with open(fake_disk, "rb") as f:
+			after = f.read()
+			
+		assert result.name == "write-verify"
+		assert result.ops == 8
+		assert after[:1024 * 1024] == before[:1024 * 1024]
+		assert after[1024 * 1024 + 256 * 1024:] == before[1024 * 1024 + 256 * 1024:]
+		
+	def test_write_verify_unaligned_offset(self, fake_disk):
+		with pytest.raises(disk_workloads.WorkloadError):
+			disk_workloads.write_verify(fake_disk, scratch_offset=100)
+			
+	def test_unknown_workload(self, fake_disk):
+		with pytest.raises(disk_workloads.WorkloadError):
+			disk_workloads.run_workload("no such workload", fake_disk)
+			
+	def test_token_bucket_rate(self, clock):
+		'''
+		the virtual clock fixture stands in for time, so the test doesn't have to wait
+		'''
+		bucket = disk_workloads.TokenBucket(10, burst=1, clock=clock.monotonic, sleep=clock.sleep)
+		for _ in range(21):
+			bucket.take()
+			
+		#the first token is there from the start, the other 20 take 2 seconds at 10 a second
+		assert clock.now == pytest.approx(2.0)
+		
+	def test_token_bucket_bad_rate(self):
+		with pytest.raises(disk_workloads.WorkloadError):
+			disk_workloads.TokenBucket(0)
+			
+	def test_trickle_read(self, fake_disk, clock):
+		bucket = disk_workloads.TokenBucket(4, clock=clock.monotonic, sleep=clock.sleep)
+		result = disk_workloads.trickle_read(fake_disk, count=8, bucket=bucket)
+		
+		assert result.name == "trickle"
+		assert result.ops == 8
+		assert result.nbytes == 8 * 4096
+		assert clock.now == pytest.approx(7 / 4)
+		
+	def test_parse_hdparm(self):
+		output = "\n/dev/sda:\n Timing buffered disk reads: 1024 MB in  2.00 seconds = 512.00 MB/sec\n"
+		
+		result = disk_workloads.parse_hdparm(output)
+		
+		assert result.name == "hdparm"
+		assert result.nbytes == 1024 * 1024 * 1024
+		assert result.ops == 512
+		assert result.bandwidth == 512 * 1024 * 1024
+		assert disk_workloads.parse_hdparm("/dev/sda: Permission denied") is None
@@ -2,85 +2,32 @@ import pytest
 
 import dist_stat_test
 
-import subprocess
+import disk_workloads
 
-from unittest.mock import patch
-from unittest.mock import Mock
+from conftest import row, stat
 
-import pathlib
-
-python = "/usr/bin/python3"
+import socket
 
 '''
 NOTE
-As we have no way in the program of stopping execution to test individual components
-we use exceptions to stop execution between shell calls in the script
-This allows for testing individual components
+The shell calls made by the script go through the `runner` fixture, a fake
+subprocess.run (see conftest.py), its reads of /proc/diskstats through the fake
+`diskstats`, and time.sleep through the virtual `clock` fixture, all set up by the
+`disk_check` fixture.  Each test runs main() through
+to its end, then looks at what was run, what was printed and the exit status;
+nothing is shared between tests, so they can run in any order, or in parallel
 '''
 
-import types
-seen_call_args = []
-stop_after_num_calls = 1
-return_codes = [0]
-def mock_stdout_decode(): pass
-def mock_stderr_decode(): pass
-class Mock_Exception(Exception): pass
-def mock_subprocess_run(*args, **kwargs):
-	'''
-	This function is used to mock subprocess.run in dist_stat_test
-	it will accept n calls before throwing an exception
-	The exception is used to terminate execution of dist_stat_test.main()
-	The exception thrown is Mock_Exception, so as to ensure no spurious exceptions are
-	thrown
-	This function accepts the args and kwargs passed to subprocess.run in dist_stat_test.main()
-	But depends on other external variables:
-	seen_call_args; which stores the arguments passed to the mock function
-	stop_after_num_calls; which indicates how many calls to observe before throwing the mock exception
-	return_codes; a list of values to use as return codes from mock shell calls
-	mock_stdout_decode; mocks the function call: res.stdout.decode()
-	mock_stderr_decode; mocks the function call: res.stderr.decode()
-	'''
-	seen_call_args.append(args)
-	
-	#check to see if we want to stop execution by throwing Mock_Exception
-	call_index = len(seen_call_args)
-	if call_index == (stop_after_num_calls+1):
-		raise Mock_Exception()
-	
-	#otherwise return a namespace object to mimic a return object from subprocess.run
-	#but whose return code is set from `return_codes`
-	res = types.SimpleNamespace()
-	res.returncode = return_codes[call_index-1]
-
-	res.stdout = types.SimpleNamespace()
-	res.stdout.decode = mock_stdout_decode
-	
-	res.stderr = types.SimpleNamespace()
-	res.stderr.decode = mock_stderr_decode
-	
-	return res
-	
-@pytest.fixture
-def setup_mock_subprocess_run():
-	global seen_call_args
-	seen_call_args = []
-	
-	global stop_after_num_calls
-	stop_after_num_calls = None
-	
-	global return_codes
-	return_codes = []
-	
 class Test_dist_stat_test:
 	'''
 	NOTE
 	As sys.exit is called inside the script, we need to capture that event for testing
 	thus the construction:
-
+	
 	```
 	with pytest.raises(SystemExit) as pytest_wrapped_e:
 	```
-
+	
 	see:
 	https://medium.com/python-pandemonium/testing-sys-exit-with-pytest-10c6e5f7726f
 	'''
@@ -88,67 +35,45 @@ class Test_dist_stat_test:
 	'''
 	NOTE
 	since we output to stdout and stderr, we need to capture that output and test against
-	so we use the fixture capsys
+	so we use the fixture capsys; readouterr() consumes what has been captured, so it
+	is called once, and both .out and .err taken from the result
 	
 	see:
 	https://docs.pytest.org/en/6.2.x/capture.html#accessing-captured-output-from-a-test-function
 	'''
-	def test_nvdimm_check(self, capsys):
-		dist_stat_test.DISK = "pmem"
-		
+	def run_main(self):
 		with pytest.raises(SystemExit) as pytest_wrapped_e:
 			dist_stat_test.main()
-	
+		
 		assert pytest_wrapped_e.type == SystemExit
-		assert dist_stat_test.STATUS == 0
-		assert pytest_wrapped_e.value.code == dist_stat_test.STATUS
+		return pytest_wrapped_e.value.code
+	
+	def test_nvdimm_check(self, capsys, disk_check, runner):
+		dist_stat_test.DISK = "pmem0"
 		
-		captured_stdout = capsys.readouterr().out
-		captured_stderr = capsys.readouterr().err
+		assert self.run_main() == 0
+		assert runner.calls == []
 		
-		assert "NVDIMM" in captured_stdout
+		captured = capsys.readouterr()
+		
+		assert "NVDIMM" in captured.out
 	
-	'''
-	NOTE
-	Here we found that stderr messages were not being properly captured by capsys
-	so instead check_return_code() was mocked and its arguments and calls were inspected directly
-	'''
-	def test_proc_partitions_check_ok(self, capsys, setup_mock_subprocess_run):
+	def test_proc_partitions_check_ok(self, capsys, disk_check, runner):
 		'''
 		testing call:
 		Check /proc/partitions, exit with fail if disk isn't found
 		
 		returned without issue
-		so no output or errors, and STATUS should be 0
+		so no error, and STATUS should be 0
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 1
-
-		global return_codes
-		return_codes = [0]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-				
-				assert mock_check_return.call_count == 1
-								
-				#get the arguments for the first call to `check_return_code()`
-				return_code = mock_check_return.call_args_list[0][0][0]
-				check_return_code_message = mock_check_return.call_args_list[0][0][1]
-								
-				assert return_code == 0
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_proc_partitions_check_error(self, capsys, setup_mock_subprocess_run):
+		assert self.run_main() == 0
+		assert runner.calls[0] == ["grep", "-w", "-q", "sda", f"{dist_stat_test.PROC}/partitions"]
+		
+		captured = capsys.readouterr()
+		
+		assert len(captured.err) == 0
+	
+	def test_proc_partitions_check_error(self, capsys, disk_check, runner):
 		'''
 		testing call:
 		Check /proc/partitions, exit with fail if disk isn't found
@@ -156,565 +81,183 @@ class Test_dist_stat_test:
 		returned with error
 		should see an error message, and STATUS is 1
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 1
-
-		global return_codes
-		return_codes = [1]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 1
-				
-				#get the arguments for the first call to `check_return_code()`
-				return_code = mock_check_return.call_args_list[0][0][0]
-				check_return_code_message = mock_check_return.call_args_list[0][0][1]
-								
-				assert return_code == 1
-				assert "not found in /proc/partitions" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_proc_diskstats_check_ok(self, capsys, setup_mock_subprocess_run):
+		runner.on("partitions", returncode=1)
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert f"not found in {dist_stat_test.PROC}/partitions" in captured.err
+		assert captured.err.count("ERROR") == 1
+	
+	def test_proc_diskstats_check_ok(self, capsys, disk_check, diskstats):
 		'''
 		testing call:
 		#Next, check /proc/diskstats
 		
 		returns without error
-		should see return code 0, and no error messages
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 2
-
-		global return_codes
-		return_codes = [0, 0]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 2
-				
-				#get the arguments for the last call to `check_return_code()`
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 0
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_proc_diskstats_check_error(self, capsys, setup_mock_subprocess_run):
+		assert self.run_main() == 0
+		assert diskstats.reads[0] == ["sda"]
+	
+	def test_proc_diskstats_check_error(self, capsys, disk_check, diskstats):
 		'''
 		testing call:
 		#Next, check /proc/diskstats
 		
-		return with an error
+		no row for the disk
 		should see return code 1, and an error message
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 2
-
-		global return_codes
-		return_codes = [0, 1]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 2
-				
-				#get the arguments for the last call to `check_return_code()`
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 1
-				assert "not found in /proc/diskstats" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_sys_block_check_ok(self, capsys, setup_mock_subprocess_run):
+		diskstats.remove("sda")
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert f"not found in {dist_stat_test.PROC}/diskstats" in captured.err
+		assert captured.err.count("ERROR") == 1
+	
+	def test_sys_block_check_ok(self, capsys, disk_check, runner):
 		'''
 		testing call:
 		#Verify the disk shows up in /sys/block/
 		
 		return without error
-		should see return code 0, and no error message
-		
-		Note for this test execution continues until the block marked:
-		#Get some baseline stats for use later
-		and so we get extra calls to check_return_code()
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 0]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 4
-				
-				#get the arguments for next to the last call, since this executes more than we want for this test
-				return_code = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][0]
-				check_return_code_message = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][1]
-								
-				assert return_code == 0
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_sys_block_check_error(self, capsys, setup_mock_subprocess_run):
+		assert self.run_main() == 0
+		assert runner.calls[1] == ["ls", f"{dist_stat_test.SYS}/block/sda"]
+	
+	def test_sys_block_check_error(self, capsys, disk_check, runner):
 		'''
 		testing call:
 		#Verify the disk shows up in /sys/block/
 		
-		return without error
+		return with error
 		should see return code 1, and should have error message
-		
-		Note for this test execution continues until the block marked:
-		#Get some baseline stats for use later
-		and so we get extra calls to check_return_code()
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 1]
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-					dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 4
-				
-				#get the arguments for next to the last call, since this executes more than we want for this test
-				return_code = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][0]
-				check_return_code_message = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][1]
-								
-				assert return_code == 1
-				assert "not found in /sys/block" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_stats_in_sys_block_exists_false_stat_0(self, capsys, setup_mock_subprocess_run):
-		'''
-		testing call:
-		#Verify there are stats in /sys/block/$DISK/stat
+		runner.on("sysfs", returncode=1)
 		
-		here we test this branch:
-		if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+		assert self.run_main() == 1
 		
-		so we mock pathlib.Path.exists() and pathlib.Path.stat()
-		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return False
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 0
-			return res
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-							dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 4
-				
-				#get the arguments for the last call to check_return_code()
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 1
-				assert "stat is either empty or nonexistant in" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_stats_in_sys_block_exists_true_stat_0(self, capsys, setup_mock_subprocess_run):
-		'''
-		testing call:
-		#Verify there are stats in /sys/block/$DISK/stat
+		captured = capsys.readouterr()
 		
-		here we test this branch:
-		if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+		assert "/block" in captured.err
+		assert "not found in" in captured.err
+	
+	'''
+	NOTE
+	The next four tests cover the branch:
+	if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+	
+	rather than mocking pathlib.Path, the stat file set up by the disk_check fixture
+	is removed or emptied
+	'''
+	def test_stats_in_sys_block_exists_false_stat_0(self, capsys, disk_check):
+		disk_check.unlink()
 		
-		so we mock pathlib.Path.exists() and pathlib.Path.stat()
-		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 0
-			return res
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-							dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 4
-				
-				#get the arguments for the last call to check_return_code()
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 1
-				assert "stat is either empty or nonexistant in" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_stats_in_sys_block_exists_false_stat_1(self, capsys, setup_mock_subprocess_run):
-		'''
-		testing call:
-		#Verify there are stats in /sys/block/$DISK/stat
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "stat is either empty or nonexistant in" in captured.err
+	
+	def test_stats_in_sys_block_exists_true_stat_0(self, capsys, disk_check):
+		disk_check.write_text("")
+		
+		assert self.run_main() == 1
 		
-		here we test this branch:
-		if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+		captured = capsys.readouterr()
 		
-		so we mock pathlib.Path.exists() and pathlib.Path.stat()
+		assert "stat is either empty or nonexistant in" in captured.err
+	
+	def test_stats_in_sys_block_exists_false_stat_1(self, capsys, disk_check):
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return False
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-							dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				assert mock_check_return.call_count == 4
-				
-				#get the arguments for the last call to check_return_code()
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 1
-				assert "stat is either empty or nonexistant in" in check_return_code_message
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_stats_in_sys_block_exists_true_stat_1(self, capsys, setup_mock_subprocess_run):
+		the stat file is gone, but the directory it was in is still there
 		'''
-		testing call:
-		#Verify there are stats in /sys/block/$DISK/stat
+		disk_check.unlink()
+		(disk_check.parent / "queue").write_text("1")
 		
-		here we test this branch:
-		if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
+		assert self.run_main() == 1
 		
-		so we mock pathlib.Path.exists() and pathlib.Path.stat()
-		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 3
-
-		global return_codes
-		return_codes = [0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with pytest.raises(Mock_Exception) as pytest_wrapped_e:
-							dist_stat_test.main()
-					
-				assert pytest_wrapped_e.type == Mock_Exception
-					
-				#here we have one less call to check_return_code() than previous tests as there is no call in the path:
-				#if not ( disk_stat.exists() and (disk_stat.stat().st_size > 0) ):
-				#	check_return_code(1, f"stat is either empty or nonexistant in /sys/block/{DISK}/")
-				assert mock_check_return.call_count == 3
-				
-				#get the arguments for the last call to check_return_code()
-				return_code = mock_check_return.call_args[0][0]
-				check_return_code_message = mock_check_return.call_args[0][1]
-								
-				assert return_code == 0
-							
-				captured_stdout = capsys.readouterr().out
-				
-				assert len(captured_stdout) == 0
-				
-	def test_hadparm_failed_error(self, capsys, setup_mock_subprocess_run):
+		captured = capsys.readouterr()
+		
+		assert "stat is either empty or nonexistant in" in captured.err
+	
+	def test_stats_in_sys_block_exists_true_stat_1(self, capsys, disk_check):
+		assert self.run_main() == 0
+		
+		captured = capsys.readouterr()
+		
+		assert "stat is either empty or nonexistant in" not in captured.err
+	
+	def test_hadparm_failed_error(self, capsys, disk_check, runner, clock):
 		'''
 		testing branch:
 		#giving up, as the test is compromised
 		
 		here we test if hdparm had failed; perhaps due to a permission issue
 		this causes the script to fail and exit() with a non-zero return code
+		before waiting, or reading the stats again
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 6
-
-		global return_codes
-		return_codes = [0, 0, 0, 0, 0, 1]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with pytest.raises(SystemExit) as pytest_wrapped_e:
-							dist_stat_test.main()
-	
-						assert pytest_wrapped_e.type == SystemExit
-						
-						assert mock_check_return.call_count == 4
-						
-						#get the arguments for the last call to check_return_code()
-						return_code = mock_check_return.call_args[0][0]
-						check_return_code_message = mock_check_return.call_args[0][1]
-										
-						assert return_code == 1
-						assert "Error with hdparm" in check_return_code_message
-									
-						captured_stdout = capsys.readouterr().out
-						
-						assert len(captured_stdout) == 0
-						
-	def test_proc_stat_equal(self, capsys, setup_mock_subprocess_run):
+		runner.on("hdparm", returncode=1, stderr="/dev/sda: Permission denied")
+		
+		assert self.run_main() == 1
+		assert runner.steps()[-1] == "hdparm"
+		assert clock.sleeps == []
+		
+		captured = capsys.readouterr()
+		
+		assert "Error with hdparm: /dev/sda: Permission denied" in captured.err
+	
+	def test_hdparm_missing(self, capsys, disk_check, runner, clock):
+		'''
+		hdparm isn't installed; the disk fails its check, rather than the script crashing
+		'''
+		runner.on("hdparm", raises=FileNotFoundError(2, "No such file or directory: 'hdparm'"))
+		
+		assert self.run_main() == 1
+		assert clock.sleeps == []
+		
+		captured = capsys.readouterr()
+		
+		assert "Error with hdparm: [Errno 2] No such file or directory: 'hdparm'" in captured.err
+	
+	def test_proc_stat_equal(self, capsys, disk_check, diskstats):
 		'''
 		testing branch:
 		if (PROC_STAT_BEGIN == PROC_STAT_END):
 		
 		where PROC_STAT_BEGIN equal PROC_STAT_END, producing an error
 		and SYS_STAT_BEGIN does not equal SYS_STAT_END
-		the script ends at `sys.exit(STATUS)` in this case, rather than an exception from subprocess.run
-		and so STATUS is set manually, as it is not set in mock_check_return
-		to avoid unexpected statements to stdout
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 8
-
-		global return_codes
-		return_codes = [0, 0, 0, 0, 0, 0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		#here we setup a mock function for res.stdout.decode()
-		#this mock function will return a sequence of values, one for each call in the script
-		#see: https://stackoverflow.com/questions/24897145/python-mock-multiple-return-values
-		stdout_decode = Mock()
-		return_values = [
-			#first call
-			#PROC_STAT_BEGIN = res.stdout.decode()
-			"PROC_STAT1",
-			#second call
-			#SYS_STAT_BEGIN = res.stdout.decode()
-			"SYS_STAT1",
-			#third call
-			#PROC_STAT_END = res.stdout.decode()
-			"PROC_STAT1",
-			#fourth call
-			#SYS_STAT_END = res.stdout.decode()
-			"SYS_STAT2",
-		]
-		stdout_decode.side_effect = return_values
-		
-		global mock_stdout_decode
-		mock_stdout_decode = stdout_decode
-		
-		def mock_sleep(*args, **kwargs): pass
-		
-		dist_stat_test.STATUS = 1
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with patch("dist_stat_test.time.sleep", new=mock_sleep): #mock time.sleep so we don't have to wait for each test
-							with pytest.raises(SystemExit) as pytest_wrapped_e:
-								dist_stat_test.main()
-	
-						assert pytest_wrapped_e.type == SystemExit
-						
-						assert mock_check_return.call_count == 5
-						
-						#get the arguments for the last call to check_return_code()
-						return_code = mock_check_return.call_args[0][0]
-						check_return_code_message = mock_check_return.call_args[0][1]
-										
-						assert return_code == 1
-						assert "Stats in /proc/diskstats did not change" in check_return_code_message
-									
-						captured_stdout = capsys.readouterr().out
-						
-						assert len(captured_stdout) == 0
-						
-	def test_sys_stat_equal(self, capsys, setup_mock_subprocess_run):
+		diskstats.on([row("sda", 1), row("sda", 1)])
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "/diskstats did not change" in captured.err
+		assert "/block/sda/stat did not change" not in captured.err
+		assert f"output: {row('sda', 1).split(maxsplit=3)[3].rstrip()}" in captured.out
+	
+	def test_sys_stat_equal(self, capsys, disk_check, runner):
 		'''
 		testing branch:
 		if (SYS_STAT_BEGIN == SYS_STAT_END):
 		
 		where PROC_STAT_BEGIN does not equal PROC_STAT_END
 		and SYS_STAT_BEGIN equals SYS_STAT_END, producing an error
-		the script ends at `sys.exit(STATUS)` in this case, rather than an exception from subprocess.run
-		and so STATUS is set manually, as it is not set in mock_check_return
-		to avoid unexpected statements to stdout
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 8
-
-		global return_codes
-		return_codes = [0, 0, 0, 0, 0, 0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		#here we setup a mock function for res.stdout.decode()
-		#this mock function will return a sequence of values, one for each call in the script
-		#see: https://stackoverflow.com/questions/24897145/python-mock-multiple-return-values
-		stdout_decode = Mock()
-		return_values = [
-			#first call
-			#PROC_STAT_BEGIN = res.stdout.decode()
-			"PROC_STAT1",
-			#second call
-			#SYS_STAT_BEGIN = res.stdout.decode()
-			"SYS_STAT1",
-			#third call
-			#PROC_STAT_END = res.stdout.decode()
-			"PROC_STAT2",
-			#fourth call
-			#SYS_STAT_END = res.stdout.decode()
-			"SYS_STAT1",
-		]
-		stdout_decode.side_effect = return_values
-		
-		global mock_stdout_decode
-		mock_stdout_decode = stdout_decode
-		
-		def mock_sleep(*args, **kwargs): pass
-		
-		dist_stat_test.STATUS = 1
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with patch("dist_stat_test.time.sleep", new=mock_sleep): #mock time.sleep so we don't have to wait for each test
-							with pytest.raises(SystemExit) as pytest_wrapped_e:
-								dist_stat_test.main()
-	
-						assert pytest_wrapped_e.type == SystemExit
-						
-						assert mock_check_return.call_count == 5
-						
-						#get the arguments for the last call to check_return_code()
-						return_code = mock_check_return.call_args[0][0]
-						check_return_code_message = mock_check_return.call_args[0][1]
-										
-						assert return_code == 1
-						assert "stat did not change" in check_return_code_message
-									
-						captured_stdout = capsys.readouterr().out
-						
-						assert len(captured_stdout) == 0
-						
-	def test_sys_stat_and_proc_stat_equal(self, capsys, setup_mock_subprocess_run):
+		runner.on("sys_stat", stdout=["SYS_STAT1", "SYS_STAT1"])
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "/block/sda/stat did not change" in captured.err
+		assert "/diskstats did not change" not in captured.err
+	
+	def test_sys_stat_and_proc_stat_equal(self, capsys, disk_check, runner, diskstats):
 		'''
 		testing branch:
 		if (PROC_STAT_BEGIN == PROC_STAT_END):
@@ -722,145 +265,687 @@ class Test_dist_stat_test:
 		
 		where PROC_STAT_BEGIN equals PROC_STAT_END, producing an error
 		and SYS_STAT_BEGIN equals SYS_STAT_END, producing an error
-		the script ends at `sys.exit(STATUS)` in this case, rather than an exception from subprocess.run
-		and so STATUS is set manually, as it is not set in mock_check_return
-		to avoid unexpected statements to stdout
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 8
-
-		global return_codes
-		return_codes = [0, 0, 0, 0, 0, 0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		#here we setup a mock function for res.stdout.decode()
-		#this mock function will return a sequence of values, one for each call in the script
-		#see: https://stackoverflow.com/questions/24897145/python-mock-multiple-return-values
-		stdout_decode = Mock()
-		return_values = [
-			#first call
-			#PROC_STAT_BEGIN = res.stdout.decode()
-			"PROC_STAT1",
-			#second call
-			#SYS_STAT_BEGIN = res.stdout.decode()
-			"SYS_STAT1",
-			#third call
-			#PROC_STAT_END = res.stdout.decode()
-			"PROC_STAT1",
-			#fourth call
-			#SYS_STAT_END = res.stdout.decode()
-			"SYS_STAT1",
-		]
-		stdout_decode.side_effect = return_values
-		
-		global mock_stdout_decode
-		mock_stdout_decode = stdout_decode
-		
-		def mock_sleep(*args, **kwargs): pass
-		
-		dist_stat_test.STATUS = 1
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with patch("dist_stat_test.time.sleep", new=mock_sleep): #mock time.sleep so we don't have to wait for each test
-							with pytest.raises(SystemExit) as pytest_wrapped_e:
-								dist_stat_test.main()
-	
-						assert pytest_wrapped_e.type == SystemExit
-						
-						assert mock_check_return.call_count == 6
-						
-						#check the n-1 call to check_return_code, for the branch: `if (PROC_STAT_BEGIN == PROC_STAT_END):`
-						return_code1 = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][0]
-						check_return_code_message1 = mock_check_return.call_args_list[len(mock_check_return.call_args_list)-2][0][1]
-						
-						assert return_code1 == 1
-						assert "Stats in /proc/diskstats did not change" in check_return_code_message1
-						
-						#check the n call to check_return_code, for the branch: `if (SYS_STAT_BEGIN == SYS_STAT_END):`
-						return_code2 = mock_check_return.call_args[0][0]
-						check_return_code_message2 = mock_check_return.call_args[0][1]
-						
-						assert return_code2 == 1
-						assert "stat did not change" in check_return_code_message2
-							
-						captured_stdout = capsys.readouterr().out
-						
-						assert len(captured_stdout) == 0
-						
-	def test_all_ok(self, capsys, setup_mock_subprocess_run):
+		diskstats.on([row("sda", 1), row("sda", 1)])
+		runner.on("sys_stat", stdout=["SYS_STAT1", "SYS_STAT1"])
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert captured.err.count("ERROR") == 2
+		assert "/diskstats did not change" in captured.err
+		assert "/block/sda/stat did not change" in captured.err
+	
+	def test_all_ok(self, capsys, disk_check, runner, clock, diskstats):
 		'''
 		testing branch:
 		if STATUS == 0:
 		
 		here we emulate as if all calls were successful
+		the stats are read once before and once after hdparm, with a wait of SETTLE in between;
+		the first read of /proc/diskstats both finds the disk and takes its baseline
+		'''
+		assert self.run_main() == 0
+		assert runner.steps() == ["partitions", "sysfs", "sys_stat", "hdparm", "sys_stat"]
+		assert diskstats.reads == [["sda"], ["sda"]]
+		assert clock.sleeps == [dist_stat_test.SETTLE]
+		
+		captured = capsys.readouterr()
 		
-		the script ends at `sys.exit(STATUS)` in this case, rather than an exception from subprocess.run
-		and so STATUS is set manually, as it is not set in mock_check_return
-		to avoid unexpected statements to stdout
+		assert "PASS" in captured.out
+		assert len(captured.err) == 0
+	
+	def test_workload_failed_error(self, capsys, disk_check, runner, monkeypatch):
 		'''
-		dist_stat_test.DISK = "some test arg"
-
-		global stop_after_num_calls
-		stop_after_num_calls = 8
+		testing branch:
+		#giving up, as the test is compromised
+		
+		here a workload other than hdparm was chosen, and it failed; perhaps the disk can't be opened
+		this causes the script to fail and exit() with a non-zero return code
+		'''
+		def mock_run_workload(*args, **kwargs): raise PermissionError("Permission denied")
+		
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD", "sequential")
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "run_workload", mock_run_workload)
+		
+		assert self.run_main() == 1
+		assert "hdparm" not in runner.steps()
+		
+		captured = capsys.readouterr()
+		
+		assert "Error with sequential workload" in captured.err
+	
+	def test_workload_ok(self, capsys, disk_check, runner, monkeypatch):
+		def mock_run_workload(*args, **kwargs): return disk_workloads.WorkloadResult("sequential", 10, 10 * 1024 * 1024, 0.5)
+		
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD", "sequential")
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "run_workload", mock_run_workload)
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["disk"] == "sda"
+		assert record["status"] == 0
+		assert record["workload"] == "sequential"
+		assert record["iops"] == 20.0
+		assert record["bandwidth"] == 2 * 10 * 1024 * 1024
+		
+		captured = capsys.readouterr()
+		
+		assert "sequential: 20 IOPS" in captured.out
+	
+	def test_scratch_per_disk(self, capsys, disk_check, runner, monkeypatch):
+		'''
+		{disk} in the scratch path gives each disk a scratch file of its own
+		'''
+		scratch = {}
+		def mock_run_workload(workload, path, **options):
+			scratch[path] = options["scratch"]
+			return disk_workloads.WorkloadResult("write-verify", 2, 2 * 1024 * 1024, 0.5)
+		
+		self.add_disks(disk_check, ["sdb"])
+		monkeypatch.setattr(dist_stat_test, "BATCH", True)
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD", "write-verify")
+		monkeypatch.setattr(dist_stat_test, "WORKLOAD_OPTIONS", {"scratch": "/mnt/{disk}/scratch", "scratch_offset": None})
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "run_workload", mock_run_workload)
+		
+		assert dist_stat_test.sweep(["sda", "sdb"]) == 0
+		assert scratch == {"/dev/sda": "/mnt/sda/scratch", "/dev/sdb": "/mnt/sdb/scratch"}
+	
+	def test_hdparm_throughput_recorded(self, capsys, disk_check, runner):
+		runner.on("hdparm", stdout=["\n/dev/sda:\n Timing buffered disk reads: 1024 MB in  2.00 seconds = 512.00 MB/sec\n"])
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["status"] == 0
+		assert record["workload"] == "hdparm"
+		assert record["bandwidth"] == 512 * 1024 * 1024
+		
+	def test_latency(self, capsys, disk_check, runner, monkeypatch):
+		'''
+		the trace covers the activity only, and its latencies are reported with the result
+		'''
+		class FakeTrace:
+			def stop(self):
+				histogram = dist_stat_test.disk_trace.LatencyHistogram()
+				for latency in (0.001, 0.002, 0.004):
+					histogram.add(latency)
+				self.steps = runner.steps()
+				return histogram
+		trace = FakeTrace()
+		
+		monkeypatch.setattr(dist_stat_test, "LATENCY", True)
+		monkeypatch.setattr(dist_stat_test.disk_trace, "start", lambda disk, sys_root: trace)
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert trace.steps[-1] == "hdparm"
+		assert record["status"] == 0
+		assert record["latency"]["requests"] == 3
+		assert record["latency"]["max"] == 0.004
+		assert "Disk sda latency: p50 2.048ms, p99 4.000ms, max 4.000ms over 3 requests" in capsys.readouterr().out
+		
+	def test_latency_unavailable(self, capsys, disk_check, runner, monkeypatch):
+		'''
+		without tracefs the check goes on as it would have
+		'''
+		def start(disk, sys_root):
+			raise dist_stat_test.disk_trace.TraceError("tracefs is not mounted")
+		
+		monkeypatch.setattr(dist_stat_test, "LATENCY", True)
+		monkeypatch.setattr(dist_stat_test.disk_trace, "start", start)
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["status"] == 0
+		assert record["latency"] is None
+		
+		captured = capsys.readouterr()
+		
+		assert "Latency tracing unavailable for sda: tracefs is not mounted" in captured.out
+		assert "PASS: Finished testing stats for sda" in captured.out
+		
+	def test_health_collected(self, capsys, disk_check, runner, tmp_path, monkeypatch):
+		monkeypatch.setattr(dist_stat_test, "HEALTH", True)
+		monkeypatch.setattr(dist_stat_test.disk_health, "CACHE_DIR", str(tmp_path / "health"))
+		runner.on("smartctl", stdout=['{"smart_status": {"passed": true}, "temperature": {"current": 30}}'])
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["status"] == 0
+		assert record["health"]["passed"] is True
+		assert record["health"]["temperature"] == 30
+		assert "smartctl" in runner.steps()
+		
+	def test_health_failing(self, capsys, disk_check, runner, tmp_path, monkeypatch):
+		monkeypatch.setattr(dist_stat_test, "HEALTH", True)
+		monkeypatch.setattr(dist_stat_test.disk_health, "CACHE_DIR", str(tmp_path / "health"))
+		runner.on("smartctl", returncode=8, stdout=['{"smart_status": {"passed": false}}'])
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["status"] == 1
+		assert "Disk sda reports failing health" in capsys.readouterr().err
+		
+	def test_health_unavailable(self, capsys, disk_check, runner, tmp_path, monkeypatch):
+		'''
+		a disk whose health can't be read still passes on its stats
+		'''
+		monkeypatch.setattr(dist_stat_test, "HEALTH", True)
+		monkeypatch.setattr(dist_stat_test.disk_health, "CACHE_DIR", str(tmp_path / "health"))
+		runner.on("smartctl", returncode=2, stdout=['{}'])
+		
+		record = dist_stat_test.check_disk("sda")
+		
+		assert record["status"] == 0
+		assert record["health"] is None
+		assert "Health data for sda unavailable" in capsys.readouterr().out
+		
+	def test_gentle_busy_disk(self, capsys, disk_check, runner, clock, monkeypatch):
+		'''
+		testing branch:
+		if (PROC_STAT_BEGIN != PROC_STAT_NOW) and (SYS_STAT_BEGIN != SYS_STAT_NOW):
+		
+		in gentle mode the stats are already moving when looked at again
+		so the script should pass without generating any activity
+		'''
+		def mock_trickle_read(*args, **kwargs): raise AssertionError("no I/O should be generated")
+		
+		monkeypatch.setattr(dist_stat_test, "GENTLE", True)
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "trickle_read", mock_trickle_read)
+		
+		assert self.run_main() == 0
+		assert clock.sleeps == [dist_stat_test.OBSERVE]
+		assert "hdparm" not in runner.steps()
+		
+		captured = capsys.readouterr()
+		
+		assert "already changing" in captured.out
+	
+	def test_gentle_idle_disk(self, capsys, disk_check, runner, clock, diskstats, monkeypatch):
+		'''
+		testing branch:
+		if GENTLE:
+		
+		in gentle mode the stats have not moved when looked at again
+		so the trickle workload is run, and the stats compared as usual
+		'''
+		trickles = []
+		def mock_trickle_read(*args, **kwargs):
+			trickles.append(args)
+			return disk_workloads.WorkloadResult("trickle", 16, 16 * 4096, 0.5)
+		
+		diskstats.on([row("sda", 1), row("sda", 1), row("sda", 2)])
+		runner.on("sys_stat", stdout=["SYS_STAT1", "SYS_STAT1", "SYS_STAT2"])
+		monkeypatch.setattr(dist_stat_test, "GENTLE", True)
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "trickle_read", mock_trickle_read)
+		
+		assert self.run_main() == 0
+		assert len(trickles) == 1
+		assert "hdparm" not in runner.steps()
+		assert clock.sleeps == [dist_stat_test.OBSERVE, dist_stat_test.SETTLE]
+		
+		captured = capsys.readouterr()
+		
+		assert "PASS: Finished testing stats" in captured.out
+	
+	def test_gentle_hung_disk(self, capsys, disk_check, runner, clock, diskstats, monkeypatch):
+		'''
+		testing branch:
+		if io_completed(proc_stat_begin, proc_stats.get(disk)) and io_completed(sys_stat_begin, sys_stats[disk]):
+		
+		in gentle mode a disk with a request hung in flight moves only its in-flight
+		count and io_ticks, completing nothing; it isn't passed as already changing,
+		so the trickle workload is run
+		'''
+		trickles = []
+		def mock_trickle_read(*args, **kwargs):
+			trickles.append(args)
+			return disk_workloads.WorkloadResult("trickle", 16, 16 * 4096, 0.5)
+		
+		diskstats.on([row("sda", 1), row("sda", 1, in_flight=1, io_ticks=1000), row("sda", 2)])
+		runner.on("sys_stat", stdout=[stat(1), stat(1, in_flight=1, io_ticks=1000), stat(2)])
+		monkeypatch.setattr(dist_stat_test, "GENTLE", True)
+		monkeypatch.setattr(dist_stat_test.disk_workloads, "trickle_read", mock_trickle_read)
+		
+		assert self.run_main() == 0
+		assert len(trickles) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "already changing" not in captured.out
+	
+	'''
+	NOTE
+	sweep() runs each disk's check in a forked worker; the workers inherit the fake
+	runner and clock installed by the disk_check fixture, and send their result
+	records back to the parent
+	'''
+	def add_disks(self, disk_check, disks):
+		for disk in disks:
+			stat_file = disk_check.parent.parent / disk / "stat"
+			stat_file.parent.mkdir(exist_ok=True)
+			stat_file.write_text(disk_check.read_text())
+	
+	def test_sweep_all_ok(self, capsys, disk_check):
+		disks = [f"sd{letter}" for letter in "abcdefgh"]
+		self.add_disks(disk_check, disks)
+		
+		assert dist_stat_test.sweep(disks) == 0
+		
+		captured = capsys.readouterr()
+		
+		assert len(captured.err) == 0
+	
+	def test_sweep_one_disk_fails(self, capsys, disk_check, diskstats):
+		'''
+		sdc's stats don't move; only sdc should be reported
+		'''
+		disks = [f"sd{letter}" for letter in "abcdefgh"]
+		self.add_disks(disk_check, disks)
+		diskstats.add("sdc", row("sdc", 1).split(maxsplit=3)[3])
+		
+		assert dist_stat_test.sweep(disks) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert captured.err.count("ERROR") == 1
+		assert "Disk sdc failed its checks" in captured.err
+	
+	def test_sweep_missing_disk(self, capsys, disk_check, runner):
+		self.add_disks(disk_check, ["sdb"])
+		runner.on("partitions", returncode=1, disk="sdz")
+		
+		assert dist_stat_test.sweep(["sdb", "sdz"]) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "Disk sdz failed its checks" in captured.err
+		assert "sdb" not in captured.err
+	
+	def test_sweep_timeout(self, capsys, monkeypatch):
+		'''
+		testing sweep()
+		
+		one disk's check hangs; it should be reported as timed out
+		while the other disks are still checked
+		check_disk is replaced before the workers are forked, so they see the replacement
+		'''
+		def mock_check_disk(disk):
+			if disk == "sdb":
+				import time
+				time.sleep(60)
+			return {"disk": disk, "status": 0}
+		
+		monkeypatch.setattr(dist_stat_test, "check_disk", mock_check_disk)
+		monkeypatch.setattr(dist_stat_test, "TIMEOUT", 0.2)
+		monkeypatch.setattr(dist_stat_test, "STATUS", 0)
+		
+		assert dist_stat_test.sweep(["sda", "sdb", "sdc"]) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert captured.err.count("ERROR") == 1
+		assert "Disk sdb timed out" in captured.err
+	
+	'''
+	NOTE
+	The partition checks read /proc/diskstats in a single pass, as the other stages
+	do; `diskstats` is given rows of made up counters, which stay as they are but for
+	the disk's, and each partition is given a sysfs stat matching its row, unless
+	`stats` says otherwise.  A partition without a row is left out of diskstats
+	'''
+	def add_partitions(self, disk_check, diskstats, monkeypatch, rows, stats=None):
+		stats = {**{name: counters for name, counters in rows}, **(stats or {})}
+		for partition in ("sda1", "sda2"):
+			(disk_check.parent / partition).mkdir()
+			(disk_check.parent / partition / "partition").write_text(partition[-1])
+			if stats.get(partition) is not None:
+				(disk_check.parent / partition / "stat").write_text(f"{stats[partition]}\n")
+			if partition not in dict(rows):
+				diskstats.remove(partition)
+		
+		for name, counters in rows:
+			diskstats.add(name, counters, moving=(name == "sda"))
+		
+		monkeypatch.setattr(dist_stat_test, "PARTITIONS", True)
+		
+	def test_partitions_consistent(self, capsys, disk_check, diskstats, monkeypatch):
+		self.add_partitions(disk_check, diskstats, monkeypatch, [
+			("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0"),
+			("sda1", "60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0"),
+			("sda2", "30 0 240 3 20 0 160 2 0 5 5 0 0 0 0 0 0"),
+			("sdb", "9999 0 9999 0 9999 0 9999 0 0 0 0 0 0 0 0 0 0"),
+		])
+		
+		assert self.run_main() == 0
+		
+		captured = capsys.readouterr()
+		
+		assert len(captured.err) == 0
+		
+	def test_partition_missing_from_diskstats(self, capsys, disk_check, diskstats, monkeypatch):
+		self.add_partitions(disk_check, diskstats, monkeypatch, [
+			("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0"),
+			("sda1", "60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0"),
+		])
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "Partition sda2 of sda not found in" in captured.err
+		
+	def test_partition_sysfs_stat(self, capsys, disk_check, diskstats, monkeypatch):
+		'''
+		sda1 has no stat in sysfs, and sda2's doesn't match its row in /proc/diskstats
+		'''
+		self.add_partitions(disk_check, diskstats, monkeypatch, [
+			("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0"),
+			("sda1", "60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0"),
+			("sda2", "30 0 240 3 20 0 160 2 0 5 5 0 0 0 0 0 0"),
+		], stats={"sda1": None, "sda2": "29 0 232 3 20 0 160 2 0 5 5 0 0 0 0 0 0"})
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "stat is either empty or nonexistant in" in captured.err
+		assert "/block/sda/sda1/" in captured.err
+		assert "/block/sda/sda2/stat don't match its row in" in captured.err
+		assert captured.err.count("ERROR") == 2
+		
+	def test_partition_sysfs_stat_busy(self, capsys, disk_check, diskstats, monkeypatch):
+		'''
+		I/O completing between the reads leaves sysfs ahead of the row read after it, and
+		behind the one read before; not a mismatch
+		'''
+		self.add_partitions(disk_check, diskstats, monkeypatch, [
+			("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0"),
+			("sda1", "60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0"),
+			("sda2", "30 0 240 3 20 0 160 2 0 5 5 0 0 0 0 0 0"),
+		])
+		sysfs = iter([
+			{"sda1": [59, 0, 472, 6, 30, 0, 240, 3, 1, 9, 9], "sda2": [30, 0, 240, 3, 20, 0, 160, 2, 0, 5, 5]},
+			{"sda1": [61, 0, 488, 7, 30, 0, 240, 3, 0, 10, 10], "sda2": [30, 0, 240, 3, 20, 0, 160, 2, 0, 5, 5]},
+		])
+		monkeypatch.setattr(dist_stat_test, "read_partition_stats", lambda disk, partitions: next(sysfs))
+		
+		assert self.run_main() == 0
+		
+	def test_partitions_add_up_to_more_than_disk(self, capsys, disk_check, diskstats, monkeypatch):
+		self.add_partitions(disk_check, diskstats, monkeypatch, [
+			("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0"),
+			("sda1", "60 0 480 6 30 0 240 3 0 9 9 0 0 0 0 0 0"),
+			("sda2", "60 0 480 6 20 0 160 2 0 5 5 0 0 0 0 0 0"),
+		])
+		
+		assert self.run_main() == 1
+		
+		captured = capsys.readouterr()
+		
+		#sda has completed three more reads by the partition checks' second look at /proc/diskstats
+		assert "Partitions of sda have 120 reads completed between them, more than the disk's 103" in captured.err
+		assert "sectors read" in captured.err
+		assert "writes completed" not in captured.err
+		
+	def test_partitions_briefly_ahead_of_disk(self, capsys, disk_check, diskstats, monkeypatch):
+		'''
+		the first read catches the partitions ahead of the disk, the second doesn't;
+		that's I/O completing mid-read, not an accounting bug
+		'''
+		self.add_partitions(disk_check, diskstats, monkeypatch, [], stats={"sda1": "101 0 808 0 0 0 0", "sda2": "0 0 0 0 0 0 0"})
+		
+		#the baseline and end reads, then the partition checks' two
+		diskstats.on([
+			row("sda", 90),
+			row("sda", 99),
+			row("sda", 100) + row("sda1", 101) + row("sda2", 0),
+			row("sda", 102) + row("sda1", 102) + row("sda2", 0),
+		])
+		
+		assert self.run_main() == 0
+		assert diskstats.queued == []
+		
+	def test_sweep_saves_results(self, capsys, disk_check, runner, tmp_path, monkeypatch):
+		'''
+		one batch of records per sweep, including those for disks that failed
+		'''
+		disks = ["sda", "sdb", "sdc"]
+		self.add_disks(disk_check, disks)
+		(disk_check.parent.parent / "sdb" / "serial").write_text("SERIAL-B\n")
+		runner.on("partitions", returncode=1, disk="sdc")
+		monkeypatch.setattr(dist_stat_test, "RESULTS_DB", str(tmp_path / "results.db"))
+		
+		assert dist_stat_test.sweep(disks) == 1
+		
+		conn = dist_stat_test.disk_results_db.connect(str(tmp_path / "results.db"))
+		rows = dict(conn.execute("SELECT serial, status FROM results").fetchall())
+		conn.close()
+		
+		assert rows == {"sda": 0, "SERIAL-B": 0, "sdc": 1}
 
-		global return_codes
-		return_codes = [0, 0, 0, 0, 0, 0, 0, 0]
-		
-		def mock_exists(*args, **kwargs): return True
-		def mock_stat(*args, **kwargs):
-			res = types.SimpleNamespace()
-			res.st_size = 1
-			return res
-		
-		#here we setup a mock function for res.stdout.decode()
-		#this mock function will return a sequence of values, one for each call in the script
-		#see: https://stackoverflow.com/questions/24897145/python-mock-multiple-return-values
-		stdout_decode = Mock()
-		return_values = [
-			#first call
-			#PROC_STAT_BEGIN = res.stdout.decode()
-			"PROC_STAT1",
-			#second call
-			#SYS_STAT_BEGIN = res.stdout.decode()
-			"SYS_STAT1",
-			#third call
-			#PROC_STAT_END = res.stdout.decode()
-			"PROC_STAT2",
-			#fourth call
-			#SYS_STAT_END = res.stdout.decode()
-			"SYS_STAT2",
+	def test_sweep_batch(self, capsys, disk_check, runner, clock, diskstats, monkeypatch):
+		'''
+		with --batch, /proc/diskstats is read once per snapshot for every disk, and
+		the stats settle once; sdc's stats don't move, and only sdc should be reported
+		'''
+		disks = ["sda", "sdb", "sdc", "sdd"]
+		self.add_disks(disk_check, disks)
+		monkeypatch.setattr(dist_stat_test, "BATCH", True)
+		diskstats.on([
+			"".join(row(disk, 1) for disk in disks),
+			"".join(row(disk, 1 if disk == "sdc" else 2) for disk in disks),
+		])
+		
+		assert dist_stat_test.sweep(disks) == 1
+		assert diskstats.reads == [disks, disks]
+		assert runner.steps().count("hdparm") == len(disks)
+		assert clock.sleeps == [dist_stat_test.SETTLE]
+		
+		captured = capsys.readouterr()
+		
+		assert "/diskstats did not change" in captured.err
+		assert "Disk sdc failed its checks" in captured.err
+		assert all(f"Disk {disk} failed" not in captured.err for disk in ["sda", "sdb", "sdd"])
+		assert captured.out.count("PASS: Finished testing stats") == 3
+		
+	def test_sweep_batch_durations(self, capsys, disk_check, clock, monkeypatch, tmp_path):
+		'''
+		with --batch, each disk's duration is its own activity plus the shared wait
+		for the stats to settle, not the whole batch's
+		'''
+		disks = ["sda", "sdb"]
+		self.add_disks(disk_check, disks)
+		monkeypatch.setattr(dist_stat_test, "BATCH", True)
+		monkeypatch.setattr(dist_stat_test, "JOBS", 1)
+		monkeypatch.setattr(dist_stat_test, "RESULTS_DB", str(tmp_path / "results.db"))
+		seconds = {"sda": 2, "sdb": 10}
+		monkeypatch.setattr(dist_stat_test, "generate_activity", lambda run, disk: clock.sleep(seconds[disk]))
+		
+		assert dist_stat_test.sweep(disks) == 0
+		
+		conn = dist_stat_test.disk_results_db.connect(str(tmp_path / "results.db"))
+		durations = dict(conn.execute("SELECT disk, duration FROM results").fetchall())
+		conn.close()
+		
+		assert durations == {"sda": 2 + dist_stat_test.SETTLE, "sdb": 10 + dist_stat_test.SETTLE}
+	
+	def test_sweep_batch_errors(self, capsys, disk_check, runner, monkeypatch, tmp_path):
+		'''
+		with --batch, a disk whose activity raises, or whose stage raises, fails on its
+		own; the others are still checked, and every disk's result is saved
+		'''
+		disks = ["sda", "sdb", "sdc"]
+		self.add_disks(disk_check, disks)
+		monkeypatch.setattr(dist_stat_test, "BATCH", True)
+		monkeypatch.setattr(dist_stat_test, "RESULTS_DB", str(tmp_path / "results.db"))
+		runner.on("hdparm", raises=FileNotFoundError(2, "No such file or directory: 'hdparm'"), disk="sdb")
+		
+		def broken(run, disks):
+			if "sdc" in disks:
+				raise RuntimeError("broken stage")
+		pipeline = dist_stat_test.disk_pipeline.Pipeline(dist_stat_test.PIPELINE.stages, report=dist_stat_test.check_return_code)
+		pipeline.add(dist_stat_test.disk_pipeline.Stage("broken", broken, needs=["end"]))
+		monkeypatch.setattr(dist_stat_test, "PIPELINE", pipeline)
+		
+		assert dist_stat_test.sweep(["sda", "sdb"]) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "Error with hdparm" in captured.err
+		assert "Disk sdb failed its checks" in captured.err
+		assert "PASS: Finished testing stats for sda" in captured.out
+		
+		assert dist_stat_test.sweep(["sdc"]) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "Stage broken failed for sdc: RuntimeError('broken stage')" in captured.err
+		
+		conn = dist_stat_test.disk_results_db.connect(str(tmp_path / "results.db"))
+		rows = dict(conn.execute("SELECT disk, status FROM results").fetchall())
+		conn.close()
+		
+		assert rows == {"sda": 0, "sdb": 1, "sdc": 1}
+	
+	def test_custom_stage(self, capsys, disk_check, runner, monkeypatch):
+		'''
+		a stage added to PIPELINE runs after the stages it needs, and can fail the disk
+		'''
+		seen = []
+		def temperature(run, disks):
+			for disk in disks:
+				seen.append(run.result(disk, "end") is not None)
+				run.check(disk, 1, f"{disk} is too hot")
+		
+		pipeline = dist_stat_test.disk_pipeline.Pipeline(dist_stat_test.PIPELINE.stages, report=dist_stat_test.check_return_code)
+		pipeline.add(dist_stat_test.disk_pipeline.Stage("temperature", temperature, needs=["end"]))
+		monkeypatch.setattr(dist_stat_test, "PIPELINE", pipeline)
+		
+		assert self.run_main() == 1
+		assert seen == [True]
+		
+		captured = capsys.readouterr()
+		
+		assert "sda is too hot" in captured.err
+		
+	def test_report_unreachable(self, capsys, disk_check, monkeypatch):
+		'''
+		a collector that can't be reached fails the run, as results would otherwise be lost
+		'''
+		with socket.socket() as unused:
+			unused.bind(("127.0.0.1", 0))
+			monkeypatch.setattr(dist_stat_test, "REPORT", f"127.0.0.1:{unused.getsockname()[1]}")
+			
+			assert dist_stat_test.sweep(["sda"]) == 1
+		
+		captured = capsys.readouterr()
+		
+		assert "Could not send results to 127.0.0.1" in captured.err
+		
+	def add_plan_disks(self, disk_check, diskstats, monkeypatch, clock, tmp_path):
+		'''
+		sda is idle and has been checked before, sdb is busy, sdc passed a minute ago,
+		and sdd has gone from /proc/diskstats
+		'''
+		disks = ["sda", "sdb", "pmem0", "sdc", "sdd"]
+		self.add_disks(disk_check, disks)
+		(disk_check.parent / "device").mkdir()
+		(disk_check.parent / "device" / "model").write_text("ST8000\n")
+		
+		diskstats.add("sda", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0", moving=True)
+		diskstats.add("sdb", "100 0 800 10 50 0 400 5 3 15 15 0 0 0 0 0 0", moving=True)
+		diskstats.add("pmem0", "0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0")
+		diskstats.add("sdc", "100 0 800 10 50 0 400 5 0 15 15 0 0 0 0 0 0", moving=True)
+		diskstats.remove("sdd")
+		
+		clock.now = 1_800_000_000.0
+		db = str(tmp_path / "results.db")
+		conn = dist_stat_test.disk_results_db.connect(db)
+		dist_stat_test.disk_results_db.store(conn, [
+			dist_stat_test.new_record("sda", 0) | {"timestamp": clock.now - 7200, "duration": 8.0},
+			dist_stat_test.new_record("sda", 0) | {"timestamp": clock.now - 3600, "duration": 10.0},
+			dist_stat_test.new_record("sda", 1) | {"timestamp": clock.now - 1800, "duration": 60.0},
+			dist_stat_test.new_record("sdc", 0) | {"timestamp": clock.now - 60, "duration": 8.0},
+		])
+		conn.close()
+		monkeypatch.setattr(dist_stat_test, "RESULTS_DB", db)
+		monkeypatch.setattr(dist_stat_test, "SKIP_PASSED", 600)
+		monkeypatch.setattr(dist_stat_test, "JOBS", 2)
+		return disks
+		
+	def test_plan(self, capsys, disk_check, runner, diskstats, monkeypatch, clock, tmp_path):
+		disks = self.add_plan_disks(disk_check, diskstats, monkeypatch, clock, tmp_path)
+		
+		entries, total = dist_stat_test.plan(disks)
+		
+		assert [(entry["disk"], entry["action"], entry["reason"], entry["workload"], entry["estimate"]) for entry in entries] == [
+			("sda", "check", None, "hdparm", 9.0),
+			("sdb", "check", "busy; consider --gentle", "hdparm", 10),
+			("pmem0", "skip", "pmem", None, 0),
+			("sdc", "skip", "cached", None, 0),
+			("sdd", "fail", f"not in {tmp_path}/proc/diskstats", None, 0),
+		]
+		assert entries[0]["basis"] == "2 earlier checks of ST8000"
+		#sda and sdb at once
+		assert total == 10
+		#nothing was run against the disks
+		assert runner.calls == []
+		
+	def test_plan_gentle(self, capsys, disk_check, runner, diskstats, monkeypatch, clock, tmp_path):
+		'''
+		in gentle mode a busy disk is expected to pass on its own activity; the others
+		get the trickle, for which no timings have been recorded
+		'''
+		disks = self.add_plan_disks(disk_check, diskstats, monkeypatch, clock, tmp_path)
+		monkeypatch.setattr(dist_stat_test, "GENTLE", True)
+		
+		entries, total = dist_stat_test.plan(disks)
+		
+		assert [(entry["disk"], entry["workload"], entry["estimate"]) for entry in entries if entry["action"] == "check"] == [
+			("sda", "trickle", 1 + 16 / 32 + 5),
+			("sdb", "none", 1),
 		]
-		stdout_decode.side_effect = return_values
-		
-		global mock_stdout_decode
-		mock_stdout_decode = stdout_decode
-		
-		def mock_sleep(*args, **kwargs): pass
-		
-		dist_stat_test.STATUS = 0
-		
-		with patch("dist_stat_test.subprocess.run", new=mock_subprocess_run) as mock_run:
-			with patch("dist_stat_test.check_return_code") as mock_check_return:
-				with patch.object(pathlib.Path, 'exists', mock_exists): #mock pathlib.Path.exists
-					with patch.object(pathlib.Path, 'stat', mock_stat): #mock pathlib.Path.stat
-						with patch("dist_stat_test.time.sleep", new=mock_sleep): #mock time.sleep so we don't have to wait for each test
-							with pytest.raises(SystemExit) as pytest_wrapped_e:
-								dist_stat_test.main()
-	
-						assert pytest_wrapped_e.type == SystemExit
-							
-						captured_stdout = capsys.readouterr().out
-						
-						assert len(captured_stdout) != 0
-						
-						assert "PASS" in captured_stdout
+		assert total == 6.5
+		
+	def test_plan_batch(self, capsys, disk_check, runner, diskstats, monkeypatch, clock, tmp_path):
+		'''
+		with --batch, the activity on every disk is followed by a single wait for the stats to settle
+		'''
+		disks = self.add_plan_disks(disk_check, diskstats, monkeypatch, clock, tmp_path)
+		monkeypatch.setattr(dist_stat_test, "BATCH", True)
+		monkeypatch.setattr(dist_stat_test, "JOBS", 1)
+		
+		entries, total = dist_stat_test.plan(disks)
+		
+		#sda's 9s and sdb's 10s, less the settle counted in each, one after the other, then one settle
+		assert total == (9 - 5) + (10 - 5) + 5
+		
+	def test_print_plan(self, capsys, disk_check, runner, diskstats, monkeypatch, clock, tmp_path):
+		disks = self.add_plan_disks(disk_check, diskstats, monkeypatch, clock, tmp_path)
+		
+		assert dist_stat_test.print_plan(disks) == 0
+		
+		captured = capsys.readouterr()
+		
+		assert "Plan for 5 disks: 2 to check, 1 will fail, 2 skipped" in captured.out
+		assert "  sda: check with hdparm, ~9.0s (2 earlier checks of ST8000)" in captured.out
+		assert "  sdc: skip [cached]" in captured.out
+		assert f"  sdd: will fail [not in {tmp_path}/proc/diskstats]" in captured.out
+		assert "Estimated time: 10.0s, checking 2 disks at once" in captured.out
+		
+	def test_sweep_skips_passed(self, capsys, disk_check, runner, diskstats, monkeypatch, clock, tmp_path):
+		self.add_plan_disks(disk_check, diskstats, monkeypatch, clock, tmp_path)
+		
+		assert dist_stat_test.sweep(["sda", "sdc"]) == 0
+		
+		captured = capsys.readouterr()
+		
+		assert "Disk sdc passed within the last 600s, skipping" in captured.out
+		
+		conn = dist_stat_test.disk_results_db.connect(dist_stat_test.RESULTS_DB)
+		counts = dict(conn.execute("SELECT serial, COUNT(*) FROM results GROUP BY serial").fetchall())
+		conn.close()
+		
+		assert counts == {"sda": 4, "sdc": 1}